@@ -0,0 +1,200 @@
+'''
+Circuit build-times: how long from "launched" to "built" (or
+"failed"), overall and grouped by purpose and by guard.
+
+Each group keeps a QuantileSketch -- a histogram with logarithmic
+buckets -- so memory stays constant however long we run, and any
+quantile is within ``accuracy`` (relative) of the true value.
+'''
+
+from __future__ import print_function
+
+import math
+import time
+import signal
+
+import txtorcon
+
+from carml import util
+
+# quantiles we report
+QUANTILES = (50, 90, 99)
+
+# what SIGUSR1 does: one entry per BuildTimes (see report_on_signal)
+_on_signal = []
+
+
+class QuantileSketch(object):
+    '''
+    Streaming quantiles over positive numbers. A value v goes in
+    bucket ceil(log(v, gamma)); as build-times are somewhere between
+    a millisecond and a few minutes that is a few hundred buckets at
+    most.
+    '''
+
+    #: anything smaller counts as zero
+    MIN_VALUE = 1e-6
+
+    def __init__(self, accuracy=0.01):
+        self._gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.buckets = {}       # bucket index -> count
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value < self.MIN_VALUE:
+            self.zeros += 1
+            return
+        i = int(math.ceil(math.log(value) / self._log_gamma))
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    def quantile(self, pct):
+        '''
+        The pct-th percentile, or None if we have seen nothing.
+        '''
+        if not self.count:
+            return None
+        rank = (self.count - 1) * pct / 100.0
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen > rank:
+                # middle of the bucket (gamma**(i-1), gamma**i]
+                return 2.0 * self._gamma ** i / (self._gamma + 1.0)
+        return 2.0 * self._gamma ** max(self.buckets) / (self._gamma + 1.0)
+
+
+class _Group(object):
+    __slots__ = ['sketch', 'failed']
+
+    def __init__(self):
+        self.sketch = QuantileSketch()
+        self.failed = 0
+
+    @property
+    def built(self):
+        return self.sketch.count
+
+    def failure_rate(self):
+        total = self.built + self.failed
+        if not total:
+            return 0.0
+        return self.failed / float(total)
+
+    def record(self, **extra):
+        rec = dict(built=self.built, failed=self.failed, failure_rate=self.failure_rate())
+        for pct in QUANTILES:
+            rec['p%d' % pct] = self.sketch.quantile(pct)
+        rec.update(extra)
+        return rec
+
+    def describe(self):
+        msg = 'built %d, failed %d (%.1f%%)' % (self.built, self.failed, self.failure_rate() * 100.0)
+        if self.built:
+            msg += ', ' + ' '.join(
+                'p%d %.2fs' % (pct, self.sketch.quantile(pct)) for pct in QUANTILES
+            )
+        return msg
+
+
+def _guard_name(circuit, entry_guards):
+    if not circuit.path:
+        return '(none)'
+    guard = circuit.path[0]
+    if entry_guards is not None and guard.id_hex not in entry_guards:
+        # e.g. circuits through a bridge, or Tor's own tests; keeping
+        # each first hop would grow without bound on a busy relay
+        return '(not a guard)'
+    return guard.name or guard.id_hex
+
+
+class BuildTimes(txtorcon.CircuitListenerMixin):
+    '''
+    A circuit-listener timing every circuit we see launched.
+    entry_guards (like TorState.entry_guards) limits by_guard to our
+    actual guards.
+    '''
+
+    def __init__(self, clock=time.time, entry_guards=None):
+        self._clock = clock
+        self._entry_guards = entry_guards
+        self._launched = {}     # circuit id -> launch time
+        self.overall = _Group()
+        self.by_purpose = {}    # purpose -> _Group
+        self.by_guard = {}      # guard name -> _Group
+        self.interval = _Group()
+
+    def _groups(self, circuit):
+        purpose = circuit.purpose or '(none)'
+        guard = _guard_name(circuit, self._entry_guards)
+        return [
+            self.overall, self.interval,
+            self.by_purpose.setdefault(purpose, _Group()),
+            self.by_guard.setdefault(guard, _Group()),
+        ]
+
+    def circuit_launched(self, circuit):
+        self._launched[circuit.id] = self._clock()
+
+    def circuit_built(self, circuit):
+        start = self._launched.pop(circuit.id, None)
+        if start is None:
+            return              # launched before we started
+        elapsed = self._clock() - start
+        for group in self._groups(circuit):
+            group.sketch.add(elapsed)
+
+    def circuit_failed(self, circuit, **kw):
+        if self._launched.pop(circuit.id, None) is None:
+            return
+        for group in self._groups(circuit):
+            group.failed += 1
+
+    def circuit_closed(self, circuit, **kw):
+        self._launched.pop(circuit.id, None)
+
+    def take_interval(self):
+        '''
+        Returns the build-times since the last call (for --summary).
+        '''
+        interval, self.interval = self.interval, _Group()
+        return interval
+
+    def report(self):
+        if util.output_format == 'jsonl':
+            util.json_record('buildtimes', **self.overall.record(group='all'))
+            for (name, group) in sorted(self.by_purpose.items()):
+                util.json_record('buildtimes', **group.record(group='purpose', name=name))
+            for (name, group) in sorted(self.by_guard.items()):
+                util.json_record('buildtimes', **group.record(group='guard', name=name))
+            return
+
+        print('Circuit build times: %s' % self.overall.describe())
+        for (title, groups) in [('purpose', self.by_purpose), ('guard', self.by_guard)]:
+            if not groups:
+                continue
+            width = max(len(name) for name in groups)
+            print('  By %s:' % title)
+            for (name, group) in sorted(groups.items()):
+                print('    %s  %s' % (name.ljust(width), group.describe()))
+
+
+def report_on_signal(reactor, build_times):
+    '''
+    Makes "kill -USR1" call build_times.report(). There is only one
+    handler, so with several Tor instances (--connect more than once)
+    every BuildTimes registered here reports; each from a timer on
+    its own reactor, so its output goes where the instance's does.
+    '''
+    if not _on_signal:
+        signal.signal(signal.SIGUSR1, lambda *args: reactor.callFromThread(_report_all))
+    _on_signal.append((reactor, build_times))
+
+
+def _report_all():
+    for (reactor, build_times) in _on_signal:
+        reactor.callLater(0, build_times.report)
@@ -6,6 +6,7 @@ from __future__ import print_function
 
 import os
 import sys
+import time
 import functools
 
 import zope.interface
@@ -19,44 +20,111 @@ from carml import util
 
 
 class StdioLineReceiver(LineReceiver):
+    """
+    Runs each line as a command, keeping at most max_in_flight of them
+    queued with Tor (we stop reading when there are that many) and
+    printing the replies in the same order as the commands.
+    """
     delimiter = '\n'
 
-    def __init__(self, all_done, proto):
+    def __init__(self, all_done, proto, max_in_flight=16, interactive=True):
         self.proto = proto
         self.all_done = all_done
-        self.outstanding = []
-        self._exit = False      # when True, all_done.callback() when outstanding empties
+        self.max_in_flight = max_in_flight
+        self.interactive = interactive
+        self.in_flight = 0
+        self.completed = 0
+        self._next_seq = 0      # number of the next command we read
+        self._next_output = 0   # number of the next reply to print
+        self._replies = {}      # number -> reply, waiting for earlier ones
+        self._full = False
+        self._exit = False      # when True, all_done.callback() when in_flight is 0
+        self._started = None
 
     def connectionMade(self):
-        print("Keep entering keys to run CMD on. Control-d to exit.", file=sys.stderr)
+        if self.interactive:
+            print("Keep entering keys to run CMD on. Control-d to exit.", file=sys.stderr)
+        self._started = time.time()
 
     def lineReceived(self, line):
         # Ignore blank lines
-        if not line:
+        keys = line.split()
+        if not keys:
             return
 
-        keys = line.split()
-        d = do_cmd(self.proto, tuple(keys))
-        d.addCallback(self._completed, d)
-        d.addErrback(self._error, d)
-        self.outstanding.append(d)
-
-    def _error(self, arg, d):
-        print(util.colors.red(str(arg)))
-        return
-
-    def _completed(self, arg, d):
-        self.outstanding.remove(d)
-        if self._exit and len(self.outstanding) == 0:
-            self.all_done.callback(None)
+        seq = self._next_seq
+        self._next_seq += 1
+        self.in_flight += 1
+        if keys[0].upper() in ('GETINFO', 'GETCONF') and len(keys) > 1:
+            # these can be combined with other commands' keys into
+            # one request (see carml.coalesce)
+            if keys[0].upper() == 'GETINFO':
+                d = self.proto.get_info(*keys[1:])
+            else:
+                d = self.proto.get_conf(*keys[1:])
+            d.addCallback(_format_values, keys[1:])
+        else:
+            d = self.proto.queue_command(' '.join(keys))
+        d.addErrback(self._error)
+        d.addCallback(self._completed, seq)
+        if self.in_flight >= self.max_in_flight and not self._full:
+            self._full = True
+            self.pauseProducing()
+
+    def _error(self, fail):
+        return util.colors.red(fail.getErrorMessage())
+
+    def _completed(self, reply, seq):
+        self.in_flight -= 1
+        self.completed += 1
+        self._replies[seq] = reply
+        while self._next_output in self._replies:
+            print(self._replies.pop(self._next_output))
+            self._next_output += 1
+        if self._full and self.in_flight < self.max_in_flight:
+            self._full = False
+            self.resumeProducing()
+        self._maybe_done()
 
     def connectionLost(self, reason):
-        if len(self.outstanding):
-            self._exit = True
-        else:
+        self._exit = True
+        self._maybe_done()
+
+    def _maybe_done(self):
+        if self._exit and self.in_flight == 0 and not self.all_done.called:
+            elapsed = time.time() - self._started
+            print(
+                "{} commands in {:.2f}s ({:.0f} commands/s)".format(
+                    self.completed, elapsed, self.completed / elapsed if elapsed else 0.0,
+                ),
+                file=sys.stderr,
+            )
             self.all_done.callback(None)
 
 
+def _format_values(values, keys):
+    """
+    Turns a get_info() or get_conf() answer back into (about) what Tor
+    sent, in the order the keys were asked for.
+    """
+    lines = []
+    # Tor answers with its own spelling of the keys
+    spelled = dict((k.lower(), k) for k in values)
+    for key in keys:
+        key = spelled.get(key.lower(), key)
+        value = values.get(key, '')
+        if not isinstance(value, list):
+            value = [value]
+        for v in value:
+            if v is None:
+                lines.append(key)
+            elif '\n' in v:
+                lines.append('{}=\n{}'.format(key, v))
+            else:
+                lines.append('{}={}'.format(key, v))
+    return '\n'.join(lines)
+
+
 def do_cmd(proto, args):
     def _print(res):
         print(res)
@@ -74,13 +142,21 @@ def do_cmd(proto, args):
 # with attributes and "zope.interface.implementsDirectly()"
 # trying out both ways to see what feels better
 @defer.inlineCallbacks
-def run(reactor, cfg, tor, args):
-    if len(args) == 0:
+def run(reactor, cfg, tor, args, filename=None, in_flight=16):
+    if filename is not None:
+        all_done = defer.Deferred()
+        with open(filename, 'rb') as f:
+            receiver = StdioLineReceiver(all_done, tor.protocol, in_flight, interactive=False)
+            stdio.StandardIO(receiver, stdin=f.fileno())
+            yield all_done
+
+    elif len(args) == 0:
         print("(no command to run)")
 
     elif len(args) == 1 and args[0] == '-':
         all_done = defer.Deferred()
-        stdio.StandardIO(StdioLineReceiver(all_done, tor.protocol))
+        receiver = StdioLineReceiver(all_done, tor.protocol, in_flight, interactive=sys.stdin.isatty())
+        stdio.StandardIO(receiver)
         yield all_done
     else:
         yield do_cmd(tor.protocol, args)
@@ -0,0 +1,262 @@
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import json
+import errno
+import socket
+import importlib
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from twisted.internet import defer
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+from carml import util
+from carml import geoip
+from carml import output
+
+
+# the Config attributes a client sends along with each request;
+# everything else comes from the daemon's own configuration.
+CLIENT_CONFIG = ['quiet', 'debug', 'info', 'color', 'no_color', 'timestamps', 'output_format']
+
+# how long (in seconds) a client waits for the daemon's answer before
+# giving up and running the command itself
+CLIENT_TIMEOUT = 30.0
+
+
+def servable(command, args):
+    """
+    Returns True if the daemon can answer this command (i.e. it only
+    reads from the TorState and then exits). ``command`` is the name
+    of the carml_* module and ``args`` are the positional arguments
+    its ``run()`` would get after (reactor, cfg, tor).
+    """
+    if command == 'carml_circ':
+        return bool(args[2])            # --list
+    elif command == 'carml_stream':
+        return bool(args[0])            # --list
+    elif command == 'carml_relay':
+        return bool(args[0] or args[1])  # --list or --info
+    elif command == 'carml_monitor':
+        return bool(args[5])            # --once
+    elif command == 'carml_tmux':
+        return True
+    return False
+
+
+def run_via_daemon(cfg, command, args):
+    """
+    Client side: send a command to a running "carml daemon" over its
+    unix socket, print its output and return the exit-code. Returns
+    None if there is no daemon (or it can't serve this command), in
+    which case the caller should just run the command itself.
+
+    This is deliberately blocking (and doesn't start a reactor) as
+    the whole point is to be fast. A daemon that doesn't answer within
+    CLIENT_TIMEOUT seconds is treated like no daemon at all.
+    """
+    if not servable(command, args):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_TIMEOUT)
+    try:
+        sock.connect(cfg.daemon_socket)
+    except socket.error:
+        sock.close()
+        return None
+
+    request = dict(
+        command=command,
+        args=list(args),
+        config=dict((k, getattr(cfg, k, None)) for k in CLIENT_CONFIG),
+    )
+    try:
+        sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        print("No answer from daemon on {} after {}s; running it here.".format(
+            cfg.daemon_socket, CLIENT_TIMEOUT), file=sys.stderr)
+        return None
+    finally:
+        sock.close()
+
+    try:
+        reply = json.loads(data.decode('utf8'))
+    except ValueError:
+        return None
+    if reply.get('unsupported', False):
+        return None
+    sys.stdout.write(reply['output'])
+    sys.stdout.flush()
+    return reply['code']
+
+
+class _SharedTor(object):
+    """
+    Stands in for the txtorcon.Tor instance passed to a command's
+    run(); all commands do "yield tor.create_state()" so we hand out
+    our already-bootstrapped (and live) TorState instead. Answers
+    from Tor come back with this request's output current.
+    """
+
+    def __init__(self, tor, state, switch, writer):
+        self._tor = tor
+        self._state = state
+        self.protocol = output.SwitchedProxy(tor.protocol, switch, writer)
+
+    @property
+    def proto(self):
+        return self.protocol
+
+    def create_state(self):
+        return defer.succeed(self._state)
+
+    def __getattr__(self, name):
+        return getattr(self._tor, name)
+
+
+class DaemonProtocol(LineReceiver):
+    delimiter = b'\n'
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line.decode('utf8'))
+        except ValueError:
+            self._reply(dict(code=1, output='Error: bad request\n'))
+            return
+        d = self.factory.serve(request)
+        d.addCallbacks(self._reply, self._failed)
+
+    def _failed(self, fail):
+        self._reply(dict(code=1, output='Error: {}\n'.format(fail.getErrorMessage())))
+
+    def _reply(self, reply):
+        self.transport.write(json.dumps(reply).encode('utf8'))
+        self.transport.loseConnection()
+
+
+class DaemonFactory(Factory):
+    protocol = DaemonProtocol
+
+    def __init__(self, reactor, cfg, tor, state):
+        self._reactor = reactor
+        self._cfg = cfg
+        self._tor = tor
+        self._state = state
+        # commands print() their output; each request gets its own
+        # writer, made current around everything done for it (see
+        # output.Switch). The output format is process-wide though,
+        # so still only one request at a time.
+        self._switch = output.Switch(sys.stdout)
+        self._lock = defer.DeferredLock()
+        self.served = 0
+
+    def start(self):
+        sys.stdout = self._switch
+
+    def stop(self):
+        if sys.stdout is self._switch:
+            sys.stdout = self._switch.default
+
+    @defer.inlineCallbacks
+    def serve(self, request):
+        command = request.get('command', '')
+        args = request.get('args', [])
+        if not servable(command, args):
+            defer.returnValue(dict(unsupported=True))
+
+        cfg = copy.copy(self._cfg)
+        for (k, v) in request.get('config', {}).items():
+            if k in CLIENT_CONFIG:
+                setattr(cfg, k, v)
+        module = importlib.import_module('carml.' + command)
+
+        yield self._lock.acquire()
+        writer = StringIO()
+        tor = _SharedTor(self._tor, self._state, self._switch, writer)
+        reactor = output.SwitchedReactor(self._reactor, self._switch, writer)
+        real_format = util.output_format
+        util.output_format = cfg.output_format or real_format
+        code = 0
+        try:
+            if cfg.info:
+                info = yield tor.protocol.get_info('version', 'status/version/current')
+                print(
+                    'Connected to a Tor version "{version}" (status: '
+                    '{status/version/current}).\n'.format(**info),
+                    file=writer,
+                )
+            d = self._switch.call(writer, defer.maybeDeferred, module.run, reactor, cfg, tor, *args)
+            yield self._switch.deferred(writer, d)
+        except Exception as e:
+            print("Error: {}".format(e), file=writer)
+            code = 1
+        finally:
+            util.output_format = real_format
+            self._lock.release()
+        self.served += 1
+        defer.returnValue(dict(code=code, output=writer.getvalue()))
+
+
+def _remove_stale_socket(socket_path):
+    """
+    Removes the socket a previous daemon left behind, if nothing is
+    listening on it any more; raises RuntimeError if something is.
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error as e:
+        if e.errno == errno.ENOENT:
+            return
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.unlink(socket_path)
+    else:
+        raise RuntimeError("A daemon is already running on {}".format(socket_path))
+    finally:
+        probe.close()
+
+
+@defer.inlineCallbacks
+def run(reactor, cfg, tor, socket_path):
+    _remove_stale_socket(socket_path)
+    state = yield tor.create_state()
+    yield util.invalidate_on_new_consensus(state.protocol)
+    # we only pay for this once, so "tmux" can use it too
+    geoip.shared()
+
+    factory = DaemonFactory(reactor, cfg, tor, state)
+    ep = serverFromString(reactor, 'unix:{}:mode=600'.format(socket_path.replace(':', r'\:')))
+    port = yield ep.listen(factory)
+    factory.start()
+    print("Serving {} routers, {} circuits on {}".format(
+        len(state.routers), len(state.circuits), util.colors.bold(socket_path)))
+
+    def _cleanup():
+        factory.stop()
+        print("Served {} requests.".format(factory.served))
+        return port.stopListening()
+    reactor.addSystemEventTrigger('before', 'shutdown', _cleanup)
+
+    all_done = defer.Deferred()
+
+    def _disconnected(arg):
+        print("Tor disconnected.")
+        all_done.callback(None)
+    state.protocol.on_disconnect.addBoth(_disconnected)
+    yield all_done
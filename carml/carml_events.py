@@ -12,6 +12,8 @@ from twisted.internet import defer, reactor
 import txtorcon
 
 from carml.interface import ICarmlCommand
+from carml import util
+from carml import timing
 from carml.util import dump_circuits
 from carml.util import format_net_location
 from carml.util import nice_router_name
@@ -21,7 +23,7 @@ import click
 
 
 @defer.inlineCallbacks
-def run(reactor, cfg, tor, list_events, once, show_event, count, events):
+def run(reactor, cfg, tor, list_events, once, show_event, count, events, record=None, filter_expr=None):
     all_events = yield tor.protocol.get_info('events/names')
     all_events = all_events['events/names']
     if list_events:
@@ -29,6 +31,15 @@ def run(reactor, cfg, tor, list_events, once, show_event, count, events):
             click.echo(e)
         return
 
+    flt = None
+    if filter_expr:
+        from carml import filters
+        flt = filters.Filter(filter_expr, ['raw'])
+
+    def _matching(evt, listener, msg):
+        if flt.matches('raw', evt, msg):
+            listener(msg)
+
     all_done = defer.Deferred()
     counter = [count]
     if once:
@@ -38,26 +49,41 @@ def run(reactor, cfg, tor, list_events, once, show_event, count, events):
         if counter[0] is not None:
             counter[0] -= 1
             if counter[0] >= 0:
-                print(msg)
-            elif all_done:
+                if util.output_format == 'jsonl':
+                    util.json_record('event', event=evt, data=msg)
+                else:
+                    print(msg)
+            elif not all_done.called:
                 all_done.callback(None)
-                all_done = None
+        elif util.output_format == 'jsonl':
+            util.json_record('event', event=evt, data=msg)
         elif evt:
             print("{}: {}".format(evt, msg))
         else:
             ts = time.asctime()
             print("{} {}".format(ts, msg))
 
+    recorder = None
+    if record:
+        from carml import trace
+        recorder = trace.TraceWriter(record)
+        reactor.addSystemEventTrigger('before', 'shutdown', recorder.close)
+        yield recorder.snapshot(tor.protocol)
+
     for e in events:
         e = e.upper()
         if e not in all_events:
             print("Invalid event:", e)
             return
-        if show_event:
+        if recorder is not None:
+            tor.protocol.add_event_listener(e, recorder.listener(e))
+        if show_event or util.output_format == 'jsonl':
             listener = functools.partial(_got_event, e)
         else:
             listener = functools.partial(_got_event, None)
-        tor.protocol.add_event_listener(e, listener)
+        if flt is not None:
+            listener = functools.partial(_matching, e, listener)
+        tor.protocol.add_event_listener(e, timing.timed('events._got_event', listener))
 
     # might be forever if there's no count
     yield all_done
@@ -0,0 +1,447 @@
+'''
+A stand-in for Tor's control port, for benchmarking and testing carml
+(or anything else using txtorcon) without a real Tor.
+
+It speaks just enough of the control protocol: PROTOCOLINFO,
+AUTHENTICATE (anything is accepted), GETINFO for the keys txtorcon and
+carml use, GETCONF/SETCONF, SETEVENTS and a few more. It invents a
+consensus of however many relays you like, plus circuits and streams,
+and then emits CIRC, STREAM, ADDRMAP, BW and STREAM_BW events at the
+configured rates.
+'''
+
+from __future__ import print_function
+
+import base64
+import random
+import datetime
+import collections
+
+from twisted.internet import defer, task
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+from carml import util
+
+VERSION = '0.3.0.10 (fake)'
+
+EVENT_NAMES = (
+    'CIRC STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR NEWDESC ADDRMAP '
+    'AUTHDIR_NEWDESCS DESCCHANGED STATUS_GENERAL STATUS_CLIENT '
+    'STATUS_SERVER GUARD NS STREAM_BW CLIENTS_SEEN NEWCONSENSUS '
+    'BUILDTIMEOUT_SET SIGNAL CONF_CHANGED CIRC_MINOR TRANSPORT_LAUNCHED '
+    'HS_DESC HS_DESC_CONTENT'
+)
+
+SIGNAL_NAMES = 'RELOAD SHUTDOWN DUMP DEBUG HALT HUP INT USR1 USR2 TERM NEWNYM CLEARDNSCACHE HEARTBEAT'
+
+CONFIG = collections.OrderedDict([
+    ('SocksPort', ('LineList', '9050')),
+    ('ControlPort', ('LineList', '9051')),
+    ('ORPort', ('LineList', '0')),
+    ('HidServAuth', ('LineList', None)),
+    ('HiddenServiceOptions', ('Virtual', None)),
+    ('DataDirectory', ('Filename', '/var/lib/tor')),
+])
+
+PURPOSES = ['GENERAL'] * 6 + ['HS_CLIENT_REND', 'HS_CLIENT_INTRO', 'HS_SERVICE_INTRO', 'HS_SERVICE_REND']
+TARGETS = [
+    ('www.torproject.org', 443),
+    ('check.torproject.org', 443),
+    ('example.com', 80),
+    ('meejah.ca', 443),
+    ('expyuzz4wqqyqhjn.onion', 80),
+    ('github.com', 22),
+]
+
+# how often (seconds) we run the event generator
+TICK = 0.1
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+class FakeRouter(object):
+    def __init__(self, rand, index):
+        self.name = 'fake{}'.format(index)
+        identity = bytes(bytearray(rand.getrandbits(8) for _ in range(20)))
+        digest = bytes(bytearray(rand.getrandbits(8) for _ in range(20)))
+        self.id_hex = '$' + base64.b16encode(identity).decode('ascii')
+        self.ip = '10.{}.{}.{}'.format(index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff)
+        self.ns = (
+            'r {name} {identity} {digest} 2017-01-01 00:00:00 {ip} 9001 0\n'
+            's Fast Guard Running Stable Valid\n'
+            'w Bandwidth={bw}\n'
+            'p reject 1-65535'.format(
+                name=self.name,
+                identity=base64.b64encode(identity).decode('ascii').rstrip('='),
+                digest=base64.b64encode(digest).decode('ascii').rstrip('='),
+                ip=self.ip,
+                bw=rand.randint(20, 50000),
+            )
+        )
+
+    def long_name(self):
+        return '{}~{}'.format(self.id_hex, self.name)
+
+
+class FakeCircuit(object):
+    def __init__(self, cid, path, purpose):
+        self.id = cid
+        self.path = path
+        self.purpose = purpose
+        self.state = 'LAUNCHED'
+        self.created = _now()
+
+    def status(self):
+        path = ','.join(r.long_name() for r in self.path)
+        if self.state == 'LAUNCHED':
+            path = ''
+        return ' '.join(x for x in [
+            str(self.id), self.state, path,
+            'BUILD_FLAGS=NEED_CAPACITY',
+            'PURPOSE={}'.format(self.purpose),
+            'TIME_CREATED={}'.format(self.created),
+        ] if x)
+
+
+class FakeStream(object):
+    def __init__(self, sid, host, port, source_port):
+        self.id = sid
+        self.host = host
+        self.port = port
+        self.source_port = source_port
+        self.state = 'NEW'
+        self.circuit = None
+
+    def status(self):
+        return '{} {} {} {}:{}'.format(
+            self.id, self.state, self.circuit.id if self.circuit else 0,
+            self.host, self.port,
+        )
+
+
+class FakeTor(object):
+    '''
+    The pretend Tor: its relays, circuits and streams, and what
+    events it sends to which connections.
+    '''
+
+    def __init__(self, reactor, relays, circuits, streams, seed=0):
+        self._reactor = reactor
+        self._rand = random.Random(seed)
+        self.routers = [FakeRouter(self._rand, i) for i in range(relays)]
+        self.target_circuits = circuits
+        self.target_streams = streams
+        self.circuits = collections.OrderedDict()
+        self.streams = collections.OrderedDict()
+        self.connections = set()
+        self._next_circuit = 1
+        self._next_stream = 1
+        self._pending = []      # launched, not yet built
+        self._ns_all = None
+
+        for _ in range(circuits):
+            self._new_circuit().state = 'BUILT'
+        for _ in range(streams):
+            stream = self._new_stream()
+            stream.state = 'SUCCEEDED'
+            stream.circuit = self._random_built_circuit()
+
+        self.events_sent = 0
+        self._credit = collections.defaultdict(float)
+        self._rates = {}
+
+    # the "consensus" and GETINFO answers
+
+    def ns_all(self):
+        if self._ns_all is None:
+            self._ns_all = '\n'.join(r.ns for r in self.routers)
+        return self._ns_all
+
+    def getinfo(self, key):
+        '''
+        Returns the value for a GETINFO key, or None if we don't know
+        it.
+        '''
+        if key == 'ns/all':
+            return self.ns_all()
+        elif key == 'circuit-status':
+            return '\n'.join(c.status() for c in self.circuits.values())
+        elif key == 'stream-status':
+            return '\n'.join(s.status() for s in self.streams.values() if s.circuit)
+        elif key == 'entry-guards':
+            return '\n'.join('{} up'.format(r.long_name()) for r in self.routers[:3])
+        elif key.startswith('ip-to-country/'):
+            return 'zz'
+        return {
+            'version': VERSION,
+            'status/version/current': 'recommended',
+            'dormant': '0',
+            'events/names': EVENT_NAMES,
+            'signal/names': SIGNAL_NAMES,
+            'features/names': 'VERBOSE_NAMES EXTENDED_EVENTS',
+            'address-mappings/all': '',
+            'net/listeners/socks': '"127.0.0.1:9050"',
+            'traffic/read': '0',
+            'traffic/written': '0',
+            'config/names': '\n'.join('{} {}'.format(k, v[0]) for (k, v) in CONFIG.items()),
+            'info/names': 'version -- The current version of Tor.',
+        }.get(key, None)
+
+    # making things up
+
+    def _new_circuit(self):
+        hops = 3 if len(self.routers) >= 3 else len(self.routers)
+        circ = FakeCircuit(
+            self._next_circuit,
+            self._rand.sample(self.routers, hops),
+            self._rand.choice(PURPOSES),
+        )
+        self._next_circuit += 1
+        self.circuits[circ.id] = circ
+        return circ
+
+    def _new_stream(self):
+        host, port = self._rand.choice(TARGETS)
+        stream = FakeStream(self._next_stream, host, port, self._rand.randint(1024, 65535))
+        self._next_stream += 1
+        self.streams[stream.id] = stream
+        return stream
+
+    def _random_built_circuit(self):
+        built = [c for c in self.circuits.values() if c.state == 'BUILT']
+        if not built:
+            return None
+        return self._rand.choice(built)
+
+    # sending events
+
+    def emit(self, event, payload):
+        line = '650 {} {}'.format(event, payload)
+        for proto in self.connections:
+            if event in proto.events:
+                proto.send(line)
+                self.events_sent += 1
+
+    def start(self, circ_rate, stream_rate, bw_rate):
+        '''
+        Start producing events; rates are per-second.
+        '''
+        self._rates = dict(circ=circ_rate, stream=stream_rate, bw=bw_rate)
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = self._reactor
+        return self._loop.start(TICK, now=False)
+
+    def _tick(self):
+        # anything launched last time gets built now (or fails)
+        for circ in self._pending:
+            if circ.id not in self.circuits:
+                continue
+            if self._rand.random() < 0.05:
+                circ.state = 'FAILED'
+                self.emit('CIRC', circ.status() + ' REASON=TIMEOUT')
+                circ.state = 'CLOSED'
+                self.emit('CIRC', circ.status() + ' REASON=TIMEOUT')
+                del self.circuits[circ.id]
+            else:
+                circ.state = 'BUILT'
+                self.emit('CIRC', circ.status())
+        self._pending = []
+
+        for what in ['circ', 'stream', 'bw']:
+            self._credit[what] += self._rates[what] * TICK
+            while self._credit[what] >= 1.0:
+                self._credit[what] -= 1.0
+                getattr(self, '_make_' + what)()
+
+    def _make_circ(self):
+        circ = self._new_circuit()
+        self.emit('CIRC', circ.status())
+        self._pending.append(circ)
+        while len(self.circuits) > self.target_circuits + len(self._pending):
+            old = next(iter(self.circuits.values()))
+            old.state = 'CLOSED'
+            self.emit('CIRC', old.status() + ' REASON=FINISHED')
+            del self.circuits[old.id]
+            for stream in [s for s in self.streams.values() if s.circuit is old]:
+                self._close_stream(stream)
+
+    def _make_stream(self):
+        circ = self._random_built_circuit()
+        if circ is None:
+            return
+        stream = self._new_stream()
+        source = 'SOURCE_ADDR=127.0.0.1:{} PURPOSE=USER'.format(stream.source_port)
+        self.emit('STREAM', stream.status() + ' ' + source)
+        self.emit('ADDRMAP', '{} 10.0.0.{} "2038-01-01 00:00:00" CACHED="NO"'.format(
+            stream.host, self._rand.randint(1, 254)))
+        stream.state = 'SENTCONNECT'
+        stream.circuit = circ
+        self.emit('STREAM', stream.status())
+        stream.state = 'SUCCEEDED'
+        self.emit('STREAM', stream.status())
+        while len(self.streams) > self.target_streams:
+            self._close_stream(next(iter(self.streams.values())))
+
+    def _close_stream(self, stream):
+        stream.state = 'CLOSED'
+        self.emit('STREAM', stream.status() + ' REASON=DONE')
+        del self.streams[stream.id]
+
+    def _make_bw(self):
+        self.emit('BW', '{} {}'.format(self._rand.randint(0, 500000), self._rand.randint(0, 100000)))
+        streams = list(self.streams.values())
+        for stream in self._rand.sample(streams, min(10, len(streams))):
+            self.emit('STREAM_BW', '{} {} {}'.format(
+                stream.id, self._rand.randint(0, 5000), self._rand.randint(0, 50000)))
+
+
+class FakeTorControlProtocol(LineReceiver):
+    delimiter = b'\r\n'
+    # GETINFO ns/all with lots of relays is big
+    MAX_LENGTH = 1024 * 1024
+
+    def connectionMade(self):
+        self.events = set()
+        self.authenticated = False
+        self.factory.tor.connections.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.tor.connections.discard(self)
+
+    def send(self, line):
+        self.sendLine(line.encode('utf8'))
+
+    def lineReceived(self, line):
+        line = line.decode('utf8')
+        if not line.strip():
+            return
+        parts = line.split()
+        command = parts[0].upper()
+        args = parts[1:]
+
+        if command == 'PROTOCOLINFO':
+            self.send('250-PROTOCOLINFO 1')
+            self.send('250-AUTH METHODS=NULL')
+            self.send('250-VERSION Tor="{}"'.format(VERSION.split()[0]))
+            self.send('250 OK')
+            return
+        if command == 'AUTHENTICATE':
+            self.authenticated = True
+            self.send('250 OK')
+            return
+        if command == 'QUIT':
+            self.send('250 closing connection')
+            self.transport.loseConnection()
+            return
+        if not self.authenticated:
+            self.send('514 Authentication required.')
+            self.transport.loseConnection()
+            return
+
+        handler = getattr(self, 'do_' + command, None)
+        if handler is None:
+            self.send('510 Unrecognized command "{}"'.format(parts[0]))
+        else:
+            handler(args)
+
+    def do_GETINFO(self, keys):
+        answers = []
+        for key in keys:
+            value = self.factory.tor.getinfo(key)
+            if value is None:
+                self.send('552 Unrecognized key "{}"'.format(key))
+                return
+            answers.append((key, value))
+        for (key, value) in answers:
+            if '\n' in value or (value and key in ('ns/all', 'circuit-status', 'stream-status')):
+                self.send('250+{}='.format(key))
+                for line in value.split('\n'):
+                    if line.startswith('.'):
+                        line = '.' + line
+                    self.send(line)
+                self.send('.')
+            else:
+                self.send('250-{}={}'.format(key, value))
+        self.send('250 OK')
+
+    def do_GETCONF(self, keys):
+        lines = []
+        for key in keys:
+            if key not in CONFIG:
+                self.send('552 Unrecognized configuration key "{}"'.format(key))
+                return
+            value = CONFIG[key][1]
+            lines.append(key if value is None else '{}={}'.format(key, value))
+        for line in lines[:-1]:
+            self.send('250-' + line)
+        self.send('250 ' + (lines[-1] if lines else 'OK'))
+
+    def do_SETEVENTS(self, events):
+        self.events = set(e.upper() for e in events if e.upper() != 'EXTENDED')
+        self.send('250 OK')
+
+    def do_SIGNAL(self, args):
+        self.send('250 OK')
+        if args:
+            self.factory.tor.emit('SIGNAL', args[0].upper())
+
+    def do_EXTENDCIRCUIT(self, args):
+        tor = self.factory.tor
+        circ = tor._new_circuit()
+        self.send('250 EXTENDED {}'.format(circ.id))
+        tor.emit('CIRC', circ.status())
+        tor._pending.append(circ)
+
+    def do_CLOSECIRCUIT(self, args):
+        tor = self.factory.tor
+        try:
+            circ = tor.circuits.pop(int(args[0]))
+        except (IndexError, ValueError, KeyError):
+            self.send('552 Unknown circuit')
+            return
+        self.send('250 OK')
+        circ.state = 'CLOSED'
+        tor.emit('CIRC', circ.status() + ' REASON=REQUESTED')
+
+    def do_CLOSESTREAM(self, args):
+        tor = self.factory.tor
+        try:
+            stream = tor.streams[int(args[0])]
+        except (IndexError, ValueError, KeyError):
+            self.send('552 Unknown stream')
+            return
+        self.send('250 OK')
+        tor._close_stream(stream)
+
+    def _ok(self, args):
+        self.send('250 OK')
+
+    do_SETCONF = do_RESETCONF = do_SAVECONF = do_USEFEATURE = _ok
+    do_ATTACHSTREAM = do_TAKEOWNERSHIP = do_MAPADDRESS = _ok
+
+
+class FakeTorFactory(Factory):
+    protocol = FakeTorControlProtocol
+
+    def __init__(self, tor):
+        self.tor = tor
+
+
+@defer.inlineCallbacks
+def run(reactor, cfg, listen, relays, circuits, streams, circ_rate, stream_rate, bw_rate, seed):
+    tor = FakeTor(reactor, relays, circuits, streams, seed=seed)
+    ep = serverFromString(reactor, str(listen))
+    port = yield ep.listen(FakeTorFactory(tor))
+    print("Fake Tor with {} relays, {} circuits, {} streams listening on {}".format(
+        relays, circuits, streams, util.colors.bold(str(port.getHost()))))
+
+    def _report():
+        print("Sent {} events.".format(tor.events_sent))
+    reactor.addSystemEventTrigger('before', 'shutdown', _report)
+
+    # runs forever
+    yield tor.start(circ_rate, stream_rate, bw_rate)
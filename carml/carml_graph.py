@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import os
 import sys
+import time
 import functools
 
 import zope.interface
@@ -14,21 +15,30 @@ import txtorcon
 from twisted.internet.defer import inlineCallbacks, Deferred
 
 from carml.interface import ICarmlCommand
+from carml import util
+from carml import timing
+from carml import geoip
+from carml import rrd
 from carml.util import dump_circuits, format_net_location, nice_router_name, colors, wrap
 
 LOG_LEVELS = ["DEBUG", "INFO", "NOTICE", "WARN", "ERR"]
 
+#: how many buckets "graph --history" draws
+HISTORY_ROWS = 60
+
 
 class BandwidthTracker(object):
     '''
     This tracks bandwidth usage.
     '''
 
-    def __init__(self, maxscale, state):
+    def __init__(self, maxscale, state, store=None):
         #: a list of tuples
         self._bandwidth = []
         self._max = float(maxscale)
         self._state = state
+        #: an rrd.RoundRobinStore to record to, or None
+        self._store = store
 
     def circuits(self):
         return len(self._state.circuits)
@@ -37,15 +47,25 @@ class BandwidthTracker(object):
         return len(self._state.streams)
 
     def on_bandwidth(self, s):
-        r, w = map(int, s.split())
+        r, w = map(int, s.split()[:2])
         self._bandwidth.append((r, w))
+        if self._store is not None:
+            self._store.add(time.time(), read=r, written=w)
+        if util.output_format == 'jsonl':
+            util.json_record(
+                'bandwidth', read=r, written=w,
+                streams=self.streams(), circuits=self.circuits(),
+            )
+            return
         try:
             self.draw_bars()
         except Exception as e:
             print("bad {}".format(e))
 
     def on_stream_bandwidth(self, s):
-        pass
+        if self._store is not None:
+            sid, w, r = map(int, s.split()[:3])
+            self._store.add(time.time(), stream_read=r, stream_written=w)
 
     def draw_bars(self):
         up = min(1.0, self._bandwidth[-1][0] / self._max)
@@ -64,7 +84,7 @@ class BandwidthTracker(object):
         for stream in self._state.streams.values():
             # ...there's a window during which it may not be attached yet
             if stream.circuit:
-                circpath = '>'.join(map(lambda r: r.location.countrycode, stream.circuit.path))
+                circpath = '>'.join(map(lambda r: geoip.router_country(r) or '??', stream.circuit.path))
                 streams += ' ' + circpath
         if len(streams) > 24:
             streams = streams[:21] + '...'
@@ -101,12 +121,57 @@ def right_bar(percent, width):
     return colors.red('+' * (blocks), bg='red') + (colors.red(rpart)) + (' ' * (width - blocks))
 
 
+def show_history(fname, resolution, max):
+    '''
+    Draws (or, with --format jsonl, dumps) recorded bandwidth; this
+    needs no Tor.
+    '''
+    store = rrd.RoundRobinStore(fname, readonly=True)
+    try:
+        buckets = store.buckets(rrd.RESOLUTIONS[resolution])
+    finally:
+        store.close()
+
+    if util.output_format == 'jsonl':
+        for (start, step, means, maxes) in buckets:
+            record = dict(start=start, duration=step)
+            for (i, column) in enumerate(rrd.COLUMNS):
+                record[column] = means[i]
+                record[column + '_max'] = maxes[i]
+            util.json_record('bandwidth_history', **record)
+        return
+
+    if not buckets:
+        print('No bandwidth recorded in "{}" yet.'.format(fname))
+        return
+    fmt = '%Y-%m-%d %H:%M:%S' if resolution == 'second' else '%Y-%m-%d %H:%M'
+    scale = float(max)
+    for (start, step, means, maxes) in buckets[-HISTORY_ROWS:]:
+        read, written = means[:2]
+        status = ' ' + colors.green('%.2f' % (read / 1024.0))
+        status += '/'
+        status += colors.red('%.2f' % (written / 1024.0))
+        status += ' KiB/s'
+        if step > 1:
+            status += ' (busiest second %.2f/%.2f)' % (maxes[0] / 1024.0, maxes[1] / 1024.0)
+        bars = left_bar(min(1.0, read / scale), 20) + unichr(0x21f5) + right_bar(min(1.0, written / scale), 20)
+        print(time.strftime(fmt, time.localtime(start)) + ' ' + bars + status)
+
+
 @inlineCallbacks
-def run(reactor, cfg, tor, max):
+def run(reactor, cfg, tor, max, store=None):
     state = yield tor.create_state()
-    bwtracker = BandwidthTracker(max, state)
-    yield tor.protocol.add_event_listener('BW', bwtracker.on_bandwidth)
-    yield tor.protocol.add_event_listener('STREAM_BW', bwtracker.on_stream_bandwidth)
+    yield util.invalidate_on_new_consensus(state.protocol)
+    if store is not None:
+        store = rrd.RoundRobinStore(store)
+        reactor.addSystemEventTrigger('before', 'shutdown', store.close)
+    bwtracker = BandwidthTracker(max, state, store)
+    yield tor.protocol.add_event_listener(
+        'BW', timing.timed('BandwidthTracker.on_bandwidth', bwtracker.on_bandwidth),
+    )
+    yield tor.protocol.add_event_listener(
+        'STREAM_BW', timing.timed('BandwidthTracker.on_stream_bandwidth', bwtracker.on_stream_bandwidth),
+    )
 
     # infinite loop
     yield Deferred()
@@ -4,15 +4,23 @@ from __future__ import print_function
 import os
 import sys
 import functools
+from collections import Counter
 
 import zope.interface
 from twisted.python import usage, log, failure
-from twisted.internet import defer, reactor, error
+from twisted.internet import defer, reactor, error, task
 import humanize
 
 import txtorcon
 
 from carml.interface import ICarmlCommand
+from carml import util
+from carml import timing
+from carml import procindex
+from carml import metrics
+from carml import buildtimes
+from carml import filters
+from carml import geoip
 from carml.util import dump_circuits, format_net_location, nice_router_name, colors, wrap
 
 LOG_LEVELS = ["DEBUG", "INFO", "NOTICE", "WARN", "ERR"]
@@ -31,7 +39,7 @@ def string_for_stream(state, stream):
     circ = ''
     if stream.circuit:
         circ = ' via circuit %d' % stream.circuit.id
-    proc = txtorcon.util.process_from_address(stream.source_addr, stream.source_port, state)
+    proc = procindex.lookup(stream.source_addr, stream.source_port)
     if proc:
         proc = ' from process "%s"' % (colors.bold(os.path.realpath('/proc/%d/exe' % proc)), )
 
@@ -53,13 +61,20 @@ class StreamLogger(txtorcon.StreamListenerMixin):
         self.verbose = verbose
 
     def stream_attach(self, stream, circuit):
+        if util.output_format == 'jsonl':
+            util.json_record('stream', event='attach', **util.stream_record(stream))
+            return
         print(string_for_stream(self.state, stream))
         if self.verbose:
             m = "  " + '->'.join(map(lambda x: nice_router_name(x), circuit.path))
-            m += ' (%s)' % ' '.join(map(lambda r: str(r.location.countrycode), circuit.path))
+            m += ' (%s)' % ' '.join(map(lambda r: str(geoip.router_country(r)), circuit.path))
             print(m)
 
     def stream_failed(self, stream, remote_reason='', **kw):
+        if util.output_format == 'jsonl':
+            util.json_record('stream', event='failed', remote_reason=remote_reason,
+                             **util.stream_record(stream))
+            return
         print('Stream %d %s because "%s"' % (stream.id, colors.red('failed'),
                                              colors.red(remote_reason)))
 
@@ -78,18 +93,29 @@ def flags(d):
     return r
 
 
+def _circuit_record(event, circuit, kw=None):
+    reasons = dict((k.lower(), v) for (k, v) in (kw or {}).items() if k.upper() == k)
+    util.json_record('circuit', event=event, **dict(util.circuit_record(circuit), **reasons))
+
+
 class CircuitLogger(txtorcon.CircuitListenerMixin):
     def __init__(self, state, show_flags=False):
         self.state = state
         self.show_flags = show_flags
 
     def circuit_launched(self, circuit):
+        if util.output_format == 'jsonl':
+            return _circuit_record('launched', circuit)
         print(string_for_circuit(self.state, circuit))
 
     def circuit_extend(self, circuit, router):
+        if util.output_format == 'jsonl':
+            return _circuit_record('extend', circuit)
         print(string_for_circuit(self.state, circuit))
 
     def circuit_built(self, circuit):
+        if util.output_format == 'jsonl':
+            return _circuit_record('built', circuit)
         print(string_for_circuit(self.state, circuit))
         if self.show_flags:
             flagslist = ['%s=%s' % x for x in circuit.flags.items()]
@@ -97,9 +123,13 @@ class CircuitLogger(txtorcon.CircuitListenerMixin):
             print(colors.cyan('    Flags:'), flags.lstrip())
 
     def circuit_failed(self, circuit, **kw):
+        if util.output_format == 'jsonl':
+            return _circuit_record('failed', circuit, kw)
         print('Circuit %d failed (%s).' % (circuit.id, flags(kw)))
 
     def circuit_closed(self, circuit, **kw):
+        if util.output_format == 'jsonl':
+            return _circuit_record('closed', circuit, kw)
         print('Circuit %d %s lasted %s (%s).' % (circuit.id,
                                                  colors.red('closed'),
                                                  humanize.time.naturaldelta(circuit.age()),
@@ -110,25 +140,156 @@ class AddressLogger(object):
     zope.interface.implements(txtorcon.interface.IAddrListener)
 
     def addrmap_added(self, addr):
+        if util.output_format == 'jsonl':
+            util.json_record('addrmap', event='added', name=addr.name, ip=addr.ip)
+            return
         print('New address mapping: "%s" -> "%s".' % (addr.name, addr.ip))
 
     def addrmap_expired(self, name):
+        if util.output_format == 'jsonl':
+            util.json_record('addrmap', event='expired', name=name)
+            return
         print('Address mapping for "%s" expired.' % name)
 
 
+def _counts(counter):
+    """
+    "443:15, 80:5" from a Counter (most common first)
+    """
+    return ', '.join('%s:%d' % kv for kv in sorted(counter.items(), key=lambda kv: (-kv[1], str(kv[0]))))
+
+
+class Summary(txtorcon.CircuitListenerMixin, txtorcon.StreamListenerMixin):
+    """
+    Instead of a line per event, counts circuit, stream and address
+    events and print()s one summary every interval seconds.
+    """
+    zope.interface.implements(txtorcon.interface.IAddrListener)
+
+    def __init__(self, interval, build_times=None):
+        self.interval = interval
+        self.build_times = build_times
+        self._reset()
+
+    def _reset(self):
+        self.circuits = Counter()          # launched, built, failed, closed
+        self.circuits_failed = Counter()   # by reason
+        self.circuits_closed = Counter()   # by reason
+        self.streams_attached = Counter()  # by target port
+        self.streams_failed = Counter()    # by target port
+        self.addrmap = Counter()           # added, expired
+
+    def circuit_launched(self, circuit):
+        self.circuits['launched'] += 1
+
+    def circuit_built(self, circuit):
+        self.circuits['built'] += 1
+
+    def circuit_failed(self, circuit, **kw):
+        self.circuits['failed'] += 1
+        self.circuits_failed[kw.get('REASON', 'NONE')] += 1
+
+    def circuit_closed(self, circuit, **kw):
+        self.circuits['closed'] += 1
+        self.circuits_closed[kw.get('REASON', 'NONE')] += 1
+
+    def stream_attach(self, stream, circuit):
+        self.streams_attached[stream.target_port] += 1
+
+    def stream_failed(self, stream, **kw):
+        self.streams_failed[stream.target_port] += 1
+
+    def addrmap_added(self, addr):
+        self.addrmap['added'] += 1
+
+    def addrmap_expired(self, name):
+        self.addrmap['expired'] += 1
+
+    def emit(self):
+        built = None
+        if self.build_times is not None:
+            built = self.build_times.take_interval()
+        if util.output_format == 'jsonl':
+            extra = dict()
+            if built is not None:
+                extra['build_times'] = built.record()
+            util.json_record(
+                'summary',
+                interval=self.interval,
+                circuits=dict(self.circuits),
+                circuits_failed=dict(self.circuits_failed),
+                circuits_closed=dict(self.circuits_closed),
+                streams_attached=dict((str(k), v) for (k, v) in self.streams_attached.items()),
+                streams_failed=dict((str(k), v) for (k, v) in self.streams_failed.items()),
+                addrmap=dict(self.addrmap),
+                **extra
+            )
+        else:
+            c = self.circuits
+            msg = 'circuits: %d launched, %d built, %s failed' % (
+                c['launched'], c['built'], colors.red(str(c['failed'])) if c['failed'] else '0')
+            if c['failed']:
+                msg += ' (%s)' % _counts(self.circuits_failed)
+            msg += ', %d closed' % c['closed']
+            if c['closed']:
+                msg += ' (%s)' % _counts(self.circuits_closed)
+            attached = sum(self.streams_attached.values())
+            failed = sum(self.streams_failed.values())
+            msg += '; streams: %d attached' % attached
+            if attached:
+                msg += ' (%s)' % _counts(self.streams_attached)
+            msg += ', %s failed' % (colors.red(str(failed)) if failed else '0')
+            if failed:
+                msg += ' (%s)' % _counts(self.streams_failed)
+            msg += '; addrmap: %d added, %d expired' % (self.addrmap['added'], self.addrmap['expired'])
+            if built is not None and built.built:
+                msg += '; build times: ' + ' '.join(
+                    'p%d %.2fs' % (pct, built.sketch.quantile(pct)) for pct in buildtimes.QUANTILES
+                )
+            print('%s %s' % (colors.cyan('[%gs]' % self.interval), msg))
+        self._reset()
+
+
+def _filtered_log(flt, level, listener, msg):
+    if flt.matches('log', level, msg):
+        listener(msg)
+
+
 def tor_log(level, msg):
+    if util.output_format == 'jsonl':
+        util.json_record('log', level=level, message=msg)
+        return
     print('%s: %s' % (level, msg))
 
 
 @defer.inlineCallbacks
-def run(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level):
+def run(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level, summary=None,
+        metrics_listen=None, filter_expr=None):
     state = yield tor.create_state()
+    flt = None
+    if filter_expr:
+        flt = filters.Filter(filter_expr, ['circuit', 'stream', 'addrmap', 'log'])
+    if once:
+        summary = None
+    if not once:
+        yield util.invalidate_on_new_consensus(state.protocol)
+    build_times = None
+    if not once and not no_circuits:
+        # a replay has its own idea of the time
+        clock = getattr(tor, 'seconds', reactor.seconds)
+        build_times = buildtimes.BuildTimes(clock=clock, entry_guards=state.entry_guards)
+    summarizer = Summary(summary, build_times) if summary else None
+    if summarizer is not None:
+        filters.filtered_listener(flt, summarizer)
 
     follow_string = None
     if log_level and not once:
         follow_string = 'Logging ('
         for event in log_level:  # LOG_LEVELS:
-            state.protocol.add_event_listener(event, functools.partial(tor_log, event))
+            listener = functools.partial(tor_log, event)
+            if flt is not None:
+                listener = functools.partial(_filtered_log, flt, event, listener)
+            state.protocol.add_event_listener(event, timing.timed('tor_log', listener))
             follow_string += event + ', '
             if event == log_level:
                 break
@@ -138,13 +299,23 @@ def run(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams,
             follow_string += ' and Stream'
         else:
             follow_string = 'Stream'
-        if len(state.streams):
+        streams = state.streams.values()
+        if flt is not None:
+            streams = [s for s in streams if flt.matches('stream', 'current', s)]
+        if util.output_format == 'jsonl':
+            for stream in streams:
+                util.json_record('stream', event='current', **util.stream_record(stream))
+        elif len(streams):
             print("Current streams:")
-            for stream in state.streams.values():
+            for stream in streams:
                 print('  ' + string_for_stream(state, stream))
         else:
             print("No streams.")
-        state.add_stream_listener(StreamLogger(state, verbose))
+        if summarizer is None:
+            logger = filters.filtered_listener(flt, StreamLogger(state, verbose))
+            state.add_stream_listener(timing.timed_listener('StreamLogger', logger))
+        else:
+            state.add_stream_listener(summarizer)
 
     if not no_circuits:
         if follow_string:
@@ -152,15 +323,33 @@ def run(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams,
         else:
             follow_string = 'Circuit'
 
-        if len(state.circuits):
+        circuits = state.circuits.values()
+        if flt is not None:
+            circuits = [c for c in circuits if flt.matches('circuit', 'current', c)]
+        if util.output_format == 'jsonl':
+            dump_circuits(state, verbose=verbose, circuits=circuits)
+        elif len(circuits):
             print("Current circuits:")
-            dump_circuits(state, verbose=verbose)
+            dump_circuits(state, verbose=verbose, circuits=circuits)
         else:
             print("No circuits.")
-        state.add_circuit_listener(CircuitLogger(state, show_flags=verbose))
+        if summarizer is None:
+            logger = filters.filtered_listener(flt, CircuitLogger(state, show_flags=verbose))
+            state.add_circuit_listener(timing.timed_listener('CircuitLogger', logger))
+        else:
+            state.add_circuit_listener(summarizer)
+        if build_times is not None:
+            state.add_circuit_listener(timing.timed_listener('BuildTimes', build_times))
+            # report on demand ("kill -USR1"), and when we exit
+            buildtimes.report_on_signal(reactor, build_times)
+            reactor.addSystemEventTrigger('before', 'shutdown', build_times.report)
 
     if not no_guards:
-        if len(state.entry_guards):
+        if util.output_format == 'jsonl':
+            for router in state.entry_guards.values():
+                util.json_record('guard', from_consensus=router.from_consensus,
+                                 **util.router_record(router))
+        elif len(state.entry_guards):
             print("Current Entry Guards:")
             for (name, router) in state.entry_guards.iteritems():
                 if not router.from_consensus:
@@ -181,21 +370,51 @@ def run(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams,
         else:
             follow_string = 'Address'
 
-        if len(state.addrmap.addr):
+        addrs = list(state.addrmap.addr.values())
+        if flt is not None:
+            addrs = [a for a in addrs if flt.matches('addrmap', 'current', a)]
+        if util.output_format == 'jsonl':
+            for addr in addrs:
+                util.json_record('addrmap', event='current', name=addr.name, ip=addr.ip)
+        elif addrs:
             print("Current address mappings:")
-            for addr in state.addrmap.addr.values():
+            for addr in addrs:
                 print('  %s -> %s' % (addr.name, addr.ip))
-            state.addrmap.add_listener(AddressLogger())
         else:
             print("No address mappings.")
+        if summarizer is None:
+            logger = filters.filtered_listener(flt, AddressLogger())
+            state.addrmap.add_listener(timing.timed_listener('AddressLogger', logger))
+        else:
+            state.addrmap.add_listener(summarizer)
 
     all_done = defer.Deferred()
     if not once:
-        print('')
-        print("Following new %s activity:" % follow_string)
+        if util.output_format == 'text':
+            print('')
+            if summarizer is None:
+                print("Following new %s activity:" % follow_string)
+            else:
+                print("Summarizing new %s activity every %g seconds:" % (follow_string, summary))
+
+        if metrics_listen:
+            tor_metrics = metrics.TorMetrics(state)
+            port = yield metrics.serve(reactor, metrics_listen, tor_metrics.registry)
+            if util.output_format == 'text':
+                addr = port.getHost()
+                print("Serving metrics on http://%s:%d/metrics" % (addr.host, addr.port))
+
+        if summarizer is not None:
+            summary_loop = task.LoopingCall(summarizer.emit)
+            summary_loop.clock = reactor
+            summary_loop.start(summary, now=False)
 
         def stop_reactor(arg):
-            print("Tor disconnected.")
+            if summarizer is not None:
+                summary_loop.stop()
+                summarizer.emit()
+            if util.output_format == 'text':
+                print("Tor disconnected.")
             all_done.callback(None)
 
         def error(fail):
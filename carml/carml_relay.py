@@ -18,6 +18,13 @@ from carml import util
 def _print_router_info(router, agent=None):
     # loc = yield router.get_location()
     loc = yield router.location
+    if util.output_format == 'jsonl':
+        record = util.router_record(router)
+        record.update(or_port=router.or_port, dir_port=router.dir_port, modified=router.modified)
+        if agent:
+            record['onionoo'] = yield router.get_onionoo_details(agent)
+        util.json_record('relay', **record)
+        return
     print("            name: {}".format(router.name))
     print("          hex id: {}".format(router.id_hex))
     print("        location: {}".format(loc.countrycode))
@@ -57,13 +64,15 @@ def router_info(state, arg, tor):
             r for r in state.all_routers
             if arg in r.name or arg in r.id_hex
         ]
-        if not candidates:
+        text = util.output_format == 'text'
+        if not candidates and text:
             print("Nothing found ({} routers total)".format(len(state.all_routers)))
-        if len(candidates) > 1:
+        if len(candidates) > 1 and text:
             print("Found multiple routers:")
         for router in candidates:
             yield _print_router_info(router)
-            print()
+            if text:
+                print()
     else:
         yield _print_router_info(relay, agent=tor.web_agent())
 
@@ -111,6 +120,9 @@ def router_await(state, arg):
 
 def router_list(state):
     for router in state.all_routers:
+        if util.output_format == 'jsonl':
+            util.json_record('relay', **util.router_record(router))
+            continue
         print("{}".format(router.id_hex[1:]))
 
 
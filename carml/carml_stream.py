@@ -2,57 +2,183 @@ from __future__ import print_function
 
 import os
 import sys
+import array
+import heapq
 import functools
 
 from twisted.python import usage, log
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from zope.interface import implementer
 import txtorcon
 import humanize
 
 from carml.interface import ICarmlCommand
 from carml import util
+from carml import timing
+from carml import procindex
+from carml import circpool
+from carml import isolation
 
+#: how often (seconds) attachers look for exited processes and idle keys
+PRUNE_INTERVAL = 60.0
 
-def attach_streams_per_process(state):
+#: how long (seconds) a stream waits for its process's circuit before
+#: we let Tor choose one instead
+PENDING_TIMEOUT = 30.0
+
+
+@implementer(txtorcon.IStreamAttacher)
+class ProcessAttacher(txtorcon.CircuitListenerMixin):
+    """
+    Gives each process its own circuit, taken from a CircuitPool.
+
+    Mappings are forgotten when their circuit closes or (see prune())
+    their process exits, so this stays as big as the set of live
+    processes using Tor, however long it runs.
+    """
+
+    def __init__(self, reactor, pool):
+        self._reactor = reactor
+        self._pool = pool
+        self.pid_to_circuit = {}
+        self._started = {}          # pid -> procindex.start_time()
+        self._by_circuit = {}       # circuit id -> set of pids
+        self._taking = set()        # pids we've asked the pool for a circuit for
+        self._pending = {}          # pid -> [(stream, Deferred, timeout)] waiting for it
+        #: counters, for the curious
+        self.pruned = 0
+        self.timed_out = 0
+
+    def attach_stream(self, stream, circuits):
+        src_addr, _, src_port = stream.flags.get('SOURCE_ADDR', '').rpartition(':')
+        pid = procindex.lookup(src_addr, src_port) if src_addr else None
+        if pid is None:
+            print("  stream %d to %s:%d isn't from a local process; letting Tor choose" % (
+                stream.id, stream.target_host, stream.target_port))
+            return None
+
+        circ = self.pid_to_circuit.get(pid, None)
+        if circ is not None and circ.state == 'BUILT':
+            if self._started.get(pid) == procindex.start_time(pid):
+                return self._attach(stream, pid, circ)
+            self._forget(pid)       # a new process with a re-used PID
+        d = defer.Deferred()
+        timeout = self._reactor.callLater(PENDING_TIMEOUT, self._give_up, stream, pid, d)
+        self._pending.setdefault(pid, []).append((stream, d, timeout))
+        if pid not in self._taking:
+            self._taking.add(pid)
+            self._pool.take().addCallback(self._assign, pid)
+        return d
+
+    def _assign(self, circ, pid):
+        self._taking.discard(pid)
+        self._forget(pid)
+        self.pid_to_circuit[pid] = circ
+        self._started[pid] = procindex.start_time(pid)
+        self._by_circuit.setdefault(circ.id, set()).add(pid)
+        print('Selected circuit %d for process %d (%s).' % (circ.id, pid, _procname(pid)))
+        print('  ', '->'.join([p.name if p.name_is_unique else ('{%s}' % p.name) for p in circ.path]))
+        for (stream, d, timeout) in self._pending.pop(pid, []):
+            timeout.cancel()
+            if stream.state in ('CLOSED', 'FAILED'):
+                # gave up while we were waiting
+                d.callback(txtorcon.TorState.DO_NOT_ATTACH)
+            else:
+                d.callback(self._attach(stream, pid, circ))
+
+    def _give_up(self, stream, pid, d):
+        # the pool has run dry (e.g. circuits keep failing to build);
+        # the circuit still goes to this process once it's built
+        waiting = self._pending.get(pid, [])
+        waiting[:] = [w for w in waiting if w[1] is not d]
+        if not waiting:
+            self._pending.pop(pid, None)
+        self.timed_out += 1
+        if stream.state in ('CLOSED', 'FAILED'):
+            d.callback(txtorcon.TorState.DO_NOT_ATTACH)
+            return
+        print("  no circuit for %s after %ds; letting Tor choose for stream %d" % (
+            _procname(pid), PENDING_TIMEOUT, stream.id))
+        d.callback(None)
+
+    def _attach(self, stream, pid, circ):
+        print("  attaching stream %d to circuit %d for %s:%d (%s)" % (
+            stream.id, circ.id, stream.target_host, stream.target_port, _procname(pid)))
+        return circ
+
+    def _forget(self, pid):
+        circ = self.pid_to_circuit.pop(pid, None)
+        self._started.pop(pid, None)
+        if circ is None:
+            return None
+        pids = self._by_circuit.get(circ.id, None)
+        if pids is not None:
+            pids.discard(pid)
+            if not pids:
+                del self._by_circuit[circ.id]
+        return circ
+
+    def circuit_closed(self, circ, **kw):
+        for pid in self._by_circuit.pop(circ.id, ()):
+            self.pid_to_circuit.pop(pid, None)
+            self._started.pop(pid, None)
+            self.pruned += 1
+
+    circuit_failed = circuit_closed
+
+    def prune(self):
+        """
+        Forgets processes that have exited (or whose PID now belongs
+        to someone else), closing circuits no process maps to and
+        with no streams left on them.
+        """
+        for pid in [p for (p, started) in self._started.items() if procindex.start_time(p) != started]:
+            circ = self._forget(pid)
+            self.pruned += 1
+            if circ is None or circ.id in self._by_circuit:
+                continue
+            if circ.state == 'BUILT' and not circ.streams:
+                print('Process %d is gone; closing circuit %d.' % (pid, circ.id))
+                d = circ.close()
+                d.addErrback(lambda _: None)    # it's gone already
+
+    def __len__(self):
+        return len(self.pid_to_circuit)
+
+
+def _procname(pid):
+    return os.path.realpath('/proc/%d/exe' % pid)
+
+
+def attach_streams_per_process(state, pool_size=2):
     print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
     print("Giving each new PID we see its own Circuit (until they're gone).")
 
-    @implementer(txtorcon.IStreamAttacher)
-    class Attacher(object):
-
-        def __init__(self):
-            self.pid_to_circuits = {}
+    pool = circpool.CircuitPool(reactor, state, size=pool_size)
+    pool.start()
+    attacher = ProcessAttacher(reactor, pool)
+    state.add_circuit_listener(attacher)
+    state.set_attacher(attacher, reactor)
+    pruner = task.LoopingCall(attacher.prune)
+    pruner.clock = reactor
+    pruner.start(PRUNE_INTERVAL, now=False)
+    return defer.Deferred()
 
-        def choose_new_circuit(self, stream, circuits):
-            for circ in circuits.values():
-                if circ in self.pid_to_circuits.values():
-                    continue
-                if circ.state != 'BUILT':
-                    continue
-                return circ
-            raise RuntimeError("Ran out of circuits to select.")
 
-        def attach_stream(self, stream, circuits):
-            src_addr, src_port = stream.flags['SOURCE_ADDR'].split(':')
-            pid = txtorcon.util.process_from_address(src_addr, src_port)
-            procname = os.path.realpath('/proc/%d/exe' % pid)
-
-            try:
-                circ = self.pid_to_circuits[pid]
-            except KeyError:
-                circ = self.choose_new_circuit(stream, circuits)
-                self.pid_to_circuits[pid] = circ
-                print('Selected circuit %d for process %d (%s).' % (circ.id, pid, procname))
-                print('  ', '->'.join([p.name if p.name_is_unique else ('{%s}' % p.name) for p in circ.path]))
-
-#            if stream.state == 'NEWRESOLVE':
-#                print "  attaching %d (resolve %s)" % (stream.id, stream.target_host)
-#            else:
-            print("  attaching stream %d to circuit %d for %s:%d (%s)" % (stream.id, circ.id, stream.target_host, stream.target_port, procname))
-            return circ
+def attach_streams_by_policy(state, policy_file):
+    policy = isolation.load_policy(policy_file)
+    print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
+    print("Isolating streams according to %s (%d rules)." % (policy_file, len(policy.rules)))
 
-    state.set_attacher(Attacher(), reactor)
+    pool = circpool.CircuitPool(reactor, state, size=policy.pool)
+    pool.start()
+    attacher = isolation.IsolatingAttacher(reactor, policy, pool)
+    state.add_circuit_listener(attacher)
+    state.set_attacher(attacher, reactor)
+    sweeper = task.LoopingCall(attacher.prune)
+    sweeper.clock = reactor
+    sweeper.start(min(PRUNE_INTERVAL, policy.idle), now=False)
+    return defer.Deferred()
 
 
 def attach_streams_to_circuit(circid, state):
@@ -106,6 +232,10 @@ def attach_streams_to_circuit(circid, state):
 
 
 def list_streams(state, verbose):
+    if util.output_format == 'jsonl':
+        for stream in state.streams.values():
+            util.json_record('stream', **util.stream_record(stream))
+        return
     print("Streams:")
     for stream in state.streams.values():
         flags = str(stream.flags) if stream.flags else 'no flags'
@@ -118,7 +248,7 @@ def list_streams(state, verbose):
                                                flags))
         if verbose:
             h = stream.target_addr if stream.target_addr else stream.target_host
-            source = txtorcon.util.process_from_address(stream.source_addr, stream.source_port)
+            source = procindex.lookup(stream.source_addr, stream.source_port)
             if source is None:
                 source = 'unknown'
             print("     to %s:%s, from %s" % (h, stream.target_port, source))
@@ -171,98 +301,296 @@ def close_stream(state, streamid):
     # that our stream has entered state CLOSED
 
 
-class StreamBandwidth(object):
+#: (seconds per bucket, buckets kept) for each StreamBandwidth level:
+#: a minute of seconds, an hour of minutes and a day of hours
+LEVELS = ((1, 60), (60, 60), (3600, 24))
+
+
+class _Ring(object):
     """
-    The bandwidth-events of a single stream
+    One level of a StreamBandwidth: a fixed number of buckets, each
+    ``width`` seconds wide, in a flat array of (read, written,
+    max_read, max_written) per bucket. The maxes are of per-second
+    bytes, so the 1-hour buckets still know the busiest second.
     """
-    #  __slots__ = ['_events']
+    __slots__ = ['width', 'slots', '_data', '_newest', 'window_read', 'window_written']
+
+    def __init__(self, width, slots):
+        self.width = width
+        self.slots = slots
+        self._data = array.array('d', [0.0]) * (4 * slots)
+        self._newest = None     # bucket number (epoch // width) of the newest bucket
+        # totals over all the buckets we still have
+        self.window_read = 0.0
+        self.window_written = 0.0
+
+    def _advance(self, bucket):
+        """
+        Makes bucket the newest, zeroing the ones we skip (at most all
+        of them, so this is O(slots) worst-case, O(1) amortized).
+        """
+        if self._newest is None:
+            self._newest = bucket
+            return
+        first = max(self._newest + 1, bucket - self.slots + 1)
+        data = self._data
+        for b in range(first, bucket + 1):
+            i = 4 * (b % self.slots)
+            self.window_read -= data[i]
+            self.window_written -= data[i + 1]
+            data[i] = data[i + 1] = data[i + 2] = data[i + 3] = 0.0
+        self._newest = bucket
+
+    def add(self, epoch, read, written, peak_read, peak_written):
+        """
+        Returns the bucket's (read, written) so far, or None if epoch
+        is too old for any of our buckets.
+        """
+        bucket = int(epoch // self.width)
+        if self._newest is None or bucket > self._newest:
+            self._advance(bucket)
+        elif bucket <= self._newest - self.slots:
+            return None
+        i = 4 * (bucket % self.slots)
+        data = self._data
+        data[i] += read
+        data[i + 1] += written
+        self.window_read += read
+        self.window_written += written
+        if peak_read is None:
+            data[i + 2] = data[i]
+            data[i + 3] = data[i + 1]
+        else:
+            data[i + 2] = max(data[i + 2], peak_read)
+            data[i + 3] = max(data[i + 3], peak_written)
+        return data[i], data[i + 1]
 
-    def __init__(self, max_live=20, roll_up=5):
-        self._events = []  # list of 3-tuples
-        self._history = []
-        self.max_live = max_live
-        self.roll_up = roll_up
+    def buckets(self):
+        """
+        (start, duration, mean_r, mean_w, max_r, max_w) for each bucket
+        we have, oldest first; means are bytes/second.
+        """
+        if self._newest is None:
+            return []
+        width = float(self.width)
+        result = []
+        for b in range(self._newest - self.slots + 1, self._newest + 1):
+            if b < 0:
+                continue
+            i = 4 * (b % self.slots)
+            r, w, max_r, max_w = self._data[i:i + 4]
+            result.append((b * self.width, self.width, r / width, w / width, max_r, max_w))
+        return result
 
-        # XXX we could recursively roll-up too, i.e. spill from one
-        # bucket to the next. but, for now, there are precisely two
-        # bucks: the "current", and the first one containing (avg,
-        # min, max) etc
 
-    def add_bandwidth(self, epoch, read, write):
-        self._events.append((epoch, read, write))
-        self._maybe_truncate()
+class StreamBandwidth(object):
+    """
+    The bandwidth-events of a single stream.
 
-    def _maybe_truncate(self):
-        """
-        If we've gone past our max_live amount by at least roll_up events,
-        we push it into the history (possibly also truncating that).
-        """
-        # XXX should we examine seconds here instead? i.e. have a
-        # max-seconds (instead of going by event-count)?
-        if len(self._events) > self.max_live + self.roll_up:
-            rolling = self._events[:self.roll_up]
-            self._events = self._events[self.roll_up:]
-            duration = float(self._events[0][0] - rolling[0][0])
-            mean_r = sum(x[1] for x in rolling) / duration
-            mean_w = sum(x[2] for x in rolling) / duration
-
-            # XXX should append some smarter-er object instead of tuple?
-            # (start, duration, mean_r, mean_w, max_r, max_w)
-            self._history.append(
-                (
-                    rolling[0][0],
-                    duration,
-                    mean_r, mean_w,
-                    max(x[1] for x in rolling),
-                    max(x[2] for x in rolling),
-                )
-            )
-            self._history = self._history[-10:]
-            print("HISTORY NOW", self._history)
-            print("age {}, total bw {}".format(
-                self._events[-1][0] - (self._history[-1][0] + self._history[-1][1]),
-                sum([sum(x[1:]) for x in self._history]),
-            ))
+    Each event goes into every level of a fixed set of ring-buffers
+    (see LEVELS) and some running totals, so adding an event and
+    asking for totals or rates are all O(1) and a stream uses the same
+    memory however long it lives.
+    """
+    __slots__ = ['_levels', '_read', '_written', '_first', '_last']
+
+    def __init__(self, levels=LEVELS):
+        self._levels = [_Ring(width, slots) for (width, slots) in levels]
+        self._read = 0
+        self._written = 0
+        self._first = None
+        self._last = None
+
+    def add_bandwidth(self, epoch, read, write):
+        self._read += read
+        self._written += write
+        if self._first is None or epoch < self._first:
+            self._first = epoch
+        if self._last is None or epoch > self._last:
+            self._last = epoch
+
+        # the coarser levels remember the busiest second
+        peak = self._levels[0].add(epoch, read, write, None, None)
+        if peak is None:
+            return
+        peak_r, peak_w = peak
+        for level in self._levels[1:]:
+            level.add(epoch, read, write, peak_r, peak_w)
 
     def bytes_read(self):
-        return sum(event[1] for event in self._events)
+        return self._read
 
     def bytes_written(self):
-        return sum(event[2] for event in self._events)
+        return self._written
 
     def duration(self):
-        if not self._events:
+        if self._first is None:
             return 0.0
-        if len(self._events) == 1:
-            return 1.0
-        return float(self._events[-1][0] - self._events[0][0]) + 1.0
+        return float(self._last - self._first) + 1.0
 
     def rate(self):
+        """
+        Mean (read, written) bytes/second over the stream's life.
+        """
         span = self.duration()
         if span == 0.0:
             return (0.0, 0.0)  # mmm...pragmatism
-        return (self.bytes_read() / span, self.bytes_written() / span)
+        return (self._read / span, self._written / span)
+
+    def recent_rate(self):
+        """
+        Mean (read, written) bytes/second over the finest level's
+        window (the last minute, by default).
+        """
+        finest = self._levels[0]
+        span = min(self.duration(), float(finest.width * finest.slots))
+        if span == 0.0:
+            return (0.0, 0.0)
+        return (finest.window_read / span, finest.window_written / span)
+
+    def history(self, level=0):
+        """
+        The buckets of one level (0 is the finest); see _Ring.buckets.
+        """
+        return self._levels[level].buckets()
+
+
+#: how often (seconds) "stream --follow --top" prints its table
+TOP_INTERVAL = 5.0
+
+
+class TopTalkers(object):
+    """
+    Bytes per process, target host and circuit, for a periodic table
+    of the heaviest users ("stream --follow --top N"). Keys stay while
+    they have open streams or used any bandwidth in the last interval.
+    """
+
+    #: what we rank by, and their column headings
+    KINDS = (('process', 'Process'), ('host', 'Target'), ('circuit', 'Circuit'))
+
+    def __init__(self, reactor, n):
+        self._reactor = reactor
+        self.n = n
+        self._totals = dict((kind, {}) for (kind, _) in self.KINDS)    # kind -> key -> bytes
+        self._recent = dict((kind, {}) for (kind, _) in self.KINDS)    # kind -> key -> bytes this interval
+        self._open = {}             # (kind, key) -> open streams
+        self._streams = {}          # stream id -> its keys
+        self._since = reactor.seconds()
+
+    def _keys_for(self, stream):
+        try:
+            return self._streams[stream.id]
+        except KeyError:
+            pass
+        pid = None
+        addr, _, port = stream.flags.get('SOURCE_ADDR', '').rpartition(':')
+        if addr:
+            pid = procindex.lookup(addr, port)
+        keys = dict(
+            process='%s[%d]' % (os.path.basename(_procname(pid)), pid) if pid else '(unknown)',
+            host=stream.target_host,
+            circuit=stream.circuit.id if stream.circuit else None,
+        )
+        for kind, key in keys.items():
+            self._open[(kind, key)] = self._open.get((kind, key), 0) + 1
+        self._streams[stream.id] = keys
+        return keys
+
+    def add(self, stream, read, written):
+        total = read + written
+        for kind, key in self._keys_for(stream).items():
+            if key is None:
+                continue
+            self._totals[kind][key] = self._totals[kind].get(key, 0) + total
+            self._recent[kind][key] = self._recent[kind].get(key, 0) + total
+
+    def stream_closed(self, stream):
+        for kind, key in self._streams.pop(stream.id, {}).items():
+            count = self._open.pop((kind, key), 0) - 1
+            if count > 0:
+                self._open[(kind, key)] = count
+
+    def top(self, kind):
+        """
+        The n (key, bytes this interval, bytes in total) with the most
+        recent traffic, heaviest first.
+        """
+        recent = self._recent[kind]
+        totals = self._totals[kind]
+        heaviest = heapq.nlargest(self.n, recent.items(), key=lambda kv: (kv[1], totals[kv[0]]))
+        return [(key, nbytes, totals[key]) for (key, nbytes) in heaviest]
+
+    def report(self):
+        now = self._reactor.seconds()
+        interval = max(now - self._since, 1.0)
+        for (kind, title) in self.KINDS:
+            rows = self.top(kind)
+            if util.output_format == 'jsonl':
+                util.json_record(
+                    'top', by=kind, interval=interval,
+                    top=[dict(key=key, rate=nbytes / interval, bytes=total) for (key, nbytes, total) in rows],
+                )
+                continue
+            print(util.colors.bold('Top {} by {} (last {:.0f}s):'.format(self.n, title.lower(), interval)))
+            if not rows:
+                print('    (nothing)')
+            for (rank, (key, nbytes, total)) in enumerate(rows, 1):
+                print('  {:>3}. {:>10}/s {:>10} total  {}'.format(
+                    rank, humanize.naturalsize(nbytes / interval), humanize.naturalsize(total), key,
+                ))
+        if util.output_format != 'jsonl':
+            print()
+        self._start_interval(now)
+
+    def _start_interval(self, now):
+        # forget keys with no streams that were idle this interval
+        for kind in self._totals:
+            recent = self._recent[kind]
+            totals = self._totals[kind]
+            for key in [k for k in totals if k not in recent and (kind, k) not in self._open]:
+                del totals[key]
+            self._recent[kind] = {}
+        self._since = now
 
 
 class BandwidthMonitor(txtorcon.StreamListenerMixin):
     @staticmethod
     @defer.inlineCallbacks
-    def create(reactor, state):
-        bw = BandwidthMonitor(reactor, state)
+    def create(reactor, state, flt=None, top=None):
+        bw = BandwidthMonitor(reactor, state, flt, top)
         yield bw._setup()
         defer.returnValue(bw)
 
-    def __init__(self, reactor, state):
+    def __init__(self, reactor, state, flt=None, top=None):
         self._reactor = reactor  # just IReactorClock required?
         self._state = state
-        self._active = {}  # maps stream ID -> list-of-tuples
+        self._filter = flt
+        #: a TopTalkers, which replaces the per-stream output
+        self._top = top
+        self._active = {}  # maps stream ID -> StreamBandwidth
+
+    def _wanted(self, event, stream):
+        if self._top is not None:
+            return False
+        return self._filter is None or self._filter.matches('stream', event, stream)
 
     def stream_new(self, stream):
-        print("new", stream)
         self._active[stream.id] = StreamBandwidth()
+        if not self._wanted('new', stream):
+            return
+        if util.output_format == 'jsonl':
+            util.json_record('stream', event='new', **util.stream_record(stream))
+        else:
+            print("new", stream)
 
     def stream_succeeded(self, stream):
         # i think this happens when it *starts* passing data?
+        if not self._wanted('succeeded', stream):
+            return
+        if util.output_format == 'jsonl':
+            util.json_record('stream', event='succeeded', **util.stream_record(stream))
+            return
         print("succeeded", stream, stream.target_host, stream.target_addr)
 
     def stream_attach(self, stream, circuit):
@@ -273,14 +601,26 @@ class BandwidthMonitor(txtorcon.StreamListenerMixin):
 
     def stream_closed(self, stream, **kw):
         # print("closed", stream, self._active)
-        if stream.id not in self._active:
+        bw = self._active.pop(stream.id, None)
+        if self._top is not None:
+            self._top.stream_closed(stream)
+        if not self._wanted('closed', stream):
+            return
+        if util.output_format == 'jsonl':
+            util.json_record(
+                'stream', event='closed',
+                bytes_read=bw.bytes_read() if bw else None,
+                bytes_written=bw.bytes_written() if bw else None,
+                duration=bw.duration() if bw else None,
+                **util.stream_record(stream)
+            )
+        elif bw is None:
             print(
                 "Previously unknown stream to {stream.target_host} died".format(
                     stream=stream,
                 )
             )
         else:
-            bw = self._active[stream.id]
             print(
                 "Stream {stream.id} to {stream.target_host}: {read} read, {written} written in {duration:.1f}s ({read_rate})".format(
                     stream=stream,
@@ -301,30 +641,51 @@ class BandwidthMonitor(txtorcon.StreamListenerMixin):
         except KeyError:
             bandwidth = self._active[sid] = StreamBandwidth()
         bandwidth.add_bandwidth(self._reactor.seconds(), rd, wr)
+        if self._top is not None:
+            stream = self._state.streams.get(sid, None)
+            if stream is not None and (self._filter is None or self._filter.matches('stream', 'bw', stream)):
+                self._top.add(stream, rd, wr)
 
     @defer.inlineCallbacks
     def _setup(self):
-        yield self._state.add_stream_listener(self)
-        yield self._state.protocol.add_event_listener('STREAM_BW', self._stream_bw)
+        yield self._state.add_stream_listener(timing.timed_listener('BandwidthMonitor', self))
+        yield self._state.protocol.add_event_listener(
+            'STREAM_BW', timing.timed('BandwidthMonitor._stream_bw', self._stream_bw),
+        )
 
 
 @defer.inlineCallbacks
-def monitor_streams(state, verbose):
+def monitor_streams(state, verbose, flt=None, top=None):
     print("monitor", state, verbose)
     from twisted.internet import reactor
-    bw = yield BandwidthMonitor.create(reactor, state)
+    talkers = None
+    if top:
+        talkers = TopTalkers(reactor, top)
+        ticker = task.LoopingCall(talkers.report)
+        ticker.clock = reactor
+        ticker.start(TOP_INTERVAL, now=False)
+    bw = yield BandwidthMonitor.create(reactor, state, flt, talkers)
 
 
 @defer.inlineCallbacks
-def run(reactor, cfg, tor, list, follow, attach, close, verbose):
+def run(reactor, cfg, tor, list, follow, attach, close, verbose, filter_expr=None, per_process=False,
+        pool_size=2, policy=None, top=None):
     state = yield tor.create_state()
     if attach:
         yield attach_streams_to_circuit(attach, state)
+    elif per_process:
+        yield attach_streams_per_process(state, pool_size)
+    elif policy:
+        yield attach_streams_by_policy(state, policy)
     elif list:
         yield list_streams(state, verbose)
     elif close:
         yield close_stream(state, close)
     elif follow:
         d = defer.succeed(None)
-        yield monitor_streams(state, verbose)
+        flt = None
+        if filter_expr:
+            from carml import filters
+            flt = filters.Filter(filter_expr, ['stream'])
+        yield monitor_streams(state, verbose, flt, top)
         yield defer.Deferred()
@@ -12,6 +12,7 @@ from twisted.internet.protocol import Protocol
 
 
 from carml import util
+from carml import geoip
 import txtorcon
 from txtorcon import TCPHiddenServiceEndpoint
 
@@ -24,10 +25,18 @@ def run(reactor, cfg, tor):
         if len(circ.streams) == 0:
             continue
 
+        countries = []
         for r in circ.path:
-            if r.location.countrycode is None:
-                yield r.get_country()
-        path = u'>'.join(map(lambda r: r.location.countrycode or '__', circ.path))
+            cc = geoip.router_country(r) if geoip.loaded() else r.location.countrycode
+            if cc is None:
+                # not in our index (or we have none); ask Tor
+                try:
+                    yield r.get_country()
+                except txtorcon.TorProtocolError:
+                    pass        # no GeoIP in Tor either (or a replay)
+                cc = r.location.countrycode
+            countries.append(cc or '__')
+        path = u'>'.join(countries)
         print(u"#[fg=colour28,bg=colour22]{}#[fg=colour46,bg=colour28]{}".format(path, len(circ.streams)), end='')
 
     total = len(state.circuits)
@@ -0,0 +1,330 @@
+from __future__ import print_function
+
+import sys
+import curses
+
+from zope.interface import implementer
+from twisted.internet import defer, task
+from twisted.internet.interfaces import IReadDescriptor
+import humanize
+
+import txtorcon
+
+from carml import util
+from carml import timing
+
+
+def _age(seconds):
+    if seconds is None:
+        return '?'
+    if seconds > 300:
+        return '%dmin' % (seconds / 60.0)
+    return '%ds' % seconds
+
+
+class Screen(object):
+    '''
+    Draws a list of (text, attribute) rows, but only touches the
+    rows that differ from the last time.
+    '''
+
+    def __init__(self, stdscr):
+        self._scr = stdscr
+        self._rows = []
+        self._size = stdscr.getmaxyx()
+
+    def invalidate(self):
+        self._rows = []
+        self._size = self._scr.getmaxyx()
+        self._scr.clear()
+
+    def draw(self, rows):
+        if self._scr.getmaxyx() != self._size:
+            self.invalidate()
+        height, width = self._size
+        rows = [(text[:width - 1], attr) for (text, attr) in rows[:height]]
+        for (i, row) in enumerate(rows):
+            if i < len(self._rows) and self._rows[i] == row:
+                continue
+            text, attr = row
+            if not isinstance(text, str):
+                text = text.encode('utf8')
+            self._scr.move(i, 0)
+            self._scr.clrtoeol()
+            self._scr.addstr(i, 0, text, attr)
+        for i in range(len(rows), min(len(self._rows), height)):
+            self._scr.move(i, 0)
+            self._scr.clrtoeol()
+        self._rows = rows
+        self._scr.refresh()
+
+
+@implementer(IReadDescriptor)
+class Keyboard(object):
+    '''
+    Hands keys pressed to on_key (stdin is in curses' cbreak mode).
+    '''
+
+    def __init__(self, stdscr, on_key):
+        self._scr = stdscr
+        self._on_key = on_key
+
+    def fileno(self):
+        return sys.stdin.fileno()
+
+    def doRead(self):
+        while True:
+            key = self._scr.getch()
+            if key == -1:
+                return
+            self._on_key(key)
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return 'carml top'
+
+
+class Top(txtorcon.CircuitListenerMixin, txtorcon.StreamListenerMixin):
+    '''
+    Keeps the numbers for the dashboard up to date from Tor's events,
+    and redraws (at most max_fps times a second) when they change.
+    '''
+
+    def __init__(self, reactor, state, screen, sort='age', max_fps=4):
+        self._reactor = reactor
+        self._state = state
+        self._screen = screen
+        self.sort = sort
+        self.reverse = False
+        self._interval = 1.0 / max_fps
+        self._last_draw = 0.0
+        self._scheduled = None
+        self._seen = {}             # circuit or stream id -> when we first saw it
+        self._stream_bytes = {}     # stream id -> bytes
+        self._circuit_bytes = {}    # circuit id -> bytes (of its streams)
+        self._bandwidth = (0, 0)    # last BW event
+        #: fires when the user quits
+        self.done = defer.Deferred()
+        now = reactor.seconds()
+        for circuit in state.circuits.values():
+            if circuit.age() is not None:
+                self._seen[('circuit', circuit.id)] = now - circuit.age()
+        for stream in state.streams.values():
+            self._seen[('stream', stream.id)] = now
+
+    def changed(self, *args, **kw):
+        '''
+        Something is different; redraw soon (but not too soon).
+        '''
+        if self._scheduled is not None:
+            return
+        delay = max(0.0, self._last_draw + self._interval - self._reactor.seconds())
+        self._scheduled = self._reactor.callLater(delay, self.draw)
+
+    def draw(self):
+        self._scheduled = None
+        self._last_draw = self._reactor.seconds()
+        self._screen.draw(self.rows())
+
+    # the listener callbacks
+
+    def circuit_new(self, circuit):
+        self._seen.setdefault(('circuit', circuit.id), self._reactor.seconds())
+        self.changed()
+
+    circuit_launched = circuit_new
+
+    def circuit_extend(self, circuit, router):
+        self.changed()
+
+    def circuit_built(self, circuit):
+        self.changed()
+
+    def circuit_closed(self, circuit, **kw):
+        self._seen.pop(('circuit', circuit.id), None)
+        self._circuit_bytes.pop(circuit.id, None)
+        self.changed()
+
+    circuit_failed = circuit_closed
+
+    def stream_new(self, stream):
+        self._seen.setdefault(('stream', stream.id), self._reactor.seconds())
+        self.changed()
+
+    def stream_succeeded(self, stream):
+        self.changed()
+
+    def stream_attach(self, stream, circuit):
+        self.changed()
+
+    def stream_detach(self, stream, **kw):
+        self.changed()
+
+    def stream_closed(self, stream, **kw):
+        self._seen.pop(('stream', stream.id), None)
+        self._stream_bytes.pop(stream.id, None)
+        self.changed()
+
+    stream_failed = stream_closed
+
+    def on_bandwidth(self, data):
+        read, written = data.split()[:2]
+        self._bandwidth = (int(read), int(written))
+        self.changed()
+
+    def on_stream_bandwidth(self, data):
+        sid, written, read = [int(x) for x in data.split()[:3]]
+        total = written + read
+        self._stream_bytes[sid] = self._stream_bytes.get(sid, 0) + total
+        stream = self._state.streams.get(sid, None)
+        if stream is not None and stream.circuit is not None:
+            cid = stream.circuit.id
+            self._circuit_bytes[cid] = self._circuit_bytes.get(cid, 0) + total
+        self.changed()
+
+    def on_key(self, key):
+        if key == curses.KEY_RESIZE:
+            self._screen.invalidate()
+        elif key in (ord('q'), ord('Q')):
+            if not self.done.called:
+                self.done.callback(None)
+            return
+        elif key in (ord('a'), ord('b'), ord('p')):
+            sort = dict(a='age', b='bytes', p='purpose')[chr(key)]
+            if sort == self.sort:
+                self.reverse = not self.reverse
+            else:
+                self.sort, self.reverse = sort, False
+        self.changed()
+
+    # building the screen
+
+    def _age_of(self, kind, ident, now):
+        seen = self._seen.get((kind, ident), None)
+        if seen is None:
+            return None
+        return now - seen
+
+    def _sorted(self, things, kind, byte_counts, purpose):
+        now = self._reactor.seconds()
+        if self.sort == 'bytes':
+            def key(x):
+                return -byte_counts.get(x.id, 0)
+        elif self.sort == 'purpose':
+            def key(x):
+                return (purpose(x) or '', x.id)
+        else:
+            def key(x):
+                return -(self._age_of(kind, x.id, now) or 0)
+        return sorted(things, key=key, reverse=self.reverse)
+
+    def rows(self):
+        state = self._state
+        now = self._reactor.seconds()
+        bold = curses.A_BOLD
+        header = curses.A_REVERSE
+
+        def name(r):
+            return util.nice_router_name(r, color=False)
+
+        rows = [(
+            'carml top: %d circuits, %d streams, %d guards; read %s/s, written %s/s; sorted by %s%s' % (
+                len(state.circuits), len(state.streams), len(state.entry_guards),
+                humanize.naturalsize(self._bandwidth[0]), humanize.naturalsize(self._bandwidth[1]),
+                self.sort, ' (reversed)' if self.reverse else '',
+            ), bold)]
+        rows.append((
+            'Guards: ' + ', '.join(sorted(r.name or r.id_hex for r in state.entry_guards.values())), 0,
+        ))
+        rows.append(('keys: (a)ge (b)ytes (p)urpose sort (again to reverse), (q)uit', 0))
+        rows.append(('', 0))
+
+        rows.append(('  %5s  %6s  %-8s  %-20s  %10s  %7s  %s' % (
+            'ID', 'Age', 'State', 'Purpose', 'Bytes', 'Streams', 'Path'), header))
+        circuits = self._sorted(
+            state.circuits.values(), 'circuit', self._circuit_bytes, lambda c: c.purpose,
+        )
+        for circ in circuits:
+            rows.append(('  %5d  %6s  %-8s  %-20s  %10s  %7d  %s' % (
+                circ.id, _age(self._age_of('circuit', circ.id, now)), circ.state,
+                circ.purpose, humanize.naturalsize(self._circuit_bytes.get(circ.id, 0)),
+                len(circ.streams), '->'.join(name(r) for r in circ.path),
+            ), 0))
+
+        rows.append(('', 0))
+        rows.append(('  %5s  %6s  %7s  %-12s  %10s  %s' % (
+            'ID', 'Age', 'Circuit', 'State', 'Bytes', 'Target'), header))
+        streams = self._sorted(
+            state.streams.values(), 'stream', self._stream_bytes, lambda s: s.flags.get('PURPOSE', None),
+        )
+        for stream in streams:
+            rows.append(('  %5d  %6s  %7s  %-12s  %10s  %s:%s' % (
+                stream.id, _age(self._age_of('stream', stream.id, now)),
+                stream.circuit.id if stream.circuit else '-', stream.state,
+                humanize.naturalsize(self._stream_bytes.get(stream.id, 0)),
+                stream.target_host, stream.target_port,
+            ), 0))
+        return rows
+
+
+@defer.inlineCallbacks
+def run(reactor, cfg, tor, sort, max_fps):
+    if not sys.stdout.isatty() or util.output_format != 'text':
+        print('"carml top" needs a terminal.')
+        return
+    state = yield tor.create_state()
+    yield util.invalidate_on_new_consensus(state.protocol)
+
+    stdscr = curses.initscr()
+    restored = []
+
+    def restore_terminal():
+        if not restored:
+            restored.append(True)
+            curses.endwin()
+
+    try:
+        curses.noecho()
+        curses.cbreak()
+        stdscr.keypad(1)
+        stdscr.nodelay(1)
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass            # terminal can't hide the cursor
+
+        screen = Screen(stdscr)
+        top = Top(reactor, state, screen, sort=sort, max_fps=max_fps)
+        keyboard = Keyboard(stdscr, top.on_key)
+        reactor.addReader(keyboard)
+
+        state.add_circuit_listener(timing.timed_listener('Top', top))
+        state.add_stream_listener(top)
+        yield tor.protocol.add_event_listener('BW', timing.timed('Top.on_bandwidth', top.on_bandwidth))
+        yield tor.protocol.add_event_listener(
+            'STREAM_BW', timing.timed('Top.on_stream_bandwidth', top.on_stream_bandwidth),
+        )
+
+        def tick():
+            # ages go up even when nothing happens, and curses only
+            # tells us about a resized terminal from getch()
+            keyboard.doRead()
+            top.changed()
+        ticker = task.LoopingCall(tick)
+        ticker.clock = reactor
+        ticker.start(1.0, now=False)
+
+        def disconnected(_):
+            if not top.done.called:
+                top.done.callback(None)
+        state.protocol.on_disconnect.addBoth(disconnected)
+        reactor.addSystemEventTrigger('before', 'shutdown', restore_terminal)
+
+        top.draw()
+        yield top.done
+        ticker.stop()
+        reactor.removeReader(keyboard)
+    finally:
+        restore_terminal()
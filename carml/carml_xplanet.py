@@ -14,6 +14,7 @@ from twisted.internet import defer, reactor, stdio
 import txtorcon
 from carml.interface import ICarmlCommand
 from carml import util
+from carml import geoip
 
 _log = functools.partial(log.msg, system='carml')
 
@@ -68,9 +69,11 @@ def dump_xplanet_files(cfg, all, arc_file, file, follow, state):
             arc_colors = gen_colors(*start_color.next())
             for (i, link) in enumerate(circ.path[:-1]):
                 nxt = circ.path[i + 1]
-                if link.location.latlng[0] and nxt.location.latlng[0]:
-                    arc_file.write('%f %f ' % link.location.latlng)
-                    arc_file.write('%f %f ' % nxt.location.latlng)
+                link_latlng = geoip.router_latlng(link)
+                nxt_latlng = geoip.router_latlng(nxt)
+                if link_latlng[0] and nxt_latlng[0]:
+                    arc_file.write('%f %f ' % link_latlng)
+                    arc_file.write('%f %f ' % nxt_latlng)
                     arc_file.write('color=%s thickness=2 # %s->%s\n' % (arc_colors.next(), link.id_hex, nxt.id_hex))
 
     markerfile = file
@@ -80,7 +83,7 @@ def dump_xplanet_files(cfg, all, arc_file, file, follow, state):
 
     misses = 0
     for router in unique_routers:
-        lat, lng = router.location.latlng
+        lat, lng = geoip.router_latlng(router)
         if lat is not None and lng is not None:
             color = 'purple'
             if router.id_hex in state.entry_guards:
@@ -95,14 +98,14 @@ def dump_xplanet_files(cfg, all, arc_file, file, follow, state):
             misses += 1
 
     for router in routers_in_streams:
-        lat, lng = router.location.latlng
+        lat, lng = geoip.router_latlng(router)
         if lat and lng:
             markerfile.write('%02.5f %02.5f color=green # %s %s\n' % (lat, lng, router.unique_name, router.id_hex))
 
     if False:
         for stream in state.streams.values():
             for (idx, router) in enumerate(stream.circuit.path):
-                lat, lng = router.location.latlng
+                lat, lng = geoip.router_latlng(router)
                 if lat and lng:
                     markerfile.write('%02.5f %02.5f "%d:%s" color=green # %s\n' % (lat, lng, idx, router.unique_name, router.id_hex))
 
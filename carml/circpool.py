@@ -0,0 +1,119 @@
+'''
+A pool of built, unused circuits for stream attachers.
+
+Building a circuit takes anything from a few hundred milliseconds to
+many seconds; an attacher that only starts building one when a new
+process (or isolation key) shows up makes that stream wait. A
+CircuitPool keeps ``size`` BUILT circuits nobody is using yet, hands
+them out in O(1) and builds replacements in the background.
+'''
+
+from __future__ import print_function
+
+import collections
+
+from twisted.internet import defer
+import txtorcon
+
+#: longest we wait before trying again after circuits fail to build
+MAX_BACKOFF = 60.0
+
+
+class CircuitPool(txtorcon.CircuitListenerMixin):
+
+    def __init__(self, reactor, state, size=2):
+        self._reactor = reactor
+        self._state = state
+        self.size = size
+        self._ready = collections.OrderedDict()     # circuit id -> Circuit
+        self._waiting = collections.deque()         # Deferreds wanting a circuit
+        self._building = 0
+        self._in_flight = {}        # circuit id -> Circuit we're building
+        self._failures = 0
+        self._retry = None
+        #: counters, for the curious
+        self.built = 0
+        self.failed = 0
+        self.taken = 0
+
+    def start(self, adopt=True):
+        '''
+        Starts building circuits. With adopt, any BUILT general-purpose
+        circuits Tor already has count towards the pool.
+        '''
+        self._state.add_circuit_listener(self)
+        if adopt:
+            for circ in sorted(self._state.circuits.values(), key=lambda c: c.id):
+                if circ.state == 'BUILT' and circ.purpose == 'GENERAL':
+                    self._ready[circ.id] = circ
+        self._replenish()
+
+    def take(self):
+        '''
+        Returns a Deferred that fires with a BUILT circuit that nobody
+        else has been given. This is immediate unless the pool has run
+        dry.
+        '''
+        self.taken += 1
+        if self._ready:
+            _, circ = self._ready.popitem(last=False)
+            d = defer.succeed(circ)
+        else:
+            d = defer.Deferred()
+            self._waiting.append(d)
+        self._replenish()
+        return d
+
+    def __len__(self):
+        return len(self._ready)
+
+    def _replenish(self):
+        if self._retry is not None:
+            return              # backing off after failures
+        wanted = self.size + len(self._waiting)
+        while len(self._ready) + self._building < wanted:
+            self._build_one()
+
+    def _build_one(self):
+        self._building += 1
+        d = self._state.build_circuit()
+        d.addCallbacks(self._launched, self._build_failed)
+
+    def _launched(self, circ):
+        # when_built() never errbacks; circuit_failed/circuit_closed
+        # tell us about those that don't make it
+        self._in_flight[circ.id] = circ
+        circ.when_built().addCallback(self._built)
+
+    def _built(self, circ):
+        if self._in_flight.pop(circ.id, None) is None:
+            return              # already counted as failed
+        self._building -= 1
+        self._failures = 0
+        self.built += 1
+        if circ.state != 'BUILT':
+            return self._replenish()    # closed before we heard about it
+        if self._waiting:
+            self._waiting.popleft().callback(circ)
+        else:
+            self._ready[circ.id] = circ
+
+    def _build_failed(self, fail):
+        self._building -= 1
+        self._failures += 1
+        self.failed += 1
+        delay = min(MAX_BACKOFF, 2 ** (self._failures - 1))
+        if self._retry is None:
+            self._retry = self._reactor.callLater(delay, self._retry_now)
+
+    def _retry_now(self):
+        self._retry = None
+        self._replenish()
+
+    def circuit_closed(self, circ, **kw):
+        if self._in_flight.pop(circ.id, None) is not None:
+            self._build_failed(None)
+        elif self._ready.pop(circ.id, None) is not None:
+            self._replenish()
+
+    circuit_failed = circuit_closed
@@ -1,30 +1,26 @@
 from __future__ import absolute_import, print_function
 
 import sys
+import time
+import atexit
 
 from twisted.internet import defer, task
-from twisted.internet.endpoints import clientFromString
 from twisted.python.failure import Failure
 from twisted.python import usage, log
 
 import click
-import txtorcon
-
-from . import carml_check_pypi
-from . import carml_stream
-from . import carml_events
-from . import carml_circ
-from . import carml_cmd
-from . import carml_monitor
-from . import carml_newid
-from . import carml_pastebin
-from . import carml_copybin
-from . import carml_relay
-from . import carml_tbb
-from . import carml_temphs
-from . import carml_tmux
-from . import carml_xplanet
-from . import carml_graph
+
+from . import util
+
+# NOTE: the carml_* sub-command modules are imported lazily, inside
+# each command below. Several of them drag in twisted.web, OpenSSL,
+# txsocksx etc. and we don't want "carml tmux" (which might run every
+# couple seconds) to pay for importing all of those.
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
 
 
 LOG_LEVELS = ["DEBUG", "INFO", "NOTICE", "WARN", "ERR"]
@@ -68,6 +64,75 @@ class LogObserver(object):
             out.flush()
 
 
+class ImportProfiler(object):
+    '''
+    Times every import (by wrapping __import__) and can print a
+    report of the slowest ones. Times are "inclusive"; that is, they
+    include any imports that module itself did.
+    '''
+
+    def __init__(self):
+        self._original_import = None
+        self._depth = 0
+        #: list of 3-tuples: (seconds, depth, module-name)
+        self.timings = []
+
+    def install(self):
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _import(self, name, *args, **kw):
+        already = name in sys.modules
+        self._depth += 1
+        start = time.time()
+        try:
+            return self._original_import(name, *args, **kw)
+        finally:
+            self._depth -= 1
+            if not already:
+                self.timings.append((time.time() - start, self._depth, name))
+
+    def report(self, out=None, limit=25):
+        self.uninstall()
+        out = out or sys.stderr
+        total = sum(t for (t, depth, _) in self.timings if depth == 0)
+        print('Imported {} modules in {:.1f}ms (slowest {} shown):'.format(
+            len(self.timings), total * 1000.0, limit), file=out)
+        for (t, depth, name) in sorted(self.timings, reverse=True)[:limit]:
+            print('  {:8.1f}ms {}{}'.format(t * 1000.0, '  ' * depth, name), file=out)
+
+
+def _start_profiling(fname):
+    '''
+    cProfile everything from here until we exit, and time all the
+    event-listeners.
+    '''
+    import cProfile
+    import pstats
+    from . import timing
+
+    listeners = timing.enable()
+    profiler = cProfile.Profile()
+
+    def _report():
+        profiler.disable()
+        profiler.dump_stats(fname)
+        print('Profile written to "{}"; the most expensive calls:'.format(fname), file=sys.stderr)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(20)
+        listeners.report()
+        cache = util.display_cache
+        if cache.hits or cache.misses:
+            print('Router display cache: {} hits, {} misses'.format(cache.hits, cache.misses), file=sys.stderr)
+    atexit.register(_report)
+    profiler.enable()
+
+
 class Config(object):
     '''
     Passed as the Click object (@pass_obj) to all CLI methods.
@@ -89,20 +154,95 @@ class Config(object):
 )
 @click.option(
     '--connect', '-c',
-    default='tcp:host=127.0.0.1:port=9051',
+    default=['tcp:host=127.0.0.1:port=9051'],
+    multiple=True,
     help=('Where to connect to Tor. This accepts any Twisted client endpoint '
           'string, or an ip:port pair. Examples: "tcp:localhost:9151" or '
-          '"unix:/var/run/tor/control".'),
+          '"unix:/var/run/tor/control". Give this more than once (or '
+          '"@FILE" with one endpoint per line) to run the command against '
+          'several Tors at once.'),
     metavar='ENDPOINT',
 )
+@click.option(
+    '--concurrency',
+    default=16,
+    help=('With several --connect endpoints, run at most this many at once '
+          '(0 means no limit).'),
+    type=int,
+)
 @click.option(
     '--color', '-C',
     type=click.Choice(['auto', 'no', 'always']),
     default='auto',
     help='Colourize output using ANSI commands.',
 )
+@click.option(
+    '--format', '-F', 'output_format',
+    type=click.Choice(['text', 'jsonl']),
+    default='text',
+    help='Output human-readable text, or one JSON object per line.',
+)
+@click.option(
+    '--output-queue',
+    default=10000,
+    help=('Queue up to this many lines of output to be written when stdout '
+          'is ready, so a slow reader never stalls us (0 to write immediately).'),
+    type=int,
+    metavar='LINES',
+)
+@click.option(
+    '--output-policy',
+    type=click.Choice(['block', 'drop-oldest']),
+    default='block',
+    help='What to do when the output queue is full.',
+)
+@click.option(
+    '--flush-interval',
+    default=0.0,
+    help='Write queued output at most this often (seconds).',
+    type=float,
+)
+@click.option(
+    '--no-router-cache',
+    help="Don't use (or update) the on-disk copy of Tor's router list.",
+    is_flag=True,
+)
+@click.option(
+    '--cache-dir',
+    default=None,
+    help='Where to keep the router list (default: ~/.cache/carml).',
+    metavar='DIR',
+)
+@click.option(
+    '--geoip', 'geoip_files',
+    multiple=True,
+    help='GeoIP file (Tor geoip/geoip6 or MaxMind CSV) to use instead of Tor\'s; may be repeated.',
+    type=click.Path(exists=True, dir_okay=False),
+    metavar='FILE',
+)
+@click.option(
+    '--daemon-socket',
+    default=None,
+    envvar='CARML_DAEMON_SOCKET',
+    help=('If a "carml daemon" is listening on this unix socket, commands it '
+          'can answer (like "circ --list") are sent to it instead of '
+          'connecting to Tor ourselves.'),
+    metavar='PATH',
+)
+@click.option(
+    '--profile',
+    help=('Run under cProfile, saving the stats to FILE. Also report (on '
+          'stderr) how long our event-listeners take.'),
+    default=None,
+    metavar='FILE',
+)
+@click.option(
+    '--import-profile',
+    help='Report (on stderr) how long importing each module took.',
+    is_flag=True,
+)
 @click.pass_context
-def carml(ctx, timestamps, no_color, info, quiet, debug, password, connect, color):
+def carml(ctx, timestamps, no_color, info, quiet, debug, password, connect, color, concurrency, output_format, output_queue, output_policy, flush_interval, no_router_cache, cache_dir, geoip_files, daemon_socket, profile, import_profile):
     if (color == 'always' and no_color) or \
        (color == 'no' and no_color is True):
         raise click.UsageError(
@@ -118,31 +258,119 @@ def carml(ctx, timestamps, no_color, info, quiet, debug, password, connect, colo
     cfg.quiet = quiet
     cfg.debug = debug
     cfg.password = password
-    cfg.connect = connect
+    from . import fanout
+    try:
+        cfg.endpoints = fanout.read_endpoints(connect)
+    except IOError as e:
+        raise click.UsageError(str(e))
+    if not cfg.endpoints:
+        raise click.UsageError("No endpoints to connect to")
+    cfg.connect = cfg.endpoints[0]
+    cfg.concurrency = concurrency
     cfg.color = color
+    cfg.daemon_socket = daemon_socket
+    cfg.replay = None
+    cfg.router_cache = not no_router_cache
+    cfg.cache_dir = cache_dir
+    if geoip_files:
+        from . import geoip
+        geoip.configure(geoip_files)
+    cfg.output_format = output_format
+    util.set_output_format(output_format)
+    cfg.output_queue = output_queue
+    cfg.output_policy = output_policy
+    cfg.flush_interval = flush_interval
+
+    if import_profile:
+        profiler = ImportProfiler()
+        profiler.install()
+        atexit.register(profiler.report)
+
+    if profile:
+        _start_profiling(profile)
 
     # start logging
-    _log_observer = LogObserver()
-    log.startLoggingWithObserver(_log_observer, setStdout=False)
+    cfg.log_observer = LogObserver()
+    log.startLoggingWithObserver(cfg.log_observer, setStdout=False)
 
 
 def _run_command(cmd, cfg, *args, **kwargs):
 
+    if cfg.daemon_socket and len(cfg.endpoints) == 1 and not kwargs:
+        from . import carml_daemon
+        code = carml_daemon.run_via_daemon(
+            cfg, cmd.__module__.split('.')[-1], args,
+        )
+        if code is not None:
+            sys.exit(code)
+
     @defer.inlineCallbacks
-    def _startup(reactor):
-        ep = clientFromString(reactor, cfg.connect)
-        tor = yield txtorcon.connect(reactor, ep)
+    def _connect_and_run(reactor, endpoint, on_connect=None, within=None):
+        from twisted.internet.endpoints import clientFromString
+        import txtorcon
+
+        if cfg.replay:
+            from . import trace
+            tor = trace.ReplayTor(reactor, cfg.replay)
+        else:
+            ep = clientFromString(reactor, endpoint)
+            d = txtorcon.connect(reactor, ep)
+            tor = yield (d if within is None else within(d))
+            if cfg.router_cache:
+                from . import nscache
+                tor = nscache.CachingTor(tor, cfg.cache_dir or nscache.default_cache_dir())
+            from . import coalesce
+            tor = coalesce.CoalescingTor(reactor, tor)
+        if on_connect is not None:
+            on_connect(tor)
 
         if cfg.info:
-            info = yield tor.proto.get_info('version', 'status/version/current', 'dormant')
-            click.echo(
+            try:
+                info = yield tor.proto.get_info('version', 'status/version/current', 'dormant')
+            except txtorcon.TorProtocolError:
+                # e.g. a trace recorded without them
+                info = yield tor.proto.get_info('version')
+                info['status/version/current'] = 'unknown'
+            print(
                 'Connected to a Tor version "{version}" (status: '
                 '{status/version/current}).\n'.format(**info)
             )
-        yield defer.maybeDeferred(
+        d = defer.maybeDeferred(
             cmd, reactor, cfg, tor, *args, **kwargs
         )
+        if cfg.replay:
+            yield tor.play(cfg.replay_speed)
+            # commands that follow events forever are done when the
+            # trace is
+            if not d.called:
+                return
+        yield d
+
+    @defer.inlineCallbacks
+    def _startup(reactor):
+        if len(cfg.endpoints) == 1:
+            yield _connect_and_run(reactor, cfg.connect)
+            return
+
+        from . import fanout
+        failures = yield fanout.run_all(
+            reactor, cfg, cfg.endpoints,
+            lambda ep, reactor, on_connect, within: _connect_and_run(reactor, ep, on_connect, within),
+            cfg.concurrency,
+        )
+        if failures:
+            raise RuntimeError(
+                "{} of {} Tor instances failed".format(failures, len(cfg.endpoints))
+            )
 
+    _run_reactor(cfg, _startup)
+
+
+def _run_reactor(cfg, startup):
+    """
+    Runs the reactor until the Deferred returned by startup(reactor)
+    fires, and exits (with 1 if it failed).
+    """
     from twisted.internet import reactor
     codes = [0]
 
@@ -153,16 +381,52 @@ def _run_command(cmd, cfg, *args, **kwargs):
         codes[0] = 1
         return None
 
+    queue = None
+    real_stdout = sys.stdout
+    if cfg.output_queue > 0:
+        from .output import OutputQueue
+        if OutputQueue.suitable(real_stdout):
+            real_stdout.flush()
+            queue = OutputQueue(
+                reactor, real_stdout,
+                max_lines=cfg.output_queue,
+                policy=cfg.output_policy,
+                flush_interval=cfg.flush_interval,
+            )
+            sys.stdout = queue
+            cfg.log_observer.stdout = queue
+
     def _go():
-        d = _startup(reactor)
+        d = defer.maybeDeferred(startup, reactor)
         d.addErrback(_the_bad_stuff)
         d.addBoth(lambda _: reactor.stop())
 
     reactor.callWhenRunning(_go)
     reactor.run()
+    if queue is not None:
+        queue.close()
+        sys.stdout = real_stdout
+        cfg.log_observer.stdout = real_stdout
     sys.exit(codes[0])
 
 
+def _check_filter(expression, kinds):
+    """
+    Compiles a --filter expression now, so mistakes are usage errors
+    (the command itself compiles it again; that's cheap).
+    """
+    if expression is None:
+        return
+    from . import filters
+    try:
+        filters.Filter(expression, kinds)
+    except filters.FilterError as e:
+        raise click.BadParameter(str(e), param_hint='--filter')
+
+
+_FILTER_HELP = 'Only show events matching this expression, e.g. "purpose=HS_* and state=FAILED".'
+
+
 @carml.command()
 @click.option(
     '--package', '-p',
@@ -179,6 +443,7 @@ def check_pypi(cfg, package, revision):
     """
     Check a PyPI package hash across multiple circuits.
     """
+    from . import carml_check_pypi
     return _run_command(
         carml_check_pypi.run,
         cfg, package, revision,
@@ -224,6 +489,7 @@ def circ(cfg, if_unused, verbose, list, build, delete):
         raise click.UsageError(
             "Specify just one of --list, --build or --delete"
         )
+    from . import carml_circ
     return _run_command(
         carml_circ.run,
         cfg, if_unused, verbose, list, build, delete,
@@ -231,19 +497,35 @@ def circ(cfg, if_unused, verbose, list, build, delete):
 
 
 @carml.command()
+@click.option(
+    '--file', '-f',
+    help='Run each line of this file as a command.',
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    '--in-flight', '-j',
+    help='With "-" or --file, how many commands to have queued with Tor at once.',
+    default=16,
+    type=click.IntRange(1, None),
+)
 @click.argument(
     "command_args",
     nargs=-1,
 )
 @click.pass_obj
-def cmd(cfg, command_args):
+def cmd(cfg, file, in_flight, command_args):
     """
     Run the rest of the args as a Tor control command. For example
     "GETCONF SocksPort" or "GETINFO net/listeners/socks".
+
+    If the only argument is "-", read commands (one per line) from
+    stdin instead; replies are printed in the same order.
     """
+    from . import carml_cmd
     return _run_command(
         carml_cmd.run,
-        cfg, command_args,
+        cfg, command_args, file, in_flight,
     )
 
 
@@ -268,12 +550,25 @@ def cmd(cfg, command_args):
     help='Output this many events, and quit (default is unlimited).',
     type=int,
 )
+@click.option(
+    '--record', '-r',
+    help=('Also append the events (with timestamps) to this file, for '
+          '"carml replay". Compressed if it ends in ".gz".'),
+    default=None,
+    metavar='FILE',
+)
+@click.option(
+    '--filter',
+    default=None,
+    metavar='EXPR',
+    help=_FILTER_HELP,
+)
 @click.argument(
     "events",
     nargs=-1,
 )
 @click.pass_obj
-def events(cfg, list, once, show_event, count, events):
+def events(cfg, list, once, show_event, count, record, filter, events):
     """
     Follow any Tor events, listed as positional arguments.
     """
@@ -281,9 +576,11 @@ def events(cfg, list, once, show_event, count, events):
         raise click.UsageError(
             "Must specify at least one event"
         )
+    _check_filter(filter, ['raw'])
+    from . import carml_events
     return _run_command(
         carml_events.run,
-        cfg, list, once, show_event, count, events,
+        cfg, list, once, show_event, count, events, record, filter,
     )
 
 
@@ -298,12 +595,37 @@ def events(cfg, list, once, show_event, count, events):
     help='Follow stream creation.',
     is_flag=True,
 )
+@click.option(
+    '--top',
+    help='With --follow, print the N heaviest processes, targets and circuits every few seconds instead.',
+    type=click.IntRange(1, 1000),
+    default=None,
+    metavar='N',
+)
 @click.option(
     '--attach', '-a',
     help='Attach all new streams to a particular circuit-id.',
     type=int,
     default=None,
 )
+@click.option(
+    '--per-process', '-P',
+    help='Attach the streams of each local process to a circuit of its own.',
+    is_flag=True,
+)
+@click.option(
+    '--pool',
+    help='With --per-process, keep this many spare circuits built.',
+    type=click.IntRange(0, 100),
+    default=2,
+)
+@click.option(
+    '--policy',
+    help='Attach streams to circuits according to the isolation rules in FILE.',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    metavar='FILE',
+)
 @click.option(
     '--close', '-d',
     help='Delete/close a stream by its ID.',
@@ -315,20 +637,36 @@ def events(cfg, list, once, show_event, count, events):
     help='Show more details.',
     is_flag=True,
 )
+@click.option(
+    '--filter',
+    default=None,
+    metavar='EXPR',
+    help='With --follow, ' + _FILTER_HELP[0].lower() + _FILTER_HELP[1:],
+)
 @click.pass_context
-def stream(ctx, list, follow, attach, close, verbose):
+def stream(ctx, list, follow, top, attach, close, per_process, pool, policy, verbose, filter):
     """
     Manipulate Tor streams.
     """
     cfg = ctx.obj
-    if len([x for x in [list, follow, attach, close] if x]) != 1:
+    if len([x for x in [list, follow, attach, close, per_process, policy] if x]) != 1:
         click.echo(ctx.get_help())
         raise click.UsageError(
-            "Must specify one of --list, --follow, --attach or --close"
+            "Must specify one of --list, --follow, --attach, --per-process, --policy or --close"
         )
+    if top and not follow:
+        raise click.UsageError("--top only makes sense with --follow")
+    if policy:
+        from . import isolation
+        try:
+            isolation.load_policy(policy)
+        except isolation.PolicyError as e:
+            raise click.BadParameter(str(e), param_hint='--policy')
+    _check_filter(filter, ['stream'])
+    from . import carml_stream
     return _run_command(
         carml_stream.run,
-        cfg, list, follow, attach, close, verbose,
+        cfg, list, follow, attach, close, verbose, filter, per_process, pool, policy, top,
     )
 
 
@@ -369,16 +707,135 @@ def stream(ctx, list, follow, attach, close, verbose):
     type=click.Choice(LOG_LEVELS),
     multiple=True,
 )
+@click.option(
+    '--summary',
+    default=None,
+    type=float,
+    metavar='INTERVAL',
+    help='Instead of a line per event, print counts every INTERVAL seconds.',
+)
+@click.option(
+    '--metrics',
+    default=None,
+    metavar='LISTEN',
+    help='Serve Prometheus-style metrics over HTTP on LISTEN (a port on localhost, or a Twisted endpoint string).',
+)
+@click.option(
+    '--filter',
+    default=None,
+    metavar='EXPR',
+    help=_FILTER_HELP,
+)
 @click.pass_context
-def monitor(ctx, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level):
+def monitor(ctx, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level, summary, metrics, filter):
     """
     General information about a running Tor; streams, circuits,
     address-maps and event monitoring.
     """
     cfg = ctx.obj
+    if summary is not None and summary <= 0:
+        raise click.UsageError("--summary must be positive")
+    _check_filter(filter, ['circuit', 'stream', 'addrmap', 'log'])
+    from . import carml_monitor
     return _run_command(
         carml_monitor.run,
-        cfg, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level,
+        cfg, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level, summary, metrics, filter,
+    )
+
+
+@carml.command()
+@click.option(
+    '--socket', '-s',
+    help='Unix socket to listen on (default: --daemon-socket).',
+    default=None,
+    metavar='PATH',
+)
+@click.pass_context
+def daemon(ctx, socket):
+    """
+    Keep one connection (and live state) to Tor, and answer other
+    carml invocations over a unix socket.
+
+    Run other commands with --daemon-socket (or set
+    CARML_DAEMON_SOCKET) to use it. Commands which only read the
+    current state (circ --list, stream --list, relay --info, relay
+    --list, monitor --once and tmux) are answered from the daemon's
+    state; anything else runs as normal.
+    """
+    cfg = ctx.obj
+    socket = socket or cfg.daemon_socket
+    if not socket:
+        raise click.UsageError(
+            "Specify --socket (or the global --daemon-socket option)"
+        )
+    # we don't want to try to talk to ourselves
+    cfg.daemon_socket = None
+    from . import carml_daemon
+    return _run_command(
+        carml_daemon.run,
+        cfg, socket,
+    )
+
+
+@carml.command(name='fake-tor')
+@click.option(
+    '--listen', '-l',
+    help='Endpoint to listen on.',
+    default='tcp:9052:interface=127.0.0.1',
+    metavar='ENDPOINT',
+)
+@click.option(
+    '--relays',
+    help='How many relays are in the (made-up) consensus.',
+    default=7000,
+)
+@click.option(
+    '--circuits',
+    help='How many circuits to (try to) keep open.',
+    default=20,
+)
+@click.option(
+    '--streams',
+    help='How many streams to (try to) keep open.',
+    default=10,
+)
+@click.option(
+    '--circ-rate',
+    help='New circuits per second.',
+    default=1.0,
+)
+@click.option(
+    '--stream-rate',
+    help='New streams per second.',
+    default=1.0,
+)
+@click.option(
+    '--bw-rate',
+    help='BW (and STREAM_BW) events per second.',
+    default=1.0,
+)
+@click.option(
+    '--seed',
+    help='Random seed, for repeatable relays and events.',
+    default=0,
+)
+@click.pass_context
+def fake_tor(ctx, listen, relays, circuits, streams, circ_rate, stream_rate, bw_rate, seed):
+    """
+    Pretend to be a Tor control-port, for testing and benchmarking.
+
+    Point other carml commands at it with --connect. It makes up a
+    consensus, circuits and streams, and sends CIRC, STREAM, ADDRMAP,
+    BW and STREAM_BW events at the given rates.
+    """
+    cfg = ctx.obj
+    from . import carml_faketor
+    return _run_reactor(
+        cfg,
+        lambda reactor: carml_faketor.run(
+            reactor, cfg, listen, relays, circuits, streams,
+            circ_rate, stream_rate, bw_rate, seed,
+        ),
     )
 
 
@@ -390,6 +847,7 @@ def newid(ctx):
     acknowledgement.
     """
     cfg = ctx.obj
+    from . import carml_newid
     return _run_command(
         carml_newid.run,
         cfg,
@@ -440,6 +898,7 @@ def pastebin(ctx, dry_run, once, file, count, keys):
         )
 
     cfg = ctx.obj
+    from . import carml_pastebin
     return _run_command(
         carml_pastebin.run,
         cfg, dry_run, once, file, count, keys,
@@ -472,6 +931,7 @@ def relay(ctx, list, info, await):
             "Require one of --list, --info, --await"
         )
     cfg = ctx.obj
+    from . import carml_relay
     return _run_command(
         carml_relay.run,
         cfg, list, info, await,
@@ -526,6 +986,7 @@ def tbb(ctx, beta, alpha, use_clearnet, system_keychain, no_extract, no_launch):
             )
 
     cfg = ctx.obj
+    from . import carml_tbb
     return _run_command(
         carml_tbb.run,
         cfg, beta, alpha, use_clearnet, system_keychain, no_extract, no_launch,
@@ -568,12 +1029,39 @@ def temphs(ctx, port):
             _range_check(p)
 
     cfg = ctx.obj
+    from . import carml_temphs
     return _run_command(
         carml_temphs.run,
         cfg, list(port),
     )
 
 
+@carml.command()
+@click.option(
+    '--sort', '-s',
+    help='What to sort circuits and streams by at first (press a, b or p to change).',
+    type=click.Choice(['age', 'bytes', 'purpose']),
+    default='age',
+)
+@click.option(
+    '--fps',
+    help='Redraw at most this many times a second.',
+    type=click.IntRange(1, 60),
+    default=4,
+)
+@click.pass_context
+def top(ctx, sort, fps):
+    """
+    Full-screen live view of circuits, streams, bandwidth and guards.
+    """
+    cfg = ctx.obj
+    from . import carml_top
+    return _run_command(
+        carml_top.run,
+        cfg, sort, fps,
+    )
+
+
 @carml.command()
 @click.pass_context
 def tmux(ctx):
@@ -588,6 +1076,7 @@ def tmux(ctx):
         set -g status-interval 2
     """
     cfg = ctx.obj
+    from . import carml_tmux
     return _run_command(
         carml_tmux.run,
         cfg,
@@ -627,6 +1116,7 @@ def xplanet(ctx, all, execute, follow, arc_file, file):
     """
     """
     cfg = ctx.obj
+    from . import carml_xplanet
     return _run_command(
         carml_xplanet.run,
         cfg, all, execute, follow, arc_file, file,
@@ -647,6 +1137,7 @@ def copybin(ctx, service):
     Download something from a "pastebin" hidden-service.
     """
     cfg = ctx.obj
+    from . import carml_copybin
     return _run_command(
         carml_copybin.run,
         cfg, service,
@@ -659,18 +1150,96 @@ def copybin(ctx, service):
     help='Maximum scale, in bytes.',
     default=1024 * 20,
 )
+@click.option(
+    '--record', '-r',
+    help='Also save bandwidth to the history file (see --store).',
+    is_flag=True,
+)
+@click.option(
+    '--history',
+    help='Draw recorded bandwidth, one line per second, minute or hour (no Tor needed).',
+    type=click.Choice(['second', 'minute', 'hour']),
+    default=None,
+)
+@click.option(
+    '--store',
+    help='The bandwidth history file (default: one per --connect endpoint, in ~/.local/share/carml).',
+    type=click.Path(dir_okay=False),
+    default=None,
+    metavar='FILE',
+)
 @click.pass_context
-def graph(ctx, max):
+def graph(ctx, max, record, history, store):
     """
     A nice coloured console bandwidth-graph.
     """
     cfg = ctx.obj
+    from . import carml_graph, rrd
+    if record and history:
+        raise click.UsageError("--record and --history can't be used together")
+    if (record or history) and store is None:
+        if len(cfg.endpoints) > 1:
+            raise click.UsageError("With several --connect endpoints, give --store")
+        store = rrd.default_store(cfg.connect)
+    if history:
+        try:
+            return carml_graph.show_history(store, history, max)
+        except rrd.StoreError as e:
+            raise click.ClickException(str(e))
     return _run_command(
         carml_graph.run,
-        cfg, max,
+        cfg, max, store if record else None,
     )
 
 
+@carml.command(
+    context_settings=dict(
+        ignore_unknown_options=True,
+        allow_interspersed_args=False,
+    ),
+)
+@click.option(
+    '--speed', '-s',
+    help='Replay this many times faster than recorded; 0 means as fast as possible.',
+    default=1.0,
+    type=float,
+)
+@click.argument(
+    'trace',
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.argument(
+    'command',
+    type=click.Choice(['monitor', 'graph', 'stream', 'xplanet', 'events', 'circ', 'relay', 'tmux']),
+)
+@click.argument(
+    'command_args',
+    nargs=-1,
+    type=click.UNPROCESSED,
+)
+@click.pass_context
+def replay(ctx, speed, trace, command, command_args):
+    """
+    Run a command against a trace recorded with "carml events
+    --record" instead of a live Tor. For example: "carml replay
+    trace.gz monitor --verbose".
+    """
+    if speed < 0:
+        raise click.UsageError(
+            "--speed must be positive"
+        )
+    cfg = ctx.obj
+    cfg.replay = trace
+    cfg.replay_speed = speed
+    cfg.daemon_socket = None
+    cfg.endpoints = [trace]
+
+    cmd = carml.get_command(ctx, command)
+    sub_ctx = cmd.make_context(command, list(command_args), parent=ctx)
+    with sub_ctx:
+        return cmd.invoke(sub_ctx)
+
+
 @carml.command()
 @click.argument(
     'what'
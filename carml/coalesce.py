@@ -0,0 +1,147 @@
+'''
+Coalescing of GETINFO and GETCONF requests.
+
+Tor answers "GETINFO a b c" in one round-trip, but our commands (and
+"carml cmd -") tend to ask for one key at a time. CoalescingProtocol
+collects all the get_info() (and get_conf()) calls made during one
+reactor iteration, sends them as a single request and hands each
+caller just the keys it asked for. Over a slow (e.g. ssh-tunnelled)
+control connection this saves a round-trip per call.
+
+Anything else sent through the wrapper first sends whatever is
+waiting, so commands still reach Tor in the order they were made
+(e.g. "GETINFO a", "SETCONF x=y", "GETINFO b" from "carml cmd -").
+'''
+
+from __future__ import print_function
+
+import functools
+
+from zope.interface import implementer
+from twisted.internet import defer
+
+from txtorcon.interface import ITorControlProtocol
+
+
+@implementer(ITorControlProtocol)
+class CoalescingProtocol(object):
+    '''
+    Wraps a TorControlProtocol; get_info() and get_conf() are
+    coalesced and everything else is passed straight through.
+    '''
+
+    def __init__(self, reactor, protocol):
+        self._reactor = reactor
+        self._protocol = protocol
+        self._waiting = dict(info=[], conf=[])  # lists of (keys, Deferred)
+        self._scheduled = None  # DelayedCall of _send, if any
+        #: how many get_info/get_conf calls we got, and how many
+        #: requests we actually made
+        self.calls = 0
+        self.requests = 0
+
+    def get_info(self, *keys):
+        return self._queue('info', keys)
+
+    def get_conf(self, *keys):
+        return self._queue('conf', keys)
+
+    def __getattr__(self, name):
+        attr = getattr(self._protocol, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def in_order(*args, **kw):
+            self.flush()
+            return attr(*args, **kw)
+        return in_order
+
+    def flush(self):
+        '''
+        Sends any waiting get_info/get_conf calls now.
+        '''
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+            self._send()
+
+    def _queue(self, kind, keys):
+        self.calls += 1
+        d = defer.Deferred()
+        self._waiting[kind].append((keys, d))
+        if self._scheduled is None:
+            self._scheduled = self._reactor.callLater(0, self._send)
+        return d
+
+    def _send(self):
+        self._scheduled = None
+        for (kind, method) in [('info', self._protocol.get_info), ('conf', self._protocol.get_conf)]:
+            waiters = self._waiting[kind]
+            self._waiting[kind] = []
+            if not waiters:
+                continue
+            self.requests += 1
+            if len(waiters) == 1:
+                keys, d = waiters[0]
+                method(*keys).chainDeferred(d)
+                continue
+
+            all_keys = []
+            for (keys, _) in waiters:
+                all_keys.extend(k for k in keys if k not in all_keys)
+            d = method(*all_keys)
+            d.addCallbacks(
+                self._split, self._separately,
+                callbackArgs=(method, waiters),
+                errbackArgs=(method, waiters),
+            )
+
+    def _split(self, answers, method, waiters):
+        # Tor answers with its own spelling of each key ("getconf
+        # socksport" gets "SocksPort=..."), which is what callers get
+        # when we don't coalesce, too
+        spelled = dict((k.lower(), k) for k in answers)
+        unmatched = set(answers)
+        short = []  # callers missing a key; Tor answered with others
+        for (keys, d) in waiters:
+            found = [spelled[k.lower()] for k in keys if k.lower() in spelled]
+            unmatched.difference_update(found)
+            if len(found) < len(keys):
+                short.append((keys, d, found))
+            else:
+                d.callback(dict((k, answers[k]) for k in found))
+
+        # some keys expand to others (e.g. "getconf
+        # HiddenServiceOptions" answers HiddenServiceDir=...); when
+        # only one caller can have asked for them, they're its
+        if len(short) == 1:
+            keys, d, found = short[0]
+            found.extend(sorted(unmatched))
+            d.callback(dict((k, answers[k]) for k in found))
+        elif short:
+            self._separately(None, method, [(keys, d) for (keys, d, _) in short])
+
+    def _separately(self, fail, method, waiters):
+        # Tor fails the whole request if any key is bad, so ask again
+        # one caller at a time; then only the bad one gets an error
+        for (keys, d) in waiters:
+            self.requests += 1
+            method(*keys).chainDeferred(d)
+
+
+class CoalescingTor(object):
+    '''
+    Stands in for a txtorcon.Tor instance, with a CoalescingProtocol
+    as its protocol.
+    '''
+
+    def __init__(self, reactor, tor):
+        self._tor = tor
+        self.protocol = CoalescingProtocol(reactor, tor.protocol)
+
+    @property
+    def proto(self):
+        return self.protocol
+
+    def __getattr__(self, name):
+        return getattr(self._tor, name)
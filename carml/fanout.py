@@ -0,0 +1,126 @@
+'''
+Running a single carml command against many Tor instances at once
+(i.e. when --connect is given more than once).
+
+All the commands simply print() their output, so to tag each line
+with the instance it came from we replace sys.stdout with an
+output.Switch, and give each instance a TaggedOutput writer that is
+made current whenever its control connection delivers data, and
+around its timers and its connection attempt (everything a command
+does happens in reaction to one of those).
+'''
+
+from __future__ import print_function
+
+import sys
+import functools
+
+from twisted.internet import defer
+
+from carml import util
+from carml import output
+
+
+def read_endpoints(connect):
+    """
+    Expands a list of --connect arguments into a list of endpoint
+    strings; an argument starting with "@" is a file containing one
+    endpoint per line (blank lines and "#" comments are ignored).
+    """
+    endpoints = []
+    for arg in connect:
+        if arg.startswith('@'):
+            with open(arg[1:], 'r') as f:
+                for line in f.readlines():
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        endpoints.append(line)
+        else:
+            endpoints.append(arg)
+    return endpoints
+
+
+class TaggedOutput(object):
+    '''
+    A file-like object that prefixes every complete line with one
+    instance's tag.
+    '''
+
+    def __init__(self, out, tag):
+        self._out = out
+        self._tag = tag
+        self._partial = ''
+
+    def write(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._out.write(util.colors.cyan(self._tag) + ' ' + line + '\n')
+
+    def flush(self):
+        self._out.flush()
+
+    def close(self):
+        if self._partial:
+            self.write('\n')
+        self.flush()
+
+
+def _tag_protocol(switch, writer, proto):
+    '''
+    Make output from anything that happens due to data arriving on
+    this control-connection get tagged.
+    '''
+    proto.dataReceived = switch.wrap(writer, proto.dataReceived)
+
+
+@defer.inlineCallbacks
+def run_all(reactor, cfg, endpoints, connect_and_run, concurrency):
+    """
+    Calls ``connect_and_run(endpoint, reactor, on_connect, within)``
+    for each endpoint, at most ``concurrency`` at once (0 means no
+    limit), and returns the number that failed. The command should be
+    run with the reactor given (whose timers tag their output),
+    ``on_connect`` must be called with the txtorcon.Tor instance as
+    soon as there is one and ``within(d)`` returns a Deferred like d
+    whose callbacks get tagged (for the connection attempt).
+    """
+    real_stdout = sys.stdout
+    switch = output.Switch(real_stdout)
+    writers = dict((tag, TaggedOutput(real_stdout, tag)) for tag in endpoints)
+    if concurrency <= 0:
+        concurrency = len(endpoints)
+    semaphore = defer.DeferredSemaphore(concurrency)
+    failures = [0]
+
+    def _on_connect(tag, tor):
+        _tag_protocol(switch, writers[tag], tor.protocol)
+
+    def _failed(tag, fail):
+        print(util.colors.red('Error: ') + fail.getErrorMessage(), file=writers[tag])
+        if cfg.debug:
+            print(fail.getTraceback(), file=writers[tag])
+        failures[0] += 1
+
+    def _one(tag):
+        writer = writers[tag]
+        return switch.call(
+            writer, connect_and_run, tag,
+            output.SwitchedReactor(reactor, switch, writer),
+            functools.partial(_on_connect, tag),
+            functools.partial(switch.deferred, writer),
+        )
+
+    sys.stdout = switch
+    try:
+        runs = []
+        for tag in endpoints:
+            d = semaphore.run(_one, tag)
+            d.addErrback(functools.partial(_failed, tag))
+            runs.append(d)
+        yield defer.DeferredList(runs)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        sys.stdout = real_stdout
+    defer.returnValue(failures[0])
@@ -0,0 +1,387 @@
+'''
+``--filter`` expressions, like::
+
+    purpose=HS_* and state=FAILED
+    target_port in (443, 80) and host~=\\.onion$
+    not (event=closed or reason=DONE)
+
+An expression is parsed and compiled once into a Python function per
+kind of event (circuit, stream, ...), which is called with the event
+*before* we do any formatting, colouring or process lookups -- so
+filtered-out events cost very little.
+
+Comparisons are ``field=value`` (may contain * and ? wildcards),
+``field!=value``, ``field~=regex``, ``field in (a, b, c)`` and the
+numeric ``<``, ``<=``, ``>`` and ``>=``; ``=``, ``!=`` and ``in``
+ignore case. Combine them with ``and``, ``or``, ``not`` and
+parentheses. Values containing spaces, commas, parentheses or quotes
+must be quoted.
+'''
+
+from __future__ import print_function
+
+import re
+import fnmatch
+import operator
+import collections
+
+#: what our filter functions see; kind is "circuit", "stream" etc,
+#: event is the listener method without its prefix ("built",
+#: "attach", ...) and kw are its keyword arguments
+Event = collections.namedtuple('Event', ['kind', 'event', 'subject', 'kw'])
+
+
+class FilterError(ValueError):
+    pass
+
+
+def _path(event):
+    return getattr(event.subject, 'path', None) or []
+
+
+def _router(index):
+    def get(event):
+        path = _path(event)
+        if not path:
+            return None
+        return path[index].name or path[index].id_hex
+    return get
+
+
+def _circuit_id(event):
+    circuit = getattr(event.subject, 'circuit', None)
+    return circuit.id if circuit else None
+
+
+def _reason(event):
+    return event.kw.get('REASON', event.kw.get('reason', None))
+
+
+def _remote_reason(event):
+    return event.kw.get('REMOTE_REASON', event.kw.get('remote_reason', None))
+
+
+_COMMON = dict(
+    type=lambda e: e.kind,
+    event=lambda e: e.event,
+)
+
+#: the fields each kind of event has
+FIELDS = dict(
+    circuit=dict(
+        _COMMON,
+        id=lambda e: e.subject.id,
+        state=lambda e: e.subject.state,
+        purpose=lambda e: e.subject.purpose,
+        hops=lambda e: len(_path(e)),
+        guard=_router(0),
+        exit=_router(-1),
+        reason=_reason,
+        remote_reason=_remote_reason,
+    ),
+    stream=dict(
+        _COMMON,
+        id=lambda e: e.subject.id,
+        state=lambda e: e.subject.state,
+        host=lambda e: e.subject.target_host,
+        target_host=lambda e: e.subject.target_host,
+        target_addr=lambda e: e.subject.target_addr,
+        target_port=lambda e: e.subject.target_port,
+        port=lambda e: e.subject.target_port,
+        source_addr=lambda e: e.subject.source_addr,
+        source_port=lambda e: e.subject.source_port,
+        circuit=_circuit_id,
+        purpose=lambda e: e.subject.flags.get('PURPOSE', None),
+        socks_username=lambda e: e.subject.flags.get('SOCKS_USERNAME', None),
+        reason=_reason,
+        remote_reason=_remote_reason,
+    ),
+    addrmap=dict(
+        _COMMON,
+        # addrmap_added gets an Addr, addrmap_expired just the name
+        name=lambda e: getattr(e.subject, 'name', e.subject),
+        host=lambda e: getattr(e.subject, 'name', e.subject),
+        ip=lambda e: getattr(e.subject, 'ip', None),
+    ),
+    log=dict(
+        _COMMON,
+        level=lambda e: e.event,
+        message=lambda e: e.subject,
+    ),
+)
+
+
+def _keyword(name):
+    '''
+    For raw events ("carml events"): FOO=bar pairs in the event
+    text, so e.g. "purpose=HS_*" works on CIRC events.
+    '''
+    pattern = re.compile(r'(?:^|\s){}=("[^"]*"|\S*)'.format(re.escape(name.upper())))
+
+    def get(event):
+        m = pattern.search(event.subject)
+        if m is None:
+            return None
+        return m.group(1).strip('"')
+    return get
+
+
+#: raw event text, with any other field name looked up by _keyword
+RAW_FIELDS = dict(
+    _COMMON,
+    data=lambda e: e.subject,
+)
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<op>~=|!=|<=|>=|=|<|>|\(|\)|,)
+      | (?P<word>[^\s(),=!<>~"']+)
+    )''', re.VERBOSE)
+
+_COMPARISONS = ('=', '!=', '~=', '<', '<=', '>', '>=', 'in')
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if m is None:
+            raise FilterError('Cannot parse filter at "{}"'.format(text[pos:].strip()))
+        pos = m.end()
+        if m.group('string') is not None:
+            s = m.group('string')
+            tokens.append(('value', re.sub(r'\\(.)', r'\1', s[1:-1])))
+        elif m.group('op') is not None:
+            tokens.append(('op', m.group('op')))
+        else:
+            word = m.group('word')
+            if word.lower() in ('and', 'or', 'not', 'in'):
+                tokens.append(('op', word.lower()))
+            else:
+                tokens.append(('value', word))
+    return tokens
+
+
+class _Parser(object):
+    '''
+    Recursive-descent parser turning tokens into nested tuples:
+    ('or', a, b), ('and', a, b), ('not', a) and
+    ('compare', field, op, value).
+    '''
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._pos = 0
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _next(self, expected=None):
+        token = self._peek()
+        if token[0] is None:
+            raise FilterError('Filter ends too soon')
+        if expected is not None and token != ('op', expected):
+            raise FilterError('Expected "{}" but got "{}"'.format(expected, token[1]))
+        self._pos += 1
+        return token
+
+    def parse(self):
+        tree = self._or()
+        if self._peek()[0] is not None:
+            raise FilterError('Unexpected "{}" in filter'.format(self._peek()[1]))
+        return tree
+
+    def _or(self):
+        tree = self._and()
+        while self._peek() == ('op', 'or'):
+            self._next()
+            tree = ('or', tree, self._and())
+        return tree
+
+    def _and(self):
+        tree = self._not()
+        while self._peek() == ('op', 'and'):
+            self._next()
+            tree = ('and', tree, self._not())
+        return tree
+
+    def _not(self):
+        if self._peek() == ('op', 'not'):
+            self._next()
+            return ('not', self._not())
+        if self._peek() == ('op', '('):
+            self._next()
+            tree = self._or()
+            self._next(')')
+            return tree
+        return self._comparison()
+
+    def _comparison(self):
+        kind, field = self._next()
+        if kind != 'value':
+            raise FilterError('Expected a field name but got "{}"'.format(field))
+        kind, op = self._next()
+        if kind != 'op' or op not in _COMPARISONS:
+            raise FilterError('Expected a comparison after "{}" but got "{}"'.format(field, op))
+        if op != 'in':
+            kind, value = self._next()
+            if kind != 'value':
+                raise FilterError('Expected a value after "{}{}"'.format(field, op))
+            return ('compare', field.lower(), op, value)
+
+        values = []
+        self._next('(')
+        while True:
+            kind, value = self._next()
+            if kind != 'value':
+                raise FilterError('Expected a value in "{} in (...)"'.format(field))
+            values.append(value)
+            token = self._next()
+            if token == ('op', ')'):
+                break
+            if token != ('op', ','):
+                raise FilterError('Expected "," or ")" but got "{}"'.format(token[1]))
+        return ('compare', field.lower(), op, tuple(values))
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf8', 'replace')
+    return u'{}'.format(value)
+
+
+def _test(op, value):
+    '''
+    Returns a function of one (field) value for the comparison.
+    '''
+    if op in ('=', '!='):
+        if any(c in value for c in '*?['):
+            match = re.compile(fnmatch.translate(value), re.IGNORECASE).match
+
+            def test(v):
+                return match(_text(v)) is not None
+        else:
+            value = value.lower()
+
+            def test(v):
+                return _text(v).lower() == value
+        if op == '!=':
+            return lambda v: v is None or not test(v)
+        return lambda v: v is not None and test(v)
+
+    if op == 'in':
+        values = frozenset(v.lower() for v in value)
+        return lambda v: v is not None and _text(v).lower() in values
+
+    if op == '~=':
+        try:
+            search = re.compile(value).search
+        except re.error as e:
+            raise FilterError('Bad regular expression "{}": {}'.format(value, e))
+        return lambda v: v is not None and search(_text(v)) is not None
+
+    try:
+        number = float(value)
+    except ValueError:
+        raise FilterError('"{}" needs a number, not "{}"'.format(op, value))
+    compare = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}[op]
+
+    def numeric(v):
+        try:
+            return compare(float(v), number)
+        except (TypeError, ValueError):
+            return False
+    return numeric
+
+
+def _compile(tree, fields):
+    what = tree[0]
+    if what == 'and':
+        a, b = _compile(tree[1], fields), _compile(tree[2], fields)
+        return lambda e: a(e) and b(e)
+    if what == 'or':
+        a, b = _compile(tree[1], fields), _compile(tree[2], fields)
+        return lambda e: a(e) or b(e)
+    if what == 'not':
+        a = _compile(tree[1], fields)
+        return lambda e: not a(e)
+
+    _, field, op, value = tree
+    test = _test(op, value)
+    if fields is RAW_FIELDS and field not in fields:
+        get = _keyword(field)
+    elif field in fields:
+        get = fields[field]
+    else:
+        # this kind of event doesn't have that field
+        return lambda e: test(None)
+
+    def compare(event):
+        try:
+            v = get(event)
+        except (AttributeError, IndexError, KeyError):
+            v = None
+        return test(v)
+    return compare
+
+
+def _fields_of(tree):
+    if tree[0] == 'compare':
+        return set([tree[1]])
+    return set().union(*[_fields_of(t) for t in tree[1:]])
+
+
+class Filter(object):
+    '''
+    A compiled --filter expression. ``kinds`` are the kinds of
+    events the command has (keys of FIELDS, or "raw"); using a field
+    none of them have is an error.
+    '''
+
+    def __init__(self, expression, kinds):
+        self.expression = expression
+        tree = _Parser(_tokenize(expression)).parse()
+        tables = dict((k, RAW_FIELDS if k == 'raw' else FIELDS[k]) for k in kinds)
+        if 'raw' not in kinds:
+            known = set()
+            for table in tables.values():
+                known.update(table.keys())
+            unknown = _fields_of(tree) - known
+            if unknown:
+                raise FilterError('Unknown field(s) in filter: {} (known: {})'.format(
+                    ', '.join(sorted(unknown)), ', '.join(sorted(known))))
+        self._predicates = dict((k, _compile(tree, t)) for (k, t) in tables.items())
+
+    def matches(self, kind, event, subject, kw=None):
+        return self._predicates[kind](Event(kind, event, subject, kw or {}))
+
+
+def filtered_listener(flt, listener):
+    '''
+    Makes the circuit_*, stream_* and addrmap_* methods of listener
+    skip any event flt doesn't match. Returns the listener.
+    '''
+    if flt is None:
+        return listener
+    for attr in dir(listener):
+        kind, _, event = attr.partition('_')
+        if kind not in ('circuit', 'stream', 'addrmap') or not event:
+            continue
+        method = getattr(listener, attr)
+        if callable(method):
+            setattr(listener, attr, _filtered(flt, kind, event, method))
+    return listener
+
+
+def _filtered(flt, kind, event, method):
+    predicate = flt._predicates[kind]
+
+    def filtered(subject, *args, **kw):
+        if predicate(Event(kind, event, subject, kw)):
+            return method(subject, *args, **kw)
+    return filtered
@@ -0,0 +1,274 @@
+'''
+Offline country, ASN and latitude/longitude lookups.
+
+txtorcon finds a router's country either with a GeoIP library (if
+installed) or by asking Tor ("GETINFO ip-to-country/..."), one router
+at a time. Instead, we load Tor's own geoip and geoip6 files (or
+MaxMind's CSV files) once into sorted arrays of address ranges; a
+lookup is then a bisect, with no network or control-port traffic.
+
+Understood formats:
+
+ * Tor's ``geoip`` (``1234,5678,US``) and ``geoip6``
+   (``2001:db8::,2001:db8::ffff,US``);
+ * MaxMind's legacy CSVs (``GeoIPCountryWhois.csv`` and
+   ``GeoIPASNum2.csv``);
+ * GeoLite2 "Blocks" CSVs (Country, City or ASN). For Country and
+   City, the ``*-Locations-en.csv`` next to them is used for the
+   country-codes, and City gets us latitude/longitude too.
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import csv
+import glob
+import array
+import socket
+import struct
+import bisect
+
+#: where Tor usually installs its geoip files
+DEFAULT_FILES = [
+    '/usr/share/tor/geoip',
+    '/usr/share/tor/geoip6',
+    '/usr/local/share/tor/geoip',
+    '/usr/local/share/tor/geoip6',
+    '/opt/homebrew/share/tor/geoip',
+    '/opt/homebrew/share/tor/geoip6',
+]
+
+_COUNTRY = re.compile(r'^[A-Z?]{2}$')
+
+_files = None
+_shared = None
+
+
+def address(ip):
+    '''
+    Returns (4 or 6, integer) for an IP address string, or None.
+    '''
+    try:
+        packed = socket.inet_pton(socket.AF_INET, ip)
+        return 4, struct.unpack('!I', packed)[0]
+    except (socket.error, TypeError, ValueError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip.strip('[]'))
+    except (socket.error, TypeError, ValueError, AttributeError):
+        return None
+    high, low = struct.unpack('!QQ', packed)
+    return 6, (high << 64) | low
+
+
+def _network(cidr):
+    '''
+    "10.0.0.0/8" -> (4, low, high)
+    '''
+    ip, _, bits = cidr.partition('/')
+    version, low = address(ip)
+    width = 32 if version == 4 else 128
+    span = (1 << (width - int(bits or width))) - 1
+    low &= ~span
+    return version, low, low | span
+
+
+class RangeIndex(object):
+    '''
+    Sorted, non-overlapping address ranges (from one file) and a
+    value for each. IPv4 ranges live in compact arrays; IPv6
+    addresses don't fit in an array so they're plain lists of ints.
+    '''
+
+    def __init__(self, version):
+        self._version = version
+        self._pending = []
+        self._lows = self._highs = self._which = None
+        self._values = []
+        self._value_index = {}
+
+    def add(self, low, high, value):
+        try:
+            which = self._value_index[value]
+        except KeyError:
+            which = self._value_index[value] = len(self._values)
+            self._values.append(value)
+        self._pending.append((low, high, which))
+
+    def _finish(self):
+        ranges = self._pending
+        self._pending = []
+        if self._lows is not None:
+            ranges.extend(zip(self._lows, self._highs, self._which))
+        ranges.sort()
+        if self._version == 4:
+            self._lows = array.array('I', (r[0] for r in ranges))
+            self._highs = array.array('I', (r[1] for r in ranges))
+        else:
+            self._lows = [r[0] for r in ranges]
+            self._highs = [r[1] for r in ranges]
+        self._which = array.array('I', (r[2] for r in ranges))
+
+    def lookup(self, ip):
+        if self._pending or self._lows is None:
+            self._finish()
+        i = bisect.bisect_right(self._lows, ip) - 1
+        if i >= 0 and ip <= self._highs[i]:
+            return self._values[self._which[i]]
+        return None
+
+    def __len__(self):
+        return len(self._pending) + (len(self._lows) if self._lows is not None else 0)
+
+
+class GeoIPIndex(object):
+    '''
+    country(), asn() and latlng() for IPv4 and IPv6 addresses, from
+    whatever files were load()-ed. Ranges from different files may
+    overlap (e.g. Tor's geoip and MaxMind's, or two copies of Tor's),
+    so each file gets its own RangeIndex and they are asked in the
+    order loaded; the first answer wins.
+    '''
+
+    def __init__(self):
+        self._tables = {}       # (kind, 4 or 6) -> list of RangeIndex, one per file
+        self._loading = {}      # (kind, 4 or 6) -> RangeIndex for the file being loaded
+        self.files = []
+
+    def _table(self, kind, version):
+        try:
+            return self._loading[(kind, version)]
+        except KeyError:
+            table = self._loading[(kind, version)] = RangeIndex(version)
+            self._tables.setdefault((kind, version), []).append(table)
+            return table
+
+    def _lookup(self, kind, ip):
+        addr = address(ip)
+        if addr is None:
+            return None
+        for table in self._tables.get((kind, addr[0]), ()):
+            value = table.lookup(addr[1])
+            if value is not None:
+                return value
+        return None
+
+    def country(self, ip):
+        return self._lookup('country', ip)
+
+    def asn(self, ip):
+        return self._lookup('asn', ip)
+
+    def latlng(self, ip):
+        return self._lookup('latlng', ip)
+
+    def load(self, fname):
+        self._loading = {}
+        with open(fname, 'r') as f:
+            first = f.readline()
+            f.seek(0)
+            if first.startswith('network,'):
+                self._load_blocks(fname, csv.DictReader(f))
+            else:
+                self._load_ranges(f)
+        self.files.append(fname)
+
+    def _add_value(self, version, low, high, value):
+        if _COUNTRY.match(value):
+            if value != '??':
+                self._table('country', version).add(low, high, value)
+        elif value:
+            self._table('asn', version).add(low, high, value)
+
+    def _load_ranges(self, f):
+        for row in csv.reader(line for line in f if not line.startswith('#')):
+            if len(row) == 3:
+                # Tor's geoip / geoip6, or MaxMind's legacy ASN file
+                if ':' in row[0]:
+                    version, low = address(row[0])
+                    high = address(row[1])[1]
+                else:
+                    version, low, high = 4, int(row[0]), int(row[1])
+                self._add_value(version, low, high, row[2])
+            elif len(row) >= 5 and row[2].isdigit():
+                # MaxMind's legacy country file
+                self._add_value(4, int(row[2]), int(row[3]), row[4])
+
+    def _load_blocks(self, fname, reader):
+        countries = {}
+        if 'geoname_id' in reader.fieldnames:
+            pattern = os.path.join(os.path.dirname(fname), '*-Locations-en.csv')
+            for locations in glob.glob(pattern):
+                with open(locations, 'r') as f:
+                    for row in csv.DictReader(f):
+                        countries[row['geoname_id']] = row.get('country_iso_code', '')
+
+        for row in reader:
+            version, low, high = _network(row['network'])
+            country = countries.get(row.get('geoname_id') or row.get('registered_country_geoname_id'))
+            if country:
+                self._table('country', version).add(low, high, country)
+            if row.get('autonomous_system_number'):
+                asn = 'AS{} {}'.format(
+                    row['autonomous_system_number'], row.get('autonomous_system_organization', ''),
+                )
+                self._table('asn', version).add(low, high, asn.strip())
+            if row.get('latitude') and row.get('longitude'):
+                latlng = (float(row['latitude']), float(row['longitude']))
+                self._table('latlng', version).add(low, high, latlng)
+
+
+def configure(files):
+    '''
+    Use these files instead of looking for Tor's (for "carml
+    --geoip").
+    '''
+    global _files, _shared
+    _files = list(files)
+    _shared = None
+
+
+def shared():
+    '''
+    The GeoIPIndex all commands share, loaded on first use.
+    '''
+    global _shared
+    if _shared is None:
+        _shared = GeoIPIndex()
+        for fname in (_files if _files is not None else DEFAULT_FILES):
+            if _files is None and not os.path.exists(fname):
+                continue
+            _shared.load(fname)
+    return _shared
+
+
+def loaded():
+    '''
+    True if the shared index is already loaded, or "--geoip" asked
+    for one. Loading Tor's files takes most of a second, which
+    one-shot commands that only look up a few routers (like "carml
+    tmux") shouldn't pay unless asked to.
+    '''
+    return _shared is not None or _files is not None
+
+
+def router_country(router):
+    '''
+    A router's country-code from our index, falling back to whatever
+    txtorcon already knows.
+    '''
+    cc = shared().country(router.ip)
+    if cc is None and router.location is not None:
+        return router.location.countrycode
+    return cc
+
+
+def router_latlng(router):
+    '''
+    (latitude, longitude) for a router, or (None, None).
+    '''
+    latlng = shared().latlng(router.ip)
+    if latlng is None and router.location is not None:
+        return router.location.latlng
+    return latlng or (None, None)
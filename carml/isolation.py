@@ -0,0 +1,297 @@
+'''
+Stream isolation driven by a policy file ("carml stream --policy").
+
+Each new stream is matched against the policy's rules; the first
+matching rule says which of the stream's properties ("keys") to
+isolate by, and every distinct combination of those gets its own
+circuit. A policy file looks like::
+
+    # how many spare circuits to keep built
+    pool 4
+    # remember at most this many keys, forgetting idle ones after
+    # this many seconds (their circuits are closed)
+    max-keys 1000
+    idle 600
+
+    # Tor does directory fetches itself
+    isolate none if purpose=DIR_*
+    isolate socks_username if socks_username~=.
+    isolate uid, host if port in (80, 443)
+    isolate uid
+
+Rules are "isolate KEYS [if FILTER]" where FILTER is a --filter
+expression on the stream and KEYS is a comma-separated list of: pid,
+uid, cgroup, host, port, source_addr and socks_username, or "none" to
+let Tor choose the circuit. Streams matching no rule are left to
+Tor.
+
+Finding a stream's circuit is a dict lookup; keys are kept in
+least-recently-used order so evicting idle ones is cheap too. Keys
+are also forgotten when their circuit closes, or when a process
+whose pid is part of the key exits.
+'''
+
+from __future__ import print_function
+
+import os
+import collections
+
+from twisted.internet import defer
+from zope.interface import implementer
+import txtorcon
+
+from carml import procindex
+from carml import filters
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def _source(stream):
+    addr, _, port = stream.flags.get('SOURCE_ADDR', '').rpartition(':')
+    return addr, port
+
+
+def _pid(stream, cache):
+    if 'pid' not in cache:
+        addr, port = _source(stream)
+        cache['pid'] = procindex.lookup(addr, port) if addr else None
+    return cache['pid']
+
+
+def _uid(stream, cache):
+    pid = _pid(stream, cache)
+    if pid is None:
+        return None
+    try:
+        return os.stat('/proc/%d' % pid).st_uid
+    except OSError:
+        return None
+
+
+def _cgroup(stream, cache):
+    pid = _pid(stream, cache)
+    if pid is None:
+        return None
+    try:
+        with open('/proc/%d/cgroup' % pid, 'r') as f:
+            # the unified (v2) hierarchy, or else the first one
+            lines = f.read().split('\n')
+    except IOError:
+        return None
+    for line in lines:
+        if line.startswith('0::'):
+            return line[3:]
+    return lines[0].split(':', 2)[-1] if lines else None
+
+
+#: how to get each key from a stream; the second argument caches
+#: things (like the PID) several keys need
+KEYS = dict(
+    pid=_pid,
+    uid=_uid,
+    cgroup=_cgroup,
+    host=lambda stream, cache: stream.target_host,
+    port=lambda stream, cache: stream.target_port,
+    source_addr=lambda stream, cache: _source(stream)[0],
+    socks_username=lambda stream, cache: stream.flags.get('SOCKS_USERNAME', None),
+)
+
+
+class Rule(object):
+    def __init__(self, index, keys, flt):
+        self.index = index
+        #: None means "let Tor choose"
+        self.keys = keys
+        #: where the pid is in our keys, if it is
+        self.pid_at = 1 + keys.index('pid') if keys and 'pid' in keys else None
+        self._extractors = None if keys is None else [KEYS[k] for k in keys]
+        self._filter = flt
+
+    def matches(self, stream):
+        return self._filter is None or self._filter.matches('stream', 'new', stream)
+
+    def key_for(self, stream):
+        cache = dict()
+        return (self.index, ) + tuple(get(stream, cache) for get in self._extractors)
+
+
+class Policy(object):
+    def __init__(self, rules, pool=2, max_keys=1000, idle=600.0):
+        self.rules = rules
+        self.pool = pool
+        self.max_keys = max_keys
+        self.idle = idle
+
+    def rule_for(self, stream):
+        for rule in self.rules:
+            if rule.matches(stream):
+                return rule
+        return None
+
+
+_SETTINGS = {'pool': int, 'max-keys': int, 'idle': float}
+
+
+def parse_policy(lines):
+    settings = dict()
+    rules = []
+    for (lineno, line) in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        word, _, rest = line.partition(' ')
+        rest = rest.strip()
+        try:
+            if word in _SETTINGS:
+                settings[word.replace('-', '_')] = _SETTINGS[word](rest)
+            elif word == 'isolate':
+                rules.append(_parse_rule(len(rules), rest))
+            else:
+                raise PolicyError('Unknown setting "{}"'.format(word))
+        except (ValueError, filters.FilterError) as e:
+            raise PolicyError('line {}: {}'.format(lineno, e))
+    if not rules:
+        raise PolicyError('No "isolate" rules')
+    return Policy(rules, **settings)
+
+
+def _parse_rule(index, text):
+    keys, _, condition = text.partition(' if ')
+    keys = [k.strip() for k in keys.split(',') if k.strip()]
+    if keys == ['none']:
+        keys = None
+    elif not keys:
+        raise PolicyError('"isolate" needs some keys (or "none")')
+    else:
+        unknown = [k for k in keys if k not in KEYS]
+        if unknown:
+            raise PolicyError('Unknown key(s) {} (known: {})'.format(
+                ', '.join(unknown), ', '.join(sorted(KEYS))))
+    flt = None
+    if condition.strip():
+        flt = filters.Filter(condition, ['stream'])
+    return Rule(index, keys, flt)
+
+
+def load_policy(fname):
+    with open(fname, 'r') as f:
+        return parse_policy(f)
+
+
+@implementer(txtorcon.IStreamAttacher)
+class IsolatingAttacher(txtorcon.CircuitListenerMixin):
+    '''
+    Attaches streams according to a Policy, with circuits from a
+    CircuitPool.
+    '''
+
+    def __init__(self, reactor, policy, pool):
+        self._reactor = reactor
+        self._policy = policy
+        self._pool = pool
+        # key -> (circuit, last used), least-recently used first
+        self._circuits = collections.OrderedDict()
+        self._keys = {}             # circuit id -> key
+        self._pid_at = dict((rule.index, rule.pid_at) for rule in policy.rules)
+        # key -> Deferreds for more streams that arrived while we
+        # were getting that key's circuit
+        self._pending = {}
+        #: counters, for the curious
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def attach_stream(self, stream, circuits):
+        rule = self._policy.rule_for(stream)
+        if rule is None or rule.keys is None:
+            return None
+        key = rule.key_for(stream)
+
+        entry = self._circuits.pop(key, None)
+        if entry is not None:
+            if entry[0].state == 'BUILT':
+                self.hits += 1
+                self._circuits[key] = (entry[0], self._reactor.seconds())
+                return entry[0]
+            self._keys.pop(entry[0].id, None)
+
+        self.misses += 1
+        if key in self._pending:
+            d = defer.Deferred()
+            self._pending[key].append(d)
+            return d
+        self._pending[key] = []
+        d = self._pool.take()
+        d.addCallback(self._assign, key, rule)
+        return d
+
+    def _assign(self, circ, key, rule):
+        self._circuits[key] = (circ, self._reactor.seconds())
+        self._keys[circ.id] = key
+        print('Circuit %d for %s' % (circ.id, ', '.join(
+            '%s=%s' % kv for kv in zip(rule.keys, key[1:]))))
+        while len(self._circuits) > self._policy.max_keys:
+            self._evict()
+        for d in self._pending.pop(key, []):
+            d.callback(circ)
+        return circ
+
+    def _evict(self, key=None):
+        if key is None:
+            key, (circ, _) = self._circuits.popitem(last=False)
+        else:
+            circ, _ = self._circuits.pop(key)
+        self._keys.pop(circ.id, None)
+        self.evicted += 1
+        # only close it if that won't cut off anyone's connection
+        if circ.state == 'BUILT' and not circ.streams:
+            d = circ.close()
+            d.addErrback(lambda _: None)    # it's gone already
+
+    def evict_idle(self):
+        '''
+        Forgets keys that haven't had a new stream for policy.idle
+        seconds (the oldest are first, so we stop at the first recent
+        one). Keys whose circuit still carries streams (a long
+        download, an ssh session) count as used now instead.
+        '''
+        now = self._reactor.seconds()
+        cutoff = now - self._policy.idle
+        for _ in range(len(self._circuits)):
+            key = next(iter(self._circuits))
+            circ, last_used = self._circuits[key]
+            if last_used > cutoff:
+                break
+            if circ.streams:
+                del self._circuits[key]
+                self._circuits[key] = (circ, now)
+            else:
+                self._evict()
+
+    def prune(self):
+        '''
+        evict_idle(), and forget keys for processes that have exited.
+        '''
+        self.evict_idle()
+        gone = {}
+        for key in list(self._circuits.keys()):
+            pid_at = self._pid_at[key[0]]
+            if pid_at is None or key[pid_at] is None:
+                continue
+            pid = key[pid_at]
+            if pid not in gone:
+                gone[pid] = procindex.start_time(pid) is None
+            if gone[pid]:
+                self._evict(key)
+
+    def circuit_closed(self, circ, **kw):
+        key = self._keys.pop(circ.id, None)
+        if key is not None:
+            self._circuits.pop(key, None)
+
+    circuit_failed = circuit_closed
+
+    def __len__(self):
+        return len(self._circuits)
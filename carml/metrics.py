@@ -0,0 +1,243 @@
+'''
+Prometheus-style metrics for long-running commands ("carml monitor
+--metrics").
+
+A Registry holds counters and gauges (optionally with labels) which
+our listeners keep up to date as events arrive; a scrape just renders
+the current numbers in the text exposition format, so it costs the
+same no matter how busy Tor is.
+'''
+
+from __future__ import print_function
+
+from twisted.internet import defer, endpoints
+from twisted.web import server, resource
+
+import txtorcon
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Metric(object):
+    def __init__(self, name, kind, help, labels=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}        # tuple of label-values -> number
+
+    def inc(self, labels=(), amount=1):
+        key = tuple(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        self.values[tuple(labels)] = value
+
+    def samples(self):
+        return sorted(self.values.items())
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for (key, value) in self.samples():
+            if key:
+                labels = ','.join(
+                    '{}="{}"'.format(n, _escape(v)) for (n, v) in zip(self.labels, key)
+                )
+                lines.append('{}{{{}}} {}'.format(self.name, labels, value))
+            else:
+                lines.append('{} {}'.format(self.name, value))
+        return lines
+
+
+class _FunctionGauge(Metric):
+    '''
+    A gauge whose value is asked for at scrape-time (for things that
+    are already a len() away).
+    '''
+
+    def __init__(self, name, help, fn):
+        super(_FunctionGauge, self).__init__(name, 'gauge', help)
+        self._fn = fn
+
+    def samples(self):
+        return [((), self._fn())]
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Metric(name, 'counter', help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Metric(name, 'gauge', help, labels))
+
+    def gauge_function(self, name, help, fn):
+        return self._add(_FunctionGauge(name, help, fn))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self._registry.render().encode('utf8')
+
+
+class TorMetrics(txtorcon.CircuitListenerMixin, txtorcon.StreamListenerMixin):
+    '''
+    Keeps a Registry's circuit, stream, guard, bandwidth and
+    address-map metrics up to date from a TorState's events.
+    '''
+
+    def __init__(self, state, registry=None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.circuits = r.gauge(
+            'carml_circuits', 'Circuits by state and purpose.', ['state', 'purpose'],
+        )
+        self.circuit_events = r.counter(
+            'carml_circuit_events_total', 'Circuit events seen.', ['event'],
+        )
+        self.circuit_failures = r.counter(
+            'carml_circuit_failures_total', 'Failed circuits by reason.', ['reason'],
+        )
+        self.streams = r.gauge(
+            'carml_streams', 'Streams by state.', ['state'],
+        )
+        self.stream_failures = r.counter(
+            'carml_stream_failures_total', 'Failed streams by reason.', ['reason'],
+        )
+        self.bytes_read = r.counter(
+            'carml_bytes_read_total', 'Bytes read by Tor (from BW events).',
+        )
+        self.bytes_written = r.counter(
+            'carml_bytes_written_total', 'Bytes written by Tor (from BW events).',
+        )
+        r.gauge_function(
+            'carml_guards', 'Entry guards.', lambda: len(state.entry_guards),
+        )
+        r.gauge_function(
+            'carml_address_mappings', 'Address mappings.', lambda: len(state.addrmap.addr),
+        )
+
+        self._circuit_labels = {}   # circuit id -> (state, purpose)
+        self._stream_labels = {}    # stream id -> (state, )
+        for circuit in state.circuits.values():
+            self._update_circuit(circuit)
+        for stream in state.streams.values():
+            self._update_stream(stream)
+
+        state.add_circuit_listener(self)
+        state.add_stream_listener(self)
+        state.protocol.add_event_listener('BW', self._bandwidth)
+
+    def _update_circuit(self, circuit, closed=False):
+        old = self._circuit_labels.pop(circuit.id, None)
+        if old is not None:
+            self.circuits.dec(old)
+        if not closed:
+            labels = (circuit.state, circuit.purpose or '')
+            self._circuit_labels[circuit.id] = labels
+            self.circuits.inc(labels)
+
+    def _update_stream(self, stream, closed=False):
+        old = self._stream_labels.pop(stream.id, None)
+        if old is not None:
+            self.streams.dec(old)
+        if not closed:
+            labels = (stream.state, )
+            self._stream_labels[stream.id] = labels
+            self.streams.inc(labels)
+
+    def _bandwidth(self, data):
+        read, written = data.split()[:2]
+        self.bytes_read.inc(amount=int(read))
+        self.bytes_written.inc(amount=int(written))
+
+    def circuit_new(self, circuit):
+        self._update_circuit(circuit)
+
+    def circuit_launched(self, circuit):
+        self.circuit_events.inc(['launched'])
+        self._update_circuit(circuit)
+
+    def circuit_extend(self, circuit, router):
+        self._update_circuit(circuit)
+
+    def circuit_built(self, circuit):
+        self.circuit_events.inc(['built'])
+        self._update_circuit(circuit)
+
+    def circuit_failed(self, circuit, **kw):
+        self.circuit_events.inc(['failed'])
+        self.circuit_failures.inc([kw.get('REASON', 'NONE')])
+        self._update_circuit(circuit)
+
+    def circuit_closed(self, circuit, **kw):
+        self.circuit_events.inc(['closed'])
+        self._update_circuit(circuit, closed=True)
+
+    def stream_new(self, stream):
+        self._update_stream(stream)
+
+    def stream_succeeded(self, stream):
+        self._update_stream(stream)
+
+    def stream_attach(self, stream, circuit):
+        self._update_stream(stream)
+
+    def stream_detach(self, stream, **kw):
+        self._update_stream(stream)
+
+    def stream_failed(self, stream, **kw):
+        self.stream_failures.inc([kw.get('reason') or 'NONE'])
+        self._update_stream(stream)
+
+    def stream_closed(self, stream, **kw):
+        self._update_stream(stream, closed=True)
+
+
+def endpoint_string(listen):
+    '''
+    A bare port number means "localhost only"; anything else is a
+    Twisted server endpoint string.
+    '''
+    if str(listen).isdigit():
+        return 'tcp:{}:interface=127.0.0.1'.format(listen)
+    # serverFromString needs a native str (click gives us unicode)
+    return str(listen)
+
+
+@defer.inlineCallbacks
+def serve(reactor, listen, registry):
+    '''
+    Serve registry at /metrics (well, at any path) on the given
+    endpoint; returns the IListeningPort.
+    '''
+    ep = endpoints.serverFromString(reactor, endpoint_string(listen))
+    port = yield ep.listen(server.Site(MetricsResource(registry)))
+    defer.returnValue(port)
@@ -0,0 +1,129 @@
+'''
+An on-disk cache of Tor's router list.
+
+Almost every command does "tor.create_state()", which asks Tor for
+"GETINFO ns/all" -- several megabytes for a full consensus, which is
+slow to get over the control connection (especially a remote one).
+That answer only changes when Tor gets a new consensus, so we keep a
+copy on disk named after the consensus' valid-after time and hand that
+to TorState instead. Circuits, streams etc. are still fetched fresh.
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import glob
+import errno
+import tempfile
+
+from zope.interface import implementer
+from twisted.internet import defer
+
+import txtorcon
+from txtorcon.interface import ITorControlProtocol
+
+#: how many consensuses' worth of files we keep around
+KEEP = 2
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'carml')
+
+
+def _cache_file(cache_dir, valid_after):
+    stamp = re.sub(r'[^0-9]', '', valid_after)
+    return os.path.join(cache_dir, 'ns-all-{}'.format(stamp))
+
+
+def _read(fname):
+    try:
+        with open(fname, 'rb') as f:
+            return f.read().decode('utf8')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def _write(cache_dir, fname, raw):
+    '''
+    Atomically writes the cache file (and removes all but the newest
+    KEEP of them).
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.ns-all-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(raw.encode('utf8'))
+    os.rename(tmp, fname)
+    for old in sorted(glob.glob(os.path.join(cache_dir, 'ns-all-*')))[:-KEEP]:
+        os.unlink(old)
+
+
+@implementer(ITorControlProtocol)
+class _CachedNetworkStatus(object):
+    '''
+    Wraps a TorControlProtocol, answering "ns/all" from our cache and
+    passing everything else through.
+    '''
+
+    def __init__(self, protocol, raw):
+        self._protocol = protocol
+        self._raw = raw
+
+    def get_info_raw(self, *keys):
+        if keys == ('ns/all', ):
+            return defer.succeed(self._raw)
+        return self._protocol.get_info_raw(*keys)
+
+    def get_info_incremental(self, key, line_cb):
+        if key != 'ns/all':
+            return self._protocol.get_info_incremental(key, line_cb)
+        for line in self._raw.split('\n'):
+            if line.startswith('ns/all=') or not line.strip() or line.strip() == 'OK':
+                continue
+            line_cb(line)
+        return defer.succeed(None)
+
+    def __getattr__(self, name):
+        return getattr(self._protocol, name)
+
+
+class CachingTor(object):
+    '''
+    Stands in for a txtorcon.Tor instance; create_state() uses the
+    router-list cache.
+    '''
+
+    def __init__(self, tor, cache_dir):
+        self._tor = tor
+        self._cache_dir = cache_dir
+
+    @defer.inlineCallbacks
+    def create_state(self):
+        protocol = self._tor.protocol
+        try:
+            info = yield protocol.get_info('consensus/valid-after')
+            valid_after = info['consensus/valid-after']
+        except (txtorcon.TorProtocolError, KeyError):
+            # older Tor, or no consensus yet
+            state = yield self._tor.create_state()
+            defer.returnValue(state)
+
+        fname = _cache_file(self._cache_dir, valid_after)
+        raw = _read(fname)
+        if raw is None:
+            raw = yield protocol.get_info_raw('ns/all')
+            try:
+                _write(self._cache_dir, fname, raw)
+            except (IOError, OSError):
+                pass            # we'll just be slow next time, too
+
+        state = txtorcon.TorState(_CachedNetworkStatus(protocol, raw))
+        yield state.post_bootstrap
+        defer.returnValue(state)
+
+    def __getattr__(self, name):
+        return getattr(self._tor, name)
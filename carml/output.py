@@ -0,0 +1,303 @@
+'''
+A bounded, reactor-drained replacement for sys.stdout.
+
+Commands print() a line for every event; if our stdout is a slow
+consumer (a pager, an ssh pipe) a plain write() blocks the reactor and
+then Tor's events pile up behind it. Instead, we queue complete lines
+and let the reactor write them out (in batches) whenever stdout is
+writable.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import stat
+import errno
+import select
+import collections
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.interfaces import IWriteDescriptor
+
+# writes of at most this size to a pipe won't block if select() said
+# it was writable.
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+POLICIES = ['block', 'drop-oldest']
+
+
+@implementer(IWriteDescriptor)
+class OutputQueue(object):
+    '''
+    A file-like object holding at most ``max_lines`` lines which have
+    not yet been written. When full, the ``policy`` decides: "block"
+    writes out everything right now (i.e. the same as an ordinary
+    print) and "drop-oldest" throws away the oldest queued line (and
+    counts it).
+
+    Lines are written after ``flush_interval`` seconds, so a non-zero
+    interval coalesces many print()s (and flush()es) into one write.
+    '''
+
+    def __init__(self, reactor, out, max_lines=10000, policy='block', flush_interval=0.0):
+        if policy not in POLICIES:
+            raise ValueError('Unknown output policy "{}"'.format(policy))
+        self._reactor = reactor
+        self._out = out
+        self._fd = out.fileno()
+        self.max_lines = max_lines
+        self.policy = policy
+        self.flush_interval = flush_interval
+
+        self._lines = collections.deque()
+        self._partial = b''
+        self._pending = b''     # being written out right now
+        self._writing = False   # True if we're added as a writer
+        self._scheduled = None  # IDelayedCall for the next _drain()
+        self._lost = False
+        #: how many lines we've thrown away (drop-oldest policy)
+        self.dropped = 0
+        self._reported_dropped = 0
+
+    @staticmethod
+    def suitable(out):
+        '''
+        Regular files never make us wait, and some reactors (epoll)
+        can't watch them anyway, so we only queue for pipes, ttys etc.
+        '''
+        try:
+            return not stat.S_ISREG(os.fstat(out.fileno()).st_mode)
+        except (AttributeError, ValueError, OSError):
+            return False
+
+    # file-like API
+
+    def write(self, data):
+        if self._lost:
+            return
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if len(self._lines) >= self.max_lines:
+                if self.policy == 'drop-oldest':
+                    self._lines.popleft()
+                    self.dropped += 1
+                else:
+                    self._flush_blocking()
+            self._lines.append(line + b'\n')
+        if lines:
+            self._schedule()
+
+    def flush(self):
+        # a real flush happens at the next _drain; calling this often
+        # is therefore cheap
+        self._schedule()
+
+    def fileno(self):
+        return self._fd
+
+    def isatty(self):
+        return self._out.isatty()
+
+    def close(self):
+        '''
+        Synchronously write everything still queued (including any
+        incomplete last line) and report dropped lines, if any.
+        '''
+        if self._scheduled is not None and self._scheduled.active():
+            self._scheduled.cancel()
+        self._scheduled = None
+        if self._partial:
+            self._lines.append(self._partial)
+            self._partial = b''
+        self._flush_blocking()
+        if self.dropped:
+            print('carml: dropped {} lines of output in total.'.format(self.dropped), file=sys.stderr)
+
+    # IWriteDescriptor
+
+    def doWrite(self):
+        if not self._pending:
+            self._pending = b''.join(self._lines)
+            self._lines.clear()
+        if self._pending:
+            try:
+                written = os.write(self._fd, self._pending[:PIPE_BUF])
+            except (OSError, IOError) as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return None
+                # e.g. EPIPE; nobody is listening any more
+                self._lost = True
+                return e
+            self._pending = self._pending[written:]
+        if not self._pending and not self._lines:
+            self._reactor.removeWriter(self)
+            self._writing = False
+        return None
+
+    def connectionLost(self, reason):
+        # the reactor removed us: either doWrite() failed, or it is
+        # shutting down (disconnectAll), in which case close() still
+        # writes out whatever is queued
+        self._writing = False
+        if self._lost:
+            self._lines.clear()
+            self._pending = b''
+
+    def logPrefix(self):
+        return 'OutputQueue'
+
+    # internals
+
+    def _schedule(self):
+        if self._scheduled is None and not self._writing:
+            self._scheduled = self._reactor.callLater(self.flush_interval, self._drain)
+
+    def _drain(self):
+        self._scheduled = None
+        if self.dropped > self._reported_dropped:
+            print(
+                'carml: output too slow, dropped {} lines.'.format(self.dropped - self._reported_dropped),
+                file=sys.stderr,
+            )
+            self._reported_dropped = self.dropped
+        if self._lines and not self._writing and not self._lost:
+            self._writing = True
+            self._reactor.addWriter(self)
+
+    def _flush_blocking(self):
+        if self._writing:
+            self._reactor.removeWriter(self)
+            self._writing = False
+        data = self._pending + b''.join(self._lines)
+        self._pending = b''
+        self._lines.clear()
+        if self._lost:
+            return
+        while data:
+            try:
+                written = os.write(self._fd, data)
+            except (OSError, IOError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    # still non-blocking; wait until the reader
+                    # catches up
+                    try:
+                        select.select([], [self._fd], [])
+                    except (select.error, OSError):
+                        pass    # EINTR; just try again
+                    continue
+                # e.g. EPIPE; nobody is listening any more
+                self._lost = True
+                return
+            data = data[written:]
+
+
+class Switch(object):
+    '''
+    A file-like object (to put in sys.stdout) that writes to whichever
+    writer is current -- e.g. one per Tor instance, or per daemon
+    client -- or else to ``default``.
+
+    Commands just print(), so each writer is made current around
+    everything done on its behalf: call() for a function, and
+    SwitchedReactor and deferred() so that timers and Deferred
+    callbacks are too.
+    '''
+
+    def __init__(self, default):
+        self.default = default
+        self.current = None
+
+    def _out(self):
+        return self.default if self.current is None else self.current
+
+    def write(self, data):
+        self._out().write(data)
+
+    def flush(self):
+        self._out().flush()
+
+    def isatty(self):
+        return self.default.isatty()
+
+    def fileno(self):
+        return self.default.fileno()
+
+    def call(self, writer, fn, *args, **kw):
+        previous, self.current = self.current, writer
+        try:
+            return fn(*args, **kw)
+        finally:
+            self.current = previous
+
+    def wrap(self, writer, fn):
+        '''
+        fn, but always called with writer current
+        '''
+        def wrapped(*args, **kw):
+            return self.call(writer, fn, *args, **kw)
+        return wrapped
+
+    def deferred(self, writer, d):
+        '''
+        Returns a Deferred which fires like d, but whose callbacks run
+        with writer current.
+        '''
+        if not isinstance(d, defer.Deferred):
+            return d
+        switched = defer.Deferred()
+        d.addBoth(self.wrap(writer, switched.callback))
+        return switched
+
+
+class SwitchedReactor(object):
+    '''
+    A reactor whose timers and triggers run with one Switch writer
+    current; everything else is the real reactor.
+    '''
+
+    def __init__(self, reactor, switch, writer):
+        self._reactor = reactor
+        self._switch = switch
+        self._writer = writer
+
+    def callLater(self, delay, fn, *args, **kw):
+        return self._reactor.callLater(delay, self._switch.call, self._writer, fn, *args, **kw)
+
+    def callWhenRunning(self, fn, *args, **kw):
+        return self._reactor.callWhenRunning(self._switch.call, self._writer, fn, *args, **kw)
+
+    def addSystemEventTrigger(self, phase, event, fn, *args, **kw):
+        return self._reactor.addSystemEventTrigger(
+            phase, event, self._switch.call, self._writer, fn, *args, **kw
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._reactor, name)
+
+
+class SwitchedProxy(object):
+    '''
+    Wraps e.g. a control protocol so that the Deferreds its methods
+    return call back with one Switch writer current.
+    '''
+
+    def __init__(self, target, switch, writer):
+        self._target = target
+        self._switch = switch
+        self._writer = writer
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kw):
+            return self._switch.deferred(self._writer, attr(*args, **kw))
+        return call
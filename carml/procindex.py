@@ -0,0 +1,188 @@
+'''
+Finding which local process owns a stream's source socket.
+
+txtorcon.util.process_from_address runs an external program (lsof)
+for every lookup, which is slow and blocks the reactor. Instead we
+keep an index built from /proc: /proc/net/tcp{,6} maps each local
+address to a socket inode, and /proc/<pid>/fd maps inodes to
+processes. Lookups are dict-lookups; when one misses we re-read the
+(small) socket tables and only look at processes we haven't seen
+before, falling back to re-scanning every process at most once per
+``ttl`` seconds.
+
+On systems without /proc we fall back to txtorcon's lsof-based lookup.
+'''
+
+from __future__ import print_function
+
+import os
+import time
+import errno
+import socket
+import struct
+import binascii
+
+_index = None
+
+
+def lookup(addr, port):
+    '''
+    Returns the PID that owns the local socket addr:port (or None),
+    using a shared ProcessIndex.
+    '''
+    global _index
+    if _index is None:
+        _index = ProcessIndex()
+    return _index.lookup(addr, port)
+
+
+def start_time(pid, proc='/proc'):
+    '''
+    When process pid started (in clock ticks since boot), or None if
+    it is gone. A PID that comes back with a different start time has
+    been re-used by another process.
+    '''
+    try:
+        with open(os.path.join(proc, str(pid), 'stat'), 'r') as f:
+            stat = f.read()
+    except IOError:
+        if os.path.exists(os.path.join(proc, 'self')):
+            return None
+        # no /proc; all we can tell is whether it exists
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return 0 if e.errno == errno.EPERM else None
+        return 0
+    # the command name (in parens) may contain spaces
+    return int(stat.rpartition(')')[2].split()[19])
+
+
+def _decode_address(hexaddr):
+    '''
+    Turns /proc/net/tcp's "0100007F:1F90" into ('127.0.0.1', 8080)
+    '''
+    ip, port = hexaddr.split(':')
+    packed = binascii.unhexlify(ip)
+    # the kernel prints each 32-bit word in host byte-order
+    words = struct.unpack('=%dI' % (len(packed) // 4), packed)
+    packed = struct.pack('>%dI' % len(words), *words)
+    if len(packed) == 4:
+        ip = socket.inet_ntoa(packed)
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, packed)
+        if ip.startswith('::ffff:') and '.' in ip:
+            ip = ip[7:]
+    return ip, int(port, 16)
+
+
+class ProcessIndex(object):
+    def __init__(self, ttl=2.0, proc='/proc', clock=time.time):
+        self.ttl = ttl
+        self._proc = proc
+        self._clock = clock
+        self.available = os.path.exists(os.path.join(proc, 'net', 'tcp'))
+        self._by_address = {}       # (ip, port) -> socket inode
+        self._by_inode = {}         # socket inode -> pid
+        self._inodes_by_pid = {}    # pid -> set of inodes
+        self._sockets_scanned = float('-inf')
+        self._pids_scanned = float('-inf')
+        self._unowned = {}          # socket inode -> when a full scan didn't find it
+        #: counters, for the curious
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, addr, port):
+        if not self.available:
+            import txtorcon
+            return txtorcon.util.process_from_address(addr, port)
+        try:
+            key = (addr, int(port))
+        except (TypeError, ValueError):
+            return None         # e.g. "(Tor_internal)"
+
+        now = self._clock()
+        if now - self._sockets_scanned > self.ttl:
+            self._scan_sockets(now)
+        pid = self._pid_for(key)
+        if pid is not None:
+            self.hits += 1
+            return pid
+
+        # a new socket since we last looked?
+        self.misses += 1
+        if key not in self._by_address and self._sockets_scanned != now:
+            self._scan_sockets(now)
+        inode = self._by_address.get(key)
+        if inode is None:
+            return None
+        self._scan_pids(new_only=True)
+        if inode not in self._by_inode:
+            # a process we already know opened it, so look at all of
+            # them again -- but only once per ttl for any socket we
+            # can't find an owner for (e.g. another user's)
+            last = self._unowned.get(inode)
+            if last is None or now - last > self.ttl:
+                self._pids_scanned = now
+                self._scan_pids(new_only=False)
+                if inode not in self._by_inode:
+                    self._unowned[inode] = now
+        return self._by_inode.get(inode, None)
+
+    def _pid_for(self, key):
+        inode = self._by_address.get(key)
+        if inode is None:
+            return None
+        return self._by_inode.get(inode, None)
+
+    def _scan_sockets(self, now):
+        by_address = {}
+        for name in ('tcp', 'tcp6'):
+            try:
+                f = open(os.path.join(self._proc, 'net', name), 'r')
+            except IOError:
+                continue
+            with f:
+                f.readline()    # header
+                for line in f:
+                    fields = line.split()
+                    inode = int(fields[9])
+                    if inode:
+                        by_address[_decode_address(fields[1])] = inode
+        self._by_address = by_address
+        self._sockets_scanned = now
+        live = set(by_address.values())
+        for inode in [i for i in self._unowned if i not in live]:
+            del self._unowned[inode]
+
+    def _scan_pids(self, new_only):
+        pids = set(int(p) for p in os.listdir(self._proc) if p.isdigit())
+        for pid in set(self._inodes_by_pid.keys()) - pids:
+            # gone away
+            for inode in self._inodes_by_pid.pop(pid):
+                if self._by_inode.get(inode) == pid:
+                    del self._by_inode[inode]
+        if new_only:
+            pids -= set(self._inodes_by_pid.keys())
+        for pid in pids:
+            self._scan_pid(pid)
+
+    def _scan_pid(self, pid):
+        fd_dir = os.path.join(self._proc, str(pid), 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # gone, or not ours to look at
+            self._inodes_by_pid.setdefault(pid, set())
+            return
+        inodes = set()
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if target.startswith('socket:['):
+                inode = int(target[8:-1])
+                inodes.add(inode)
+                self._by_inode[inode] = pid
+        self._inodes_by_pid[pid] = inodes
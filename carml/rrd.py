@@ -0,0 +1,157 @@
+'''
+A round-robin file of bandwidth history ("carml graph --record",
+"carml graph --history").
+
+The file has a fixed size, set when it is created: for each archive
+(a resolution, like one bucket per minute) a fixed number of rows,
+and row N holds bucket N modulo the number of rows. Each row starts
+with the bucket's number, so a row still holding an older bucket is
+simply reset when we next write to it; nothing ever needs pruning.
+Every bucket has the total bytes and the busiest second for each of
+COLUMNS. The file is mmap()-ed, so adding a sample is a couple of
+struct calls per archive and leaves the writing to the kernel.
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import mmap
+import struct
+
+#: what we keep history of; read/written are Tor's totals (from BW
+#: events) and stream_read/stream_written the sum of STREAM_BW events
+COLUMNS = ('read', 'written', 'stream_read', 'stream_written')
+
+#: (seconds per bucket, buckets kept): an hour of seconds, two weeks
+#: of minutes and a year of hours -- about 2.3MB
+ARCHIVES = ((1, 3600), (60, 14 * 24 * 60), (3600, 365 * 24))
+
+#: the names --history accepts for each archive
+RESOLUTIONS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+_MAGIC = b'CARMLRRD'
+_VERSION = 1
+_HEADER = struct.Struct('<8sII')
+_ARCHIVE = struct.Struct('<II')
+# bucket number, then (total, busiest second) for each column
+_ROW = struct.Struct('<q' + 'dd' * len(COLUMNS))
+_EMPTY = (0.0, ) * (2 * len(COLUMNS))
+
+
+class StoreError(ValueError):
+    pass
+
+
+def default_store(endpoint):
+    '''
+    Where we keep the history of the Tor at endpoint (an --connect
+    string), unless told otherwise.
+    '''
+    base = os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
+    name = re.sub(r'[^A-Za-z0-9.-]+', '_', endpoint).strip('_')
+    return os.path.join(base, 'carml', 'bandwidth-{}.rrd'.format(name))
+
+
+class RoundRobinStore(object):
+
+    def __init__(self, fname, readonly=False, archives=ARCHIVES):
+        self.fname = fname
+        if not os.path.exists(fname):
+            if readonly:
+                raise StoreError('No bandwidth history in "{}"'.format(fname))
+            _create(fname, archives)
+
+        with open(fname, 'rb' if readonly else 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise StoreError('"{}" is not a bandwidth history file'.format(fname))
+            access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+            self._map = mmap.mmap(f.fileno(), size, access=access)
+
+        magic, version, count = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise StoreError('"{}" is not a bandwidth history file'.format(fname))
+        self.archives = []      # (step, slots, offset of first row)
+        offset = _HEADER.size + count * _ARCHIVE.size
+        for i in range(count):
+            step, slots = _ARCHIVE.unpack_from(self._map, _HEADER.size + i * _ARCHIVE.size)
+            self.archives.append((step, slots, offset))
+            offset += slots * _ROW.size
+        if offset != size:
+            self.close()
+            raise StoreError('"{}" is truncated or corrupt'.format(fname))
+
+    def add(self, epoch, **values):
+        '''
+        Adds bytes to some COLUMNS, e.g. add(now, read=10, written=20).
+        '''
+        columns = [(2 * COLUMNS.index(name), float(amount)) for (name, amount) in values.items()]
+        peaks = None
+        for (step, slots, offset) in self.archives:
+            bucket = int(epoch // step)
+            where = offset + (bucket % slots) * _ROW.size
+            row = _ROW.unpack_from(self._map, where)
+            data = list(_EMPTY) if row[0] != bucket else list(row[1:])
+            for (i, amount) in columns:
+                data[i] += amount
+                # the finest archive says how busy this second was
+                data[i + 1] = max(data[i + 1], data[i] if peaks is None else peaks[i])
+            if peaks is None:
+                peaks = data
+            _ROW.pack_into(self._map, where, bucket, *data)
+
+    def buckets(self, step):
+        '''
+        For the archive with step seconds per bucket: (start, step,
+        means, maxes) for each bucket, oldest first. means and maxes
+        are bytes/second per column.
+        '''
+        for (archive_step, slots, offset) in self.archives:
+            if archive_step == step:
+                break
+        else:
+            raise StoreError('No archive with {}s buckets in "{}"'.format(step, self.fname))
+
+        rows = []
+        for i in range(slots):
+            row = _ROW.unpack_from(self._map, offset + i * _ROW.size)
+            if row[0] or any(row[1:]):
+                rows.append(row)
+        if not rows:
+            return []
+        newest = max(row[0] for row in rows)
+        result = []
+        for row in sorted(rows):
+            if row[0] <= newest - slots:
+                continue        # from before a gap; not overwritten yet
+            result.append((
+                row[0] * step, step,
+                tuple(total / float(step) for total in row[1::2]),
+                row[2::2],
+            ))
+        return result
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def _create(fname, archives):
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+    size = _HEADER.size + len(archives) * _ARCHIVE.size
+    size += sum(slots for (step, slots) in archives) * _ROW.size
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(archives)))
+        for (step, slots) in archives:
+            f.write(_ARCHIVE.pack(step, slots))
+        f.truncate(size)
+    os.rename(tmp, fname)
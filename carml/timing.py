@@ -0,0 +1,106 @@
+'''
+Timing of our event-listeners (for "carml --profile").
+
+Wrap anything that Tor's events call with timed() or timed_listener();
+unless enable() has been called, they return what they're given so
+there is no cost at all.
+'''
+
+from __future__ import print_function
+
+import sys
+import time
+import random
+
+# per-listener samples we keep for percentiles
+RESERVOIR_SIZE = 10000
+
+_timer = None
+
+
+def enable():
+    global _timer
+    if _timer is None:
+        _timer = ListenerTimer()
+    return _timer
+
+
+def timed(name, fn):
+    '''
+    Returns fn, or a wrapper that times calls to it if timing is
+    enabled.
+    '''
+    if _timer is None:
+        return fn
+    return _timer.wrap(name, fn)
+
+
+def timed_listener(name, listener):
+    '''
+    Time the circuit_*, stream_* and addrmap_* methods of a
+    listener (like a CircuitListenerMixin). Returns the listener.
+    '''
+    if _timer is None:
+        return listener
+    for attr in dir(listener):
+        if attr.startswith(('circuit_', 'stream_', 'addrmap_')):
+            method = getattr(listener, attr)
+            if callable(method):
+                setattr(listener, attr, _timer.wrap('{}.{}'.format(name, attr), method))
+    return listener
+
+
+class _Samples(object):
+    __slots__ = ['count', 'total', 'reservoir']
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.reservoir = []
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if len(self.reservoir) < RESERVOIR_SIZE:
+            self.reservoir.append(elapsed)
+        else:
+            # reservoir sampling, so memory is bounded but the
+            # percentiles still cover the whole run
+            i = random.randint(0, self.count - 1)
+            if i < RESERVOIR_SIZE:
+                self.reservoir[i] = elapsed
+
+    def percentile(self, pct):
+        ordered = sorted(self.reservoir)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+class ListenerTimer(object):
+    def __init__(self):
+        self._samples = {}      # name -> _Samples
+
+    def wrap(self, name, fn):
+        samples = self._samples.setdefault(name, _Samples())
+
+        def timed_call(*args, **kw):
+            start = time.time()
+            try:
+                return fn(*args, **kw)
+            finally:
+                samples.add(time.time() - start)
+        return timed_call
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        used = [(n, s) for (n, s) in self._samples.items() if s.count]
+        if not used:
+            return
+        width = max(len(n) for (n, _) in used)
+        print('{}  {:>8}  {:>10}  {:>10}  {:>10}'.format(
+            'listener'.ljust(width), 'calls', 'total ms', 'p50 ms', 'p99 ms'), file=out)
+        for (name, s) in sorted(used, key=lambda x: x[1].total, reverse=True):
+            print('{}  {:8d}  {:10.1f}  {:10.3f}  {:10.3f}'.format(
+                name.ljust(width), s.count, s.total * 1000.0,
+                s.percentile(50) * 1000.0, s.percentile(99) * 1000.0), file=out)
@@ -0,0 +1,307 @@
+'''
+Recording Tor's control-port events to a file ("carml events
+--record") and replaying them later through the normal commands
+("carml replay"), without any Tor running.
+
+A trace is a text file (gzip-compressed if the name ends in ".gz")
+with one line per event::
+
+    <unix-time> <EVENT> <payload>
+
+Newlines and backslashes in the payload are backslash-escaped. When a
+recording starts, the answers to a few GETINFO keys are recorded too
+(as "GETINFO:<key>" lines) so that a TorState can be bootstrapped from
+the trace. Recording again to the same file appends; the gap between
+the recordings is skipped when replaying.
+
+Anything else asked of a replay -- GETINFO keys that aren't in the
+snapshot, commands, web requests -- isn't there, and fails (or, for
+web_agent(), gives None) the way it would for a Tor that can't answer.
+'''
+
+from __future__ import print_function
+
+import re
+import sys
+import gzip
+import time
+import functools
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.python import log
+
+import txtorcon
+from txtorcon.interface import ITorControlProtocol
+
+from carml import util
+
+#: what we ask Tor for at the start of a recording; enough for
+#: TorState to bootstrap
+SNAPSHOT_KEYS = [
+    'version',
+    'status/version/current',
+    'dormant',
+    'process/pid',
+    'events/names',
+    'ns/all',
+    'circuit-status',
+    'stream-status',
+    'address-mappings/all',
+    'entry-guards',
+]
+
+# when replaying as fast as possible, go back to the reactor after
+# this many events
+_BATCH = 1000
+
+_unescape_re = re.compile(r'\\(.)')
+
+
+def _escape(payload):
+    return payload.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _unescape(payload):
+    return _unescape_re.sub(lambda m: '\n' if m.group(1) == 'n' else m.group(1), payload)
+
+
+def _open(fname, mode):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode)
+    return open(fname, mode)
+
+
+def read_trace(fname):
+    '''
+    Generates (timestamp, name, payload) tuples from a trace file.
+    '''
+    with _open(fname, 'rb') as f:
+        for line in f:
+            line = line.decode('utf8').rstrip('\n')
+            if not line:
+                continue
+            parts = line.split(' ', 2)
+            if len(parts) == 2:
+                parts.append('')
+            yield float(parts[0]), parts[1], _unescape(parts[2])
+
+
+class TraceWriter(object):
+    '''
+    Appends events to a trace file.
+    '''
+
+    def __init__(self, fname):
+        self._file = _open(fname, 'ab')
+        self.written = 0
+
+    def write(self, name, payload):
+        line = '%.6f %s %s\n' % (time.time(), name, _escape(payload))
+        self._file.write(line.encode('utf8'))
+        self.written += 1
+
+    def listener(self, name):
+        '''
+        Returns a callable suitable for add_event_listener(name, ...)
+        '''
+        return functools.partial(self.write, name)
+
+    @defer.inlineCallbacks
+    def snapshot(self, protocol):
+        for key in SNAPSHOT_KEYS:
+            try:
+                raw = yield protocol.get_info_raw(key)
+            except txtorcon.TorProtocolError:
+                continue
+            self.write('GETINFO:' + key, raw)
+
+    def close(self):
+        self._file.close()
+
+
+@implementer(ITorControlProtocol)
+class ReplayProtocol(object):
+    '''
+    Enough of a TorControlProtocol for TorState and the carml
+    commands to work; GETINFO answers come from the snapshot in the
+    trace and events come from ReplayTor.play().
+    '''
+
+    def __init__(self, info):
+        self._info = info       # key -> raw GETINFO answer
+        self._listeners = {}    # event-name -> list of callables
+        self.post_bootstrap = defer.succeed(self)
+        self.on_disconnect = defer.Deferred()
+        self.version = self._value('version')
+        # TorState looks at these; we never own a replayed Tor
+        self.is_owned = None
+
+    def _value(self, key):
+        raw = self._info.get(key, '')
+        prefix = key + '='
+        if raw.startswith(prefix):
+            raw = raw[len(prefix):]
+        return raw.lstrip('\n')
+
+    def _missing(self, keys):
+        '''
+        Fails the way Tor does for unknown keys (callers like TorState
+        expect a TorProtocolError), or returns None.
+        '''
+        missing = [k for k in keys if k not in self._info]
+        if missing:
+            return defer.fail(txtorcon.TorProtocolError(
+                552, 'GETINFO {} not in trace'.format(' '.join(missing)),
+            ))
+        return None
+
+    def get_info_raw(self, *keys):
+        return self._missing(keys) or defer.succeed('\n'.join(self._info[k] for k in keys))
+
+    def get_info(self, *keys):
+        return self._missing(keys) or defer.succeed(dict((k, self._value(k)) for k in keys))
+
+    def get_info_incremental(self, key, line_cb):
+        d = self.get_info_raw(key)
+
+        def _feed(raw):
+            for line in raw.split('\n'):
+                if line.strip() and line.strip() != 'OK':
+                    line_cb(line)
+        d.addCallback(_feed)
+        return d
+
+    def get_conf(self, *args):
+        return defer.succeed({})
+
+    def add_event_listener(self, evt, callback):
+        self._listeners.setdefault(evt, []).append(callback)
+        return defer.succeed(None)
+
+    def remove_event_listener(self, evt, callback):
+        self._listeners[evt].remove(callback)
+        return defer.succeed(None)
+
+    def queue_command(self, cmd, *args, **kw):
+        return defer.fail(RuntimeError('Can\'t send "{}" to a replay'.format(cmd)))
+
+    def signal(self, name):
+        return self.queue_command('SIGNAL ' + name)
+
+    def dispatch(self, name, payload):
+        for cb in self._listeners.get(name, [])[:]:
+            try:
+                cb(payload)
+            except Exception:
+                log.err()
+
+
+class ReplayTor(object):
+    '''
+    Stands in for a txtorcon.Tor instance, but replays a trace.
+    '''
+
+    def __init__(self, reactor, fname):
+        self._reactor = reactor
+        self._events = read_trace(fname)
+        self._next = None
+
+        # read the snapshot at the start of the trace
+        info = dict()
+        for (ts, name, payload) in self._events:
+            if not name.startswith('GETINFO:'):
+                self._next = (ts, name, payload)
+                break
+            info[name[len('GETINFO:'):]] = payload
+        self.protocol = ReplayProtocol(info)
+        self.replayed = 0
+        #: the trace's time of the event being replayed
+        self.now = None
+
+    @property
+    def proto(self):
+        return self.protocol
+
+    def create_state(self):
+        state = txtorcon.TorState(self.protocol)
+        return state.post_bootstrap
+
+    def seconds(self):
+        '''
+        The time according to the trace, so durations measured while
+        replaying at any --speed are the recorded ones.
+        '''
+        if self.now is None:
+            return self._reactor.seconds()
+        return self.now
+
+    def web_agent(self, *args, **kw):
+        '''
+        None: a replay can't make web requests, so commands leave out
+        what they'd fetch (e.g. "relay --info" from Onionoo).
+        '''
+        return None
+
+    def _next_event(self):
+        if self._next is not None:
+            event, self._next = self._next, None
+            return event
+        for (ts, name, payload) in self._events:
+            if name.startswith('GETINFO:'):
+                # the snapshot of a later recording appended to the
+                # same file; don't wait out the time between them
+                self._first = None
+                continue
+            return (ts, name, payload)
+        return None
+
+    def play(self, speed=1.0):
+        '''
+        Feed all the trace's events to our listeners; ``speed`` of 1.0
+        is the original speed, 2.0 is twice as fast etc. and 0 is as
+        fast as possible. Returns a Deferred that fires when done.
+        '''
+        self._done = defer.Deferred()
+        self._speed = speed
+        self._began = self._reactor.seconds()
+        # trace time _first was (or is due) at reactor time _started
+        self._started = None
+        self._first = None
+        self._reactor.callLater(0, self._play_some)
+        return self._done
+
+    def _play_some(self):
+        count = 0
+        while True:
+            event = self._next_event()
+            if event is None:
+                break
+            ts, name, payload = event
+            if self._first is None:
+                self._first = ts
+                self._started = self._reactor.seconds()
+            if self._speed > 0:
+                due = self._started + (ts - self._first) / self._speed
+                delay = due - self._reactor.seconds()
+                if delay > 0:
+                    self._next = event
+                    self._reactor.callLater(delay, self._play_some)
+                    return
+            self.now = ts
+            self.protocol.dispatch(name, payload)
+            self.replayed += 1
+            count += 1
+            if count >= _BATCH:
+                self._reactor.callLater(0, self._play_some)
+                return
+
+        elapsed = self._reactor.seconds() - self._began
+        print(
+            util.colors.italic('Replayed {} events in {:.2f}s ({:.0f} events/s).'.format(
+                self.replayed, elapsed, self.replayed / elapsed if elapsed else 0.0,
+            )),
+            file=sys.stderr,
+        )
+        self.protocol.on_disconnect.callback(None)
+        self._done.callback(None)
@@ -8,11 +8,19 @@ wonky.
 
 from __future__ import print_function
 
+import json
+import time
 import datetime
 import functools
 
 import colors
 
+from carml import geoip
+
+#: how commands should output things; "text" or "jsonl" (one JSON
+#: object per line). See set_output_format()
+output_format = 'text'
+
 
 class NoColor(object):
     '''
@@ -41,6 +49,63 @@ def turn_off_color():
     colors = NoColor()
 
 
+def set_output_format(fmt):
+    """
+    In "jsonl" mode, commands print one json_record() per circuit,
+    stream, event etc. instead of human-readable (coloured, padded)
+    lines.
+    """
+    global output_format
+    if fmt not in ('text', 'jsonl'):
+        raise ValueError('Unknown output format "{}"'.format(fmt))
+    output_format = fmt
+    if fmt == 'jsonl':
+        turn_off_color()
+
+
+def json_record(kind, **fields):
+    """
+    Print a single record (kind is "circuit", "stream" etc) as one
+    line of JSON.
+    """
+    fields['type'] = kind
+    fields['time'] = time.time()
+    print(json.dumps(fields, separators=(',', ':'), default=str))
+
+
+def router_record(router):
+    return dict(
+        id=router.id_hex,
+        name=router.name,
+        ip=router.ip,
+        country=geoip.router_country(router),
+    )
+
+
+def circuit_record(circ, now=None):
+    return dict(
+        id=circ.id,
+        state=circ.state,
+        purpose=circ.purpose,
+        age=circ.age(now),
+        path=[router_record(r) for r in circ.path],
+        flags=circ.flags,
+    )
+
+
+def stream_record(stream):
+    return dict(
+        id=stream.id,
+        state=stream.state,
+        target_host=stream.target_host,
+        target_port=stream.target_port,
+        source_addr=stream.source_addr,
+        source_port=stream.source_port,
+        circuit=stream.circuit.id if stream.circuit else None,
+        flags=stream.flags,
+    )
+
+
 def pretty_progress(percent, size=10, ascii=False):
     """
     Displays a unicode or ascii based progress bar of a certain
@@ -88,19 +153,64 @@ def wrap(text, width, prefix=''):
     return '\n'.join(lines)
 
 
+class DisplayCache(object):
+    """
+    Rendered router names and locations. They only change when the
+    consensus does, so see invalidate_on_new_consensus().
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render, *args):
+        try:
+            value = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            value = self._cache[key] = render(*args)
+            return value
+        self.hits += 1
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+display_cache = DisplayCache()
+
+
+def invalidate_on_new_consensus(protocol):
+    """
+    For long-running commands: forget rendered names and locations
+    whenever Tor gets a new consensus.
+    """
+    return protocol.add_event_listener('NEWCONSENSUS', lambda _: display_cache.clear())
+
+
 def format_net_location(loc, verbose_asn=False):
+    return display_cache.get(('location', loc.ip, verbose_asn), _format_net_location, loc, verbose_asn)
+
+
+def _format_net_location(loc, verbose_asn):
     rtn = '(%s ' % loc.ip
     comma = False
-    if loc.asn:
+    asn = loc.asn or geoip.shared().asn(loc.ip)
+    if asn:
         if verbose_asn:
-            rtn += loc.asn
+            rtn += asn
         else:
-            rtn += loc.asn.split()[0]
+            rtn += asn.split()[0]
         comma = True
-    if loc.countrycode:
+    countrycode = geoip.shared().country(loc.ip) or loc.countrycode
+    if countrycode:
         if comma:
             rtn += ', '
-        rtn += loc.countrycode
+        rtn += countrycode
         comma = True
     if loc.city and loc.city[0]:
         if comma:
@@ -114,6 +224,11 @@ def nice_router_name(router, color=True):
     """
     returns a router name with ~ at the front if it's not a named router
     """
+    color = color and not isinstance(colors, NoColor)
+    return display_cache.get(('name', router.id_hex, color), _nice_router_name, router, color)
+
+
+def _nice_router_name(router, color):
     green = str
     italic = str
     if color:
@@ -124,10 +239,18 @@ def nice_router_name(router, color=True):
     return italic('~%s' % router.name)
 
 
-def dump_circuits(state, verbose, show_countries=False):
+def dump_circuits(state, verbose, show_countries=False, circuits=None):
+    if circuits is None:
+        circuits = state.circuits.values()
+    if output_format == 'jsonl':
+        now = datetime.datetime.utcnow()
+        for circ in sorted(circuits, key=lambda c: c.id):
+            json_record('circuit', **circuit_record(circ, now))
+        return
+
     print('  %-4s | %-5s | %-42s | %-8s | %-12s' % ('ID', 'Age', 'Path (router names, ~ means no Named flag)', 'State', 'Purpose'))
     print(' ------+-------+' + ('-' * 44) + '+' + (10 * '-') + '+' + (12 * '-'))
-    circuits = state.circuits.values()
+    circuits = list(circuits)
     circuits.sort(lambda a, b: cmp(a.id, b.id))
     now = datetime.datetime.utcnow()
     for circ in circuits:
@@ -152,7 +275,7 @@ def dump_circuits(state, verbose, show_countries=False):
         print(colors.bold('  %4d | %5s | %s | %-8s | %-12s' % (circ.id, age, path, circ.state, circ.purpose)))
         # print str(circ.flags)
         if show_countries:
-            print(' ' * 17, '->'.join(map(lambda x: x.location.countrycode, circ.path)))
+            print(' ' * 17, '->'.join(map(lambda x: geoip.router_country(x) or '??', circ.path)))
         if verbose:
             padding = ' ' * 17
             print(' ' * 8, ', '.join([(str(k) + '=' + str(v)) for (k, v) in circ.flags.items()]))